@@ -1,6 +1,40 @@
+from django import forms
 from django.contrib import admin
-from .models import Staff, Store, Schedule
+from . import conflicts
+from .models import RecurringBlock, RecurringBlockException, Staff, Store, Schedule
+
+
+class ScheduleAdminForm(forms.ModelForm):
+
+    def clean(self):
+        # 管理サイトの保存処理はトランザクションの中で行われるので、ここでの確認がそのまま書き込みまで有効
+        cleaned_data = super().clean()
+        if not self.errors:
+            conflicts.check_schedule(Schedule(
+                pk=self.instance.pk,
+                staff=cleaned_data['staff'],
+                start=cleaned_data['start'],
+                end=cleaned_data['end'],
+                name=cleaned_data.get('name'),
+            ))
+        return cleaned_data
+
+
+@admin.register(Schedule)
+class ScheduleAdmin(admin.ModelAdmin):
+    form = ScheduleAdminForm
+
+
+class RecurringBlockExceptionInline(admin.TabularInline):
+    model = RecurringBlockException
+    extra = 1
+
+
+@admin.register(RecurringBlock)
+class RecurringBlockAdmin(admin.ModelAdmin):
+    list_display = ('staff', 'name', 'weekday', 'start_hour', 'end_hour', 'start_date', 'end_date')
+    inlines = [RecurringBlockExceptionInline]
+
 
 admin.site.register(Staff)
 admin.site.register(Store)
-admin.site.register(Schedule)
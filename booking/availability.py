@@ -0,0 +1,233 @@
+"""予約枠の空き状況に関する処理。"""
+import datetime
+from calendar import Calendar, monthrange
+from collections import Counter, defaultdict
+from django.db.models import Case, Count, ExpressionWrapper, F, IntegerField, Q, Sum, Value, When
+from django.db.models.functions import Coalesce, ExtractHour, TruncDate
+from django.utils import timezone
+from . import recurrence
+from .models import DailyBookingCount, Schedule
+
+HOLIDAY_NAME = Schedule.HOLIDAY_NAME
+
+# 予約を受け付ける時間。9時から17時まで、1時間刻み
+OPEN_HOURS = range(9, 18)
+SLOTS_PER_DAY = len(OPEN_HOURS)
+
+
+def local_slot(start):
+    """予約の開始日時から、カレンダー上の(日付, 時)を返す。受付時間外ならNone"""
+    local_dt = timezone.localtime(start) if timezone.is_aware(start) else start
+    if local_dt.hour not in OPEN_HOURS:
+        return None
+    return local_dt.date(), local_dt.hour
+
+
+def day_range(date):
+    """その日の受付時間の、最初と最後の日時"""
+    start = timezone.make_aware(datetime.datetime.combine(date, datetime.time(hour=OPEN_HOURS[0])))
+    end = timezone.make_aware(datetime.datetime.combine(date, datetime.time(hour=OPEN_HOURS[-1] + 1)))
+    return start, end
+
+
+def week_calendar(staff_id, days, capacity=1):
+    """{時: {日付: 残りの席数}} の形で、指定した日のカレンダーを作る
+
+    capacityはスタッフの定員で、1つの枠の席数。残りの席数が0の枠は予約できない。
+    休暇の枠と、繰り返しの設定で受け付けない枠は、残りの席数を0にする。
+    """
+    starts = schedule_starts(Schedule.objects.filter(staff_id=staff_id), days[0], days[-1])
+    return build_calendar(days, starts, recurrence.blocked_slots(staff_id, days), capacity)
+
+
+def schedule_starts(schedules, first_date, last_date):
+    """予約のうち、first_dateからlast_dateの受付時間内に始まるものの、(開始日時, 予約者名)を取得する"""
+    return schedules.filter(
+        start__gte=day_range(first_date)[0], start__lt=day_range(last_date)[1],
+    ).values_list('start', 'name')
+
+
+def build_calendar(days, starts, blocked, capacity=1):
+    """予約の(開始日時, 予約者名)と、繰り返しの設定で受け付けない枠から、week_calendar()と同じ形のカレンダーを作る"""
+    # 9時から17時まで1時間刻み、1週間分の、値が定員のカレンダーを作る
+    calendar = {}
+    for hour in OPEN_HOURS:
+        row = {}
+        for day in days:
+            row[day] = capacity
+        calendar[hour] = row
+
+    for start, name in starts:
+        slot = local_slot(start)
+        if slot is not None and slot[0] in calendar[slot[1]]:
+            # 休暇は、席をすべて使う
+            seats = capacity if name == HOLIDAY_NAME else 1
+            calendar[slot[1]][slot[0]] = max(calendar[slot[1]][slot[0]] - seats, 0)
+
+    for day, hour in blocked:
+        if hour in calendar and day in calendar[hour]:
+            calendar[hour][day] = 0
+    return calendar
+
+
+def booked_hours(staff_id, dates):
+    """スタッフの、指定した日ごとの予約で埋まっている(予約の数が定員に達しているか、休暇の)時間を、予約テーブルから調べる"""
+    condition = Q()
+    for date in dates:
+        start, end = day_range(date)
+        condition |= Q(start__gte=start, start__lt=end)
+    counts = Counter()
+    capacity = 1
+    schedules = Schedule.objects.filter(condition, staff_id=staff_id)
+    for start, name, capacity in schedules.values_list('start', 'name', 'staff__capacity'):
+        slot = local_slot(start)
+        if slot is not None:
+            counts[slot] += capacity if name == HOLIDAY_NAME else 1
+    booked = {date: set() for date in dates}
+    for (date, hour), count in counts.items():
+        if count >= capacity:
+            booked[date].add(hour)
+    return booked
+
+
+def booked_hours_for_slots(slots):
+    """(スタッフのpk, 開始日時)のリストについて、その日に埋まっている時間を調べる
+
+    戻り値は {(スタッフのpk, 日付): {時, ...}} で、受付時間外の予約は含まない。
+    """
+    dates_by_staff = defaultdict(set)
+    for staff_id, start in slots:
+        slot = local_slot(start)
+        if slot is not None:
+            dates_by_staff[staff_id].add(slot[0])
+    return {
+        (staff_id, date): hours
+        for staff_id, dates in dates_by_staff.items()
+        for date, hours in booked_hours(staff_id, dates).items()
+    }
+
+
+def refresh_daily_counts(booked):
+    """変更があった日の集計を、booked_hours_for_slots()の結果で置き換える
+
+    1時間に複数の予約があっても埋まる枠は1つで、定員に達するまでは埋まらないので、単純な加減算ではなく、
+    変更があった日の予約だけを数え直している。
+    """
+    for (staff_id, date), hours in booked.items():
+        if hours:
+            DailyBookingCount.objects.update_or_create(staff_id=staff_id, date=date, defaults={'booked': len(hours)})
+        else:
+            DailyBookingCount.objects.filter(staff_id=staff_id, date=date).delete()
+
+
+def with_free_slots(queryset, start_date, end_date):
+    """スタッフのクエリセットに、期間中の空き枠数(free_slots)を追加する
+
+    free_slots_by_day()と同じく、繰り返しの設定で受け付けない枠も埋まっている枠として数える。
+    日ごとの集計には予約で埋まった枠しかないので、受け付けない枠のうち、まだ埋まっていないものの数をスタッフごとに引く。
+    """
+    days = (end_date - start_date).days + 1
+    booked = Sum(
+        'daily_counts__booked',
+        filter=Q(daily_counts__date__gte=start_date, daily_counts__date__lte=end_date),
+    )
+    blocked = blocked_open_slots(queryset.values('pk'), start_date, end_date)
+    if blocked:
+        schedules = Schedule.objects.filter(
+            staff_id__in=list(blocked), start__gte=day_range(start_date)[0], start__lt=day_range(end_date)[1],
+        )
+        for row in booked_slot_rows(schedules):
+            blocked[row['staff_id']].discard((row['day'], row['hour']))
+    whens = [When(pk=staff_id, then=Value(len(slots))) for staff_id, slots in blocked.items() if slots]
+    blocked_count = Case(*whens, default=Value(0), output_field=IntegerField()) if whens else Value(0)
+    return queryset.annotate(
+        free_slots=ExpressionWrapper(
+            Value(SLOTS_PER_DAY * days) - Coalesce(booked, 0) - blocked_count, output_field=IntegerField(),
+        ),
+    )
+
+
+def bookable_week():
+    """予約を受け付ける直近1週間。当日は予約できないので、翌日から7日間"""
+    today = timezone.localdate()
+    return today + datetime.timedelta(days=1), today + datetime.timedelta(days=7)
+
+
+def month_weeks(year, month):
+    """月表示のカレンダーの、日曜日始まりの週ごとの日付のリスト。前後の月の日付も含む"""
+    return Calendar(firstweekday=6).monthdatescalendar(year, month)
+
+
+def month_range(year, month):
+    """月の最初と最後の日"""
+    return datetime.date(year, month, 1), datetime.date(year, month, monthrange(year, month)[1])
+
+
+def booked_slot_rows(schedules):
+    """予約を(スタッフ, 日付, 時)ごとに集計するクエリ
+
+    1行が埋まっている(予約の数がスタッフの定員に達しているか、休暇がある)1つの枠で、受付時間外の予約は含まない。
+    """
+    return (
+        schedules
+        .filter(start__hour__gte=OPEN_HOURS[0], start__hour__lte=OPEN_HOURS[-1])
+        .annotate(day=TruncDate('start'), hour=ExtractHour('start'))
+        .values('staff_id', 'staff__capacity', 'day', 'hour')
+        .annotate(bookings=Count('id'), holidays=Count('id', filter=Q(name=HOLIDAY_NAME)))
+        .filter(Q(bookings__gte=F('staff__capacity')) | Q(holidays__gt=0))
+        .order_by()
+    )
+
+
+def date_range(first_date, last_date):
+    """first_dateからlast_dateまでの日付のリスト"""
+    return [first_date + datetime.timedelta(days=day) for day in range((last_date - first_date).days + 1)]
+
+
+def blocked_open_slots(staff_ids, first_date, last_date):
+    """期間内の、繰り返しの設定で受け付けない受付時間内の枠 {スタッフのpk: {(日付, 時), ...}} を返す"""
+    days = date_range(first_date, last_date)
+    return {
+        staff_id: {(day, hour) for day, hour in recurrence.expand(staff_blocks, days) if hour in OPEN_HOURS}
+        for staff_id, staff_blocks in recurrence.active_blocks_by_staff(staff_ids, first_date, last_date).items()
+    }
+
+
+def rebuild_daily_counts(staff_ids):
+    """スタッフの日ごとの集計を、予約テーブルから1回の集計クエリで作り直す
+
+    シグナルを送らないbulk_createで、大量の予約をまとめて作った後などに使う。
+    """
+    staff_ids = list(staff_ids)
+    counts = defaultdict(int)
+    for row in booked_slot_rows(Schedule.objects.filter(staff_id__in=staff_ids)):
+        counts[row['staff_id'], row['day']] += 1
+    DailyBookingCount.objects.filter(staff_id__in=staff_ids).delete()
+    DailyBookingCount.objects.bulk_create([
+        DailyBookingCount(staff_id=staff_id, date=date, booked=booked) for (staff_id, date), booked in counts.items()
+    ], batch_size=500)
+
+
+def free_slots_by_day(staff_ids, first_date, last_date):
+    """スタッフ全員の、期間内の日ごとの空き枠数の合計 {日付: 空き枠数} を返す
+
+    日を1日ずつ調べるのではなく、期間内の予約を(スタッフ, 日付, 時)ごとに集計する1回のクエリで、
+    埋まっている枠を求める。行数は予約の数によらず、最大でもスタッフ数×日数×1日の枠数になる。
+    繰り返しの設定で受け付けない枠も、埋まっている枠として数える。
+    """
+    staff_ids = list(staff_ids)
+    taken = defaultdict(set)
+    schedules = Schedule.objects.filter(
+        staff_id__in=staff_ids, start__gte=day_range(first_date)[0], start__lt=day_range(last_date)[1],
+    )
+    for row in booked_slot_rows(schedules):
+        taken[row['staff_id'], row['day']].add(row['hour'])
+    for staff_id, slots in blocked_open_slots(staff_ids, first_date, last_date).items():
+        for day, hour in slots:
+            taken[staff_id, day].add(hour)
+
+    days = date_range(first_date, last_date)
+    return {
+        day: SLOTS_PER_DAY * len(staff_ids) - sum(len(taken[staff_id, day]) for staff_id in staff_ids)
+        for day in days
+    }
@@ -0,0 +1,60 @@
+"""枠の定員と、予約済みの席数のカウンター。
+
+スタッフ(またはグループレッスンや複数の席を持つ店舗の枠)は、1つの枠で定員(Staff.capacity)まで予約を受け付ける。
+お客さんの予約では、予約を数えてから保存するのではなく、枠ごとのSlotCounterの行を
+「booked < 定員」の条件付きのUPDATE文で1つ増やしてから保存する。増やせなければ満席。
+UPDATE文はトランザクションの最初の文なので、同時に予約されても書き込みの順番が決まり、定員を超えることはない。
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from . import conflicts
+from .models import Schedule, SlotCounter
+
+
+def reserve(staff, start):
+    """枠の席を1つ確保する。満席ならFalse。予約を保存するのと同じトランザクションの中で呼ぶこと"""
+    counters = SlotCounter.objects.filter(staff_id=staff.pk, start=start)
+    if counters.filter(booked__lt=staff.capacity).update(booked=F('booked') + 1):
+        return True
+    if counters.exists():
+        return False
+
+    # その枠に初めて予約するときは、今ある予約の数から行を作る。
+    # 同時に作られた場合は、一意制約で後の方が失敗するので、条件付きのUPDATEからやり直す
+    booked = Schedule.objects.filter(staff_id=staff.pk, start=start).count()
+    full = booked >= staff.capacity
+    try:
+        with transaction.atomic():
+            SlotCounter.objects.create(staff_id=staff.pk, start=start, booked=booked if full else booked + 1)
+    except IntegrityError:
+        return reserve(staff, start)
+    return not full
+
+
+def save_booking(schedule):
+    """席を確保してから、重なりを確認して予約を保存する。満席や重なりがあれば、ScheduleConflictを送出する"""
+    with transaction.atomic():
+        if not reserve(schedule.staff, schedule.start):
+            raise conflicts.ScheduleConflict([], message='この時間帯は、満席です。')
+        conflicts.save_schedule(schedule)
+    return schedule
+
+
+def sync_counters(slots):
+    """予約が変わった枠の席数を、1回のUPDATE文で予約テーブルの数に合わせる
+
+    slotsは(スタッフのpk, 開始日時)のリスト。まだ行がない枠は、次に予約するときに作られる。
+    """
+    condition = Q()
+    for staff_id, start in set(slots):
+        condition |= Q(staff_id=staff_id, start=start)
+    if not condition:
+        return
+    bookings = (
+        Schedule.objects.filter(staff_id=OuterRef('staff_id'), start=OuterRef('start'))
+        .order_by().values('staff_id').annotate(count=Count('pk')).values('count')
+    )
+    SlotCounter.objects.filter(condition).update(
+        booked=Coalesce(Subquery(bookings, output_field=IntegerField()), 0),
+    )
@@ -0,0 +1,219 @@
+"""複数のワーカープロセスで、プロセス内キャッシュを正しく保つための仕組み。
+
+スタッフや店舗ごとの世代番号を、全プロセスで共有する場所(GenerationStore)に置いておく。
+データが変わったら世代番号を上げ、プロセス内のキャッシュ(LocalCache)は、作ったときの世代番号と
+今の世代番号が違えば作り直す。共有する場所には、SQLiteのファイルを使っている。
+
+カレンダーは、全プロセスで共有するキャッシュ(BOOKING_CALENDAR_CACHE)にも、世代番号をキーに含めて置いておく。
+prewarm_calendarsコマンドが前もって作っておけば、どのワーカーも最初の表示から作り直さずに済む。
+世代番号のファイルを作り直すと世代番号は0に戻るので、キーには、ファイルを作ったときに決めた乱数(epoch)も含める。
+"""
+import datetime
+import os
+import secrets
+import sqlite3
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.http import Http404
+from django.template.loader import render_to_string
+from . import metrics
+from .availability import week_calendar
+from .models import Staff
+
+
+def staff_key(pk):
+    return f'staff:{pk}'
+
+
+def store_key(pk):
+    return f'store:{pk}'
+
+
+class GenerationStore:
+    """世代番号を保存するSQLiteファイル。パスはBOOKING_COHERENCE_DBで指定する"""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _connection(self):
+        return self._open()[0]
+
+    def _open(self):
+        """(接続, epoch)を返す"""
+        # forkした子プロセスでは、親の接続を使わない
+        path = (os.getpid(), settings.BOOKING_COHERENCE_DB)
+        connections = self._local.__dict__.setdefault('connections', {})
+        if path not in connections:
+            conn = sqlite3.connect(path[1], timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS generation (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            conn.execute("INSERT OR IGNORE INTO generation (key, value) VALUES ('epoch', ?)", [secrets.randbits(62)])
+            epoch = conn.execute("SELECT value FROM generation WHERE key = 'epoch'").fetchone()[0]
+            connections[path] = (conn, epoch)
+        return connections[path]
+
+    def epoch(self):
+        """ファイルを作ったときに決めた乱数。ファイルを作り直すと変わる"""
+        return self._open()[1]
+
+    def get_many(self, keys):
+        """{キー: 世代番号} を返す。まだ一度も上げていないキーは0"""
+        keys = list(keys)
+        placeholders = ', '.join('?' * len(keys))
+        rows = self._connection().execute(f'SELECT key, value FROM generation WHERE key IN ({placeholders})', keys)
+        generations = dict.fromkeys(keys, 0)
+        generations.update(rows)
+        return generations
+
+    def bump(self, keys):
+        """世代番号を1つ上げる。他のプロセスと同時に呼ばれても、取りこぼさない"""
+        self._connection().executemany(
+            'INSERT INTO generation (key, value) VALUES (?, 1) ON CONFLICT(key) DO UPDATE SET value = value + 1',
+            [(key,) for key in keys],
+        )
+
+
+class LocalCache:
+    """プロセス内のキャッシュ。値と一緒に、作ったときの世代番号を覚えておく"""
+
+    def __init__(self, store, maxsize=1024):
+        self.store = store
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_set(self, key, generation_keys, func):
+        """キャッシュが今の世代番号で作られたものなら、それを返す。違えば、funcで作り直す"""
+        # トランザクション中は、コミットされていない(取り消されるかもしれない)データが見えるのでキャッシュしない
+        if connection.in_atomic_block:
+            metrics.cache_requests.inc(cache='local', result='bypass')
+            return func()
+
+        generations = self.store.get_many(generation_keys)
+        stamp = tuple(generations[generation_key] for generation_key in generation_keys)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] == stamp:
+                self._data.move_to_end(key)
+                metrics.cache_requests.inc(cache='local', result='hit')
+                return entry[1]
+
+        metrics.cache_requests.inc(cache='local', result='miss')
+        value = func()
+        with self._lock:
+            self._data[key] = (stamp, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+generations = GenerationStore()
+local_cache = LocalCache(generations)
+
+
+def invalidate(keys):
+    """世代番号を上げて、全プロセスのキャッシュを無効にする
+
+    トランザクション中なら、コミット後にもう一度上げる。コミット前に他のプロセスが
+    古いデータで作り直したキャッシュも、これで無効になる。
+    """
+    keys = list(keys)
+    if not keys:
+        return
+    generations.bump(keys)
+    if connection.in_atomic_block:
+        transaction.on_commit(lambda: generations.bump(keys))
+
+
+def cached_staff(pk):
+    """店舗と一緒に、スタッフを取得する。なければHttp404
+
+    店舗が変わったときも、その店舗のスタッフの世代番号が上がる(signals.py)。
+    """
+    def get_staff():
+        staff = Staff.objects.select_related('store').filter(pk=pk).first()
+        if staff is None:
+            raise Http404
+        return staff
+
+    return local_cache.get_or_set(('staff', pk), [staff_key(pk)], get_staff)
+
+
+def shared_cache():
+    return caches[settings.BOOKING_CALENDAR_CACHE]
+
+
+def shared_key(staff_id, name, generation):
+    """共有キャッシュのキー。世代番号が上がるか、世代番号のファイルを作り直せば、古いキャッシュは使われなくなる"""
+    return f'booking:{generations.epoch()}:{name}:{staff_id}:{generation}'
+
+
+def shared_get_or_set(staff_id, name, func):
+    """共有キャッシュにあればそれを返し、なければfuncで作って置いておく"""
+    if connection.in_atomic_block:
+        metrics.cache_requests.inc(cache='shared', result='bypass')
+        return func()
+
+    # 作り始める前に世代番号を読んでおく。作っている間に予約が変われば、そのキャッシュは使われない
+    key = shared_key(staff_id, name, generations.get_many([staff_key(staff_id)])[staff_key(staff_id)])
+    value = shared_cache().get(key)
+    if value is not None:
+        metrics.cache_requests.inc(cache='shared', result='hit')
+        return value
+    metrics.cache_requests.inc(cache='shared', result='miss')
+    value = func()
+    shared_cache().set(key, value)
+    return value
+
+
+def week_calendar_name(days):
+    return f'week_calendar:{days[0].isoformat()}:{len(days)}'
+
+
+def calendar_table_name(days, today):
+    return f'calendar_table:{days[0].isoformat()}:{len(days)}:{today.isoformat()}'
+
+
+def calendar_table_context(staff, days, today, calendar):
+    return {
+        'staff': staff,
+        'days': days,
+        'calendar': calendar,
+        'today': today,
+        'before': days[0] - datetime.timedelta(days=7),
+        'next': days[-1] + datetime.timedelta(days=1),
+        'public_holidays': settings.PUBLIC_HOLIDAYS,
+    }
+
+
+def render_calendar_table(staff, days, today, calendar):
+    return render_to_string('booking/calendar_table.html', calendar_table_context(staff, days, today, calendar))
+
+
+def cached_week_calendar(staff_id, days, capacity=1):
+    """availability.week_calendar()の結果を、スタッフの世代番号が変わるまでキャッシュする
+
+    定員が変わったときも、スタッフの世代番号が上がる(signals.py)。
+    キャッシュした値は他のリクエストと共有しているので、変更しないこと。
+    """
+    return local_cache.get_or_set(
+        ('week_calendar', staff_id, days[0], len(days)),
+        [staff_key(staff_id)],
+        lambda: shared_get_or_set(staff_id, week_calendar_name(days), lambda: week_calendar(staff_id, days, capacity)),
+    )
+
+
+def cached_calendar_table(staff, days, today, calendar):
+    """お客さん向けカレンダーの表のHTMLを、スタッフの世代番号と今日の日付が変わるまで、共有キャッシュに置いておく"""
+    return shared_get_or_set(
+        staff.pk, calendar_table_name(days, today), lambda: render_calendar_table(staff, days, today, calendar)
+    )
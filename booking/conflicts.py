@@ -0,0 +1,166 @@
+"""予約の重なりのチェック。
+
+予約を書き込む処理(お客さんの予約、マイページでの編集、休暇の追加、管理サイト、まとめての操作)は、
+すべてここを通して、書き込みと同じトランザクションの中で重なりを確認する。
+開始日時が同じか、時間帯が少しでも重なれば重なりとみなす。終了と開始がちょうど同じ(隣り合う)予約は重ならない。
+ただし、開始と終了がまったく同じ予約は、スタッフの定員(Staff.capacity)までは重ならないものとする。
+休暇は枠の席をすべて使うので、開始と終了が同じでも、他の予約と重なる。
+繰り返しの設定(recurrence.py)で予約を受け付けない時間も、その時間の予約と同じように重なりとみなす。
+"""
+from collections import defaultdict
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import Q
+from . import recurrence
+from .models import Schedule, Staff
+
+
+class ScheduleConflict(ValidationError):
+    """重なる予約がある。繰り返しの設定で受け付けない時間と重なる場合は、codeが'blocked'"""
+
+    def __init__(self, conflicts, message='この時間帯には、既に別の予約があります。', code='conflict'):
+        self.conflicts = conflicts
+        super().__init__(message, code=code)
+
+
+def raise_if_blocked(schedules):
+    """繰り返しの設定で受け付けない時間と重なる予約があれば、ScheduleConflictを送出する"""
+    blocked = recurrence.find_blocked(schedules)
+    if blocked:
+        raise ScheduleConflict(blocked, message='この時間帯は、予約を受け付けていません。', code='blocked')
+
+
+def intervals_overlap(start1, end1, start2, end2):
+    return start1 == start2 or (start1 < end2 and start2 < end1)
+
+
+def overlapping(staff_id, start, end, exclude_pk=None):
+    """スタッフの予約のうち、startからendの間に重なるものを1回のクエリで探す"""
+    queryset = Schedule.objects.filter(Q(start__lt=end, end__gt=start) | Q(start=start), staff_id=staff_id)
+    if exclude_pk is not None:
+        queryset = queryset.exclude(pk=exclude_pk)
+    return queryset
+
+
+def lock_staff(staff_ids):
+    """同じスタッフへの書き込みを順番に行うため、スタッフの行をロックする
+
+    SELECT ... FOR UPDATE がないSQLiteでは、書き込み自体が順番に行われるので何もしない。
+    """
+    if connection.features.has_select_for_update:
+        list(Staff.objects.select_for_update().filter(pk__in=staff_ids).order_by('pk').values_list('pk', flat=True))
+
+
+def staff_capacity(staff_id):
+    return Staff.objects.filter(pk=staff_id).values_list('capacity', flat=True).first() or 1
+
+
+def shares_slot(schedule, other):
+    """開始と終了が同じで、どちらも休暇でなければ、定員まで同じ枠に入れる"""
+    return (schedule.start, schedule.end) == (other.start, other.end) and not schedule.is_holiday and not other.is_holiday
+
+
+def find_conflicts(schedule, limit=10):
+    """scheduleと重なる予約を、最大limit件返す"""
+    queryset = overlapping(schedule.staff_id, schedule.start, schedule.end, exclude_pk=schedule.pk)
+    conflicts = list(queryset[:limit])
+
+    def all_same():
+        return all(shares_slot(schedule, other) for other in conflicts)
+
+    # 開始と終了が同じ予約だけなら、定員に空きがあるかを調べる。定員を調べるクエリは、この場合だけ
+    if conflicts and all_same():
+        capacity = staff_capacity(schedule.staff_id)
+        if len(conflicts) == limit:
+            conflicts = list(queryset[:capacity + limit])
+        if all_same() and len(conflicts) < capacity:
+            return []
+    return conflicts[:limit]
+
+
+def check_schedule(schedule):
+    """scheduleと重なる予約があれば、ScheduleConflictを送出する。トランザクションの中で呼ぶこと"""
+    lock_staff([schedule.staff_id])
+    conflicts = find_conflicts(schedule)
+    if conflicts:
+        raise ScheduleConflict(conflicts)
+    raise_if_blocked([schedule])
+
+
+def save_schedule(schedule):
+    """重なりを確認してから、予約を保存する"""
+    with transaction.atomic():
+        check_schedule(schedule)
+        schedule.save()
+    return schedule
+
+
+def find_batch_conflicts(schedules):
+    """まとめて書き込む予約について、重なる予約の組を返す
+
+    スタッフごとに、期間内の既存の予約を1回のクエリで取得し、新しい予約と一緒に開始日時順に並べて、
+    先頭から順に重なりを調べる。重なりがある予約は、少なくとも1つの組として必ず返す。
+    既存の予約同士の重なりは返さない。開始と終了が同じ予約は、まとめて定員と比べる。
+    """
+    by_staff = defaultdict(list)
+    for schedule in schedules:
+        by_staff[schedule.staff_id].append(schedule)
+
+    conflicts = []
+    for staff_id, new_schedules in by_staff.items():
+        start = min(schedule.start for schedule in new_schedules)
+        end = max(schedule.end for schedule in new_schedules)
+        new_pks = [schedule.pk for schedule in new_schedules if schedule.pk is not None]
+        # 端がちょうど接している予約も含めて取得する。重ならない予約が混ざっても、並べて調べれば結果は同じ
+        existing = list(
+            Schedule.objects.filter(staff_id=staff_id, start__lte=end, end__gte=start).exclude(pk__in=new_pks)
+        )
+        new_ids = {id(schedule) for schedule in new_schedules}
+
+        # 開始と終了が同じ予約は1つにまとめ、新しい予約を含んで定員を超える場合(休暇を含めば2件以上)だけ、
+        # まとめた予約同士を重なりとする。まとめた予約の代表には、新しい予約があればそれを使う。
+        # 代表が他の予約と重なれば、まとめた新しい予約もすべて重なる
+        groups = defaultdict(list)
+        for schedule in sorted(existing + new_schedules, key=lambda schedule: id(schedule) not in new_ids):
+            groups[schedule.start, schedule.end].append(schedule)
+        shared = any(
+            len(group) > 1 and id(group[0]) in new_ids and not any(schedule.is_holiday for schedule in group)
+            for group in groups.values()
+        )
+        capacity = staff_capacity(staff_id) if shared else 1
+        grouped = {}
+        for group in groups.values():
+            grouped[id(group[0])] = [schedule for schedule in group[1:] if id(schedule) in new_ids]
+            seats = 1 if any(schedule.is_holiday for schedule in group) else capacity
+            if len(group) > seats and id(group[0]) in new_ids:
+                conflicts += [(group[1], group[0])] + [(group[0], schedule) for schedule in grouped[id(group[0])]]
+        intervals = sorted((group[0] for group in groups.values()), key=lambda schedule: (schedule.start, schedule.end))
+
+        # 新しい予約は、それより前に始まるすべての予約と比べる。既存の予約は、前に始まる新しい予約とだけ比べる。
+        # 比べる相手は、一番遅く終わる予約と、直前の(開始日時が同じかもしれない)予約だけでよい
+        latest = {True: None, False: None}
+        previous = {True: None, False: None}
+        for schedule in intervals:
+            is_new = id(schedule) in new_ids
+            candidates = [latest[True], previous[True]]
+            if is_new:
+                candidates += [latest[False], previous[False]]
+            for other in candidates:
+                if other is not None and intervals_overlap(other.start, other.end, schedule.start, schedule.end):
+                    conflicts.append((other, schedule))
+                    conflicts += [(other, grouped_schedule) for grouped_schedule in grouped[id(schedule)]]
+                    conflicts += [(schedule, grouped_schedule) for grouped_schedule in grouped[id(other)]]
+                    break
+            if latest[is_new] is None or schedule.end > latest[is_new].end:
+                latest[is_new] = schedule
+            previous[is_new] = schedule
+    return conflicts
+
+
+def check_schedules(schedules):
+    """まとめて書き込む予約に重なりがあれば、ScheduleConflictを送出する。トランザクションの中で呼ぶこと"""
+    lock_staff({schedule.staff_id for schedule in schedules})
+    conflicts = find_batch_conflicts(schedules)
+    if conflicts:
+        raise ScheduleConflict(conflicts)
+    raise_if_blocked(schedules)
@@ -0,0 +1,74 @@
+"""マイページでの、1日分の予約のまとめての操作。
+
+予約を1件ずつ保存・削除するとシグナルも1件ずつ送られるので、ここではトランザクションの中で
+1回のUPDATE/DELETE/bulk_createで変更し、集計などへの反映(signals.schedules_changed)もまとめて1回で行う。
+削除では、QuerySet.delete()が送るシグナルをsignals.batched_changes()でまとめる。
+"""
+import datetime
+from django.db import transaction
+from . import availability, conflicts, metrics, recurrence
+from .models import Schedule
+from .signals import batched_changes, schedules_changed
+
+HOLIDAY_NAME = Schedule.HOLIDAY_NAME
+
+
+def day_schedules(staff_id, date):
+    """スタッフの、その日の受付時間内に始まる予約"""
+    start, end = availability.day_range(date)
+    return Schedule.objects.filter(staff_id=staff_id, start__gte=start, start__lt=end)
+
+
+def clear_day(staff_id, date):
+    """その日の予約をすべて削除する。削除した件数を返す"""
+    with transaction.atomic():
+        conflicts.lock_staff([staff_id])
+        with batched_changes():
+            _, deleted = day_schedules(staff_id, date).delete()
+    return deleted.get(Schedule._meta.label, 0)
+
+
+def close_day(staff_id, date):
+    """その日の空いている時間を、すべて休暇にする。追加した件数を返す"""
+    with transaction.atomic():
+        conflicts.lock_staff([staff_id])
+        start, end = availability.day_range(date)
+        taken = set(recurrence.blocked_slots(staff_id, [date]))
+        for schedule_start, schedule_end in conflicts.overlapping(staff_id, start, end).values_list('start', 'end'):
+            taken.update(recurrence.schedule_slots(schedule_start, schedule_end))
+
+        holidays = []
+        for hour in availability.OPEN_HOURS:
+            if (date, hour) not in taken:
+                holiday_start = start.replace(hour=hour)
+                holidays.append(Schedule(
+                    staff_id=staff_id, start=holiday_start, end=holiday_start + datetime.timedelta(hours=1), name=HOLIDAY_NAME,
+                ))
+        if not holidays:
+            return 0
+        conflicts.check_schedules(holidays)
+        Schedule.objects.bulk_create(holidays)
+        schedules_changed([], [(staff_id, holiday.start) for holiday in holidays])
+    metrics.holidays_added.inc(len(holidays))
+    return len(holidays)
+
+
+def move_day(staff_id, date, to_staff_id):
+    """その日の予約(休暇は除く)を、すべて別のスタッフに移す。移した件数を返す
+
+    移動先に重なる予約があれば、何も移さずにconflicts.ScheduleConflictを送出する。
+    """
+    with transaction.atomic():
+        conflicts.lock_staff([staff_id, to_staff_id])
+        schedules = list(day_schedules(staff_id, date).exclude(name=HOLIDAY_NAME))
+        if not schedules:
+            return 0
+        for schedule in schedules:
+            schedule.staff_id = to_staff_id
+        conflicts.check_schedules(schedules)
+        Schedule.objects.filter(pk__in=[schedule.pk for schedule in schedules]).update(staff_id=to_staff_id)
+        schedules_changed(
+            [(staff_id, schedule.start) for schedule in schedules],
+            [(to_staff_id, schedule.start) for schedule in schedules],
+        )
+    return len(schedules)
@@ -0,0 +1,131 @@
+"""予約カレンダーの変更の記録と配信。
+
+予約が変わると、変わった枠(スタッフ, 日付, 時)をScheduleChangeテーブルに記録する(アウトボックス)。
+カレンダーを開いているブラウザは、Server-Sent Eventsかロングポーリングで、前回より後の変更だけを受け取る。
+また、変更のたびにスタッフのcalendar_versionを上げておき、端末が最後に見たバージョンからの差分だけを返せるようにしている。
+配信する変更には、送る時点での枠の残りの席数(remaining)も含める。定員や休暇、繰り返しの設定は記録にないので、
+ブラウザは予約の有無ではなく、残りの席数で表示を決める。
+"""
+import json
+import time
+from django.conf import settings
+from django.db.models import F
+from .availability import local_slot, week_calendar
+from .models import ScheduleChange, Staff
+
+
+def record_changes(slots, booked):
+    """変更があった枠を、予約の有無と一緒に記録する
+
+    slotsは変更があった(スタッフのpk, 開始日時)のリストで、bookedはそれを
+    availability.booked_hours_for_slots()に渡した結果。
+    """
+    cells = set()
+    for staff_id, start in slots:
+        slot = local_slot(start)
+        if slot is not None:
+            cells.add((staff_id, *slot))
+
+    # 1回の変更ごとに、スタッフのカレンダーのバージョンを1つ上げる
+    versions = {}
+    for staff_id in {cell[0] for cell in cells}:
+        Staff.objects.filter(pk=staff_id).update(calendar_version=F('calendar_version') + 1)
+        versions[staff_id] = Staff.objects.filter(pk=staff_id).values_list('calendar_version', flat=True).first()
+
+    ScheduleChange.objects.bulk_create([
+        ScheduleChange(
+            staff_id=staff_id, date=date, hour=hour, booked=hour in booked[staff_id, date], version=versions[staff_id]
+        )
+        for staff_id, date, hour in sorted(cells)
+        if versions[staff_id] is not None  # スタッフごと削除されている場合
+    ])
+
+
+def latest_change_id(staff_id):
+    """スタッフの最新の変更のid。まだ変更がなければ0"""
+    change = ScheduleChange.objects.filter(staff_id=staff_id).order_by('-id').values_list('id', flat=True).first()
+    return change or 0
+
+
+def fetch_changes(staff_id, last_id, limit=100):
+    """last_idより後の変更を、古い順に返す"""
+    return list(ScheduleChange.objects.filter(staff_id=staff_id, id__gt=last_id).order_by('id')[:limit])
+
+
+def change_to_dict(change, remaining=0):
+    return {
+        'id': change.id,
+        'staff': change.staff_id,
+        'date': change.date.isoformat(),
+        'hour': change.hour,
+        'booked': change.booked,
+        'remaining': remaining,
+    }
+
+
+def changes_to_dicts(staff_id, changes):
+    """変更のリストを、枠の今の残りの席数と一緒に辞書のリストにする。休暇や受け付けない時間、満席の枠は0"""
+    if not changes:
+        return []
+    capacity = Staff.objects.filter(pk=staff_id).values_list('capacity', flat=True).first() or 0
+    calendar = week_calendar(staff_id, sorted({change.date for change in changes}), capacity)
+    return [change_to_dict(change, calendar[change.hour][change.date]) for change in changes]
+
+
+def stream_changes(staff_id, last_id):
+    """Server-Sent Events形式で、変更を配信し続けるジェネレータ
+
+    ワーカーを占有し続けないよう、BOOKING_EVENTS_STREAM_SECONDS秒で終了する。
+    ブラウザのEventSourceは、Last-Event-IDヘッダ付きで自動的に再接続してくる。
+    """
+    deadline = time.monotonic() + settings.BOOKING_EVENTS_STREAM_SECONDS
+    yield 'retry: 3000\n\n'
+    while time.monotonic() < deadline:
+        changes = fetch_changes(staff_id, last_id)
+        for change in changes_to_dicts(staff_id, changes):
+            last_id = change['id']
+            yield f'id: {last_id}\ndata: {json.dumps(change)}\n\n'
+        if not changes:
+            # 接続が切れていないかを確かめるためにも、何もなければコメント行を送る
+            yield ': keepalive\n\n'
+            time.sleep(settings.BOOKING_EVENTS_POLL_INTERVAL)
+
+
+def wait_for_changes(staff_id, last_id, timeout):
+    """ロングポーリング用。変更があるか、timeout秒たつまで待って、変更のリストを返す"""
+    deadline = time.monotonic() + timeout
+    while True:
+        changes = fetch_changes(staff_id, last_id)
+        if changes or time.monotonic() >= deadline:
+            return changes
+        time.sleep(settings.BOOKING_EVENTS_POLL_INTERVAL)
+
+
+def changes_since(staff_id, since, version, start_date, end_date):
+    """バージョンsinceから、現在のバージョンversionまでに変わった、期間内の枠を返す
+
+    {(日付, 時): 予約あり} の辞書を返す。変更が多すぎる場合や、古い履歴が削除済みで
+    差分を作れない場合はNoneを返すので、呼び出し側はカレンダー全体を送り直す。
+    繰り返しの設定や定員の変更のように、変わった枠を記録せずにバージョンだけを上げた場合も、
+    そのバージョンの記録がないので差分は作れない。
+    """
+    if since == version:
+        return {}
+    if since > version:
+        return None
+    changes = list(
+        ScheduleChange.objects.filter(staff_id=staff_id, version__gt=since, version__lte=version)
+        .order_by('id')
+        .values_list('version', 'date', 'hour', 'booked')[:settings.BOOKING_DELTA_MAX_CHANGES + 1]
+    )
+    if len(changes) > settings.BOOKING_DELTA_MAX_CHANGES:
+        return None
+    # sinceの次から今のバージョンまで、抜けなく記録があるときだけ差分にできる
+    if len({change[0] for change in changes}) != version - since:
+        return None
+    return {(date, hour): booked for _, date, hour, booked in changes if start_date <= date <= end_date}
+
+
+def prune_changes(before, batch_size=1000):
+    """before より前の変更履歴を削除する"""
+    return ScheduleChange.objects.filter(created_at__lt=before).delete_in_batches(batch_size)
@@ -0,0 +1,69 @@
+"""テストやベンチマーク用に、ユーザー・店舗・スタッフ・予約をまとめて作る関数。
+
+1行ずつ保存する代わりにbulk_createで作るので、TestCase.setUpTestData()で大量のデータを用意できる。
+bulk_createではシグナルが送られないので、日ごとの集計や検索用のインデックスは、ここでまとめて作る。
+"""
+import datetime
+import random
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.utils import timezone
+from . import availability, search
+from .models import Schedule, Staff, Store
+
+User = get_user_model()
+
+BATCH_SIZE = 500
+PASSWORD = 'helloworld123'
+
+
+def _bulk_create(model, objects):
+    """bulk_createして、作った行を返す(SQLiteのbulk_createはpkを返さないので、作った後に取得し直す)"""
+    last = model.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    model.objects.bulk_create(objects, batch_size=BATCH_SIZE)
+    return list(model.objects.filter(pk__gt=last).order_by('pk'))
+
+
+def create_users(count, prefix='user', password=PASSWORD):
+    """ユーザーを作る。パスワードのハッシュは1回だけ計算して、全員で使い回す"""
+    password = make_password(password)
+    return _bulk_create(User, [User(username=f'{prefix}{i}', password=password) for i in range(count)])
+
+
+def create_stores(count, prefix='店舗'):
+    stores = _bulk_create(Store, [Store(name=f'{prefix}{i}') for i in range(count)])
+    search.index_objects(Store, stores)
+    return stores
+
+
+def create_staff(stores, per_store, prefix='スタッフ'):
+    """店舗ごとにper_store人のスタッフを、それぞれ別のログインユーザーで作る"""
+    users = iter(create_users(len(stores) * per_store, prefix=f'{prefix}-user'))
+    staff_list = _bulk_create(Staff, [
+        Staff(name=f'{prefix}{store.pk}-{i}', store=store, user=next(users))
+        for store in stores for i in range(per_store)
+    ])
+    search.index_objects(Staff, staff_list)
+    return staff_list
+
+
+def create_schedules(staff_list, first_date, days, fill=0.5, seed=0, name='予約'):
+    """first_dateからdays日分の受付時間の枠に、fillの割合で1時間の予約を入れる。作った件数を返す
+
+    予約はbulk_createで作るので、シグナルの代わりに日ごとの集計をまとめて作り直す。
+    カレンダーの変更履歴(ScheduleChange)は作らない。
+    """
+    rng = random.Random(seed)
+    schedules = []
+    for staff in staff_list:
+        for day in range(days):
+            date = first_date + datetime.timedelta(days=day)
+            for hour in availability.OPEN_HOURS:
+                if rng.random() < fill:
+                    start = timezone.make_aware(datetime.datetime.combine(date, datetime.time(hour)))
+                    schedules.append(Schedule(
+                        staff_id=staff.pk, start=start, end=start + datetime.timedelta(hours=1), name=name,
+                    ))
+    Schedule.objects.bulk_create(schedules, batch_size=BATCH_SIZE)
+    availability.rebuild_daily_counts([staff.pk for staff in staff_list])
+    return len(schedules)
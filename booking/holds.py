@@ -0,0 +1,82 @@
+"""予約枠の仮押さえ。
+
+予約ページを開いたお客さんのセッションで、(スタッフ, 開始日時)の枠の1席をBOOKING_HOLD_SECONDS秒だけ押さえておく。
+押さえている間は、他のお客さんのカレンダーでは、その分だけ残りの席数が減って表示される。
+予約済みの席と有効な仮押さえの合計が定員に達するまで、複数のセッションが同じ枠を押さえられる。
+"""
+import datetime
+from collections import Counter
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from . import conflicts
+from .availability import day_range, local_slot
+from .models import Schedule, SlotHold
+
+
+def booked_seats(staff_id, start, capacity):
+    """枠の、予約済みの席数。休暇があれば、すべての席(capacity)が埋まっている"""
+    names = list(Schedule.objects.filter(staff_id=staff_id, start=start).values_list('name', flat=True))
+    return capacity if Schedule.HOLIDAY_NAME in names else len(names)
+
+
+def active_holds(staff_id, start, now=None):
+    return SlotHold.objects.filter(staff_id=staff_id, start=start, expires_at__gt=now or timezone.now())
+
+
+def acquire(staff_id, start, session_key, capacity=1):
+    """枠の席を1つ仮押さえする。予約済みの席と他のセッションの仮押さえで定員に達していればFalse
+
+    自分の仮押さえなら期限を延ばし、この枠の期限切れの仮押さえは削除する。押さえられたら、
+    同じセッションが押さえていた他の枠は解除する(1つのセッションで押さえるのは1席だけ)。
+    """
+    now = timezone.now()
+    expires_at = now + datetime.timedelta(seconds=settings.BOOKING_HOLD_SECONDS)
+    with transaction.atomic():
+        # 先に自分の仮押さえを書き込んでから数えるので、同時に押さえても定員を超えない
+        conflicts.lock_staff([staff_id])
+        SlotHold.objects.filter(staff_id=staff_id, start=start, expires_at__lte=now).delete()
+        updated = SlotHold.objects.filter(
+            staff_id=staff_id, start=start, session_key=session_key,
+        ).update(expires_at=expires_at)
+        if not updated:
+            try:
+                with transaction.atomic():
+                    SlotHold.objects.create(staff_id=staff_id, start=start, session_key=session_key, expires_at=expires_at)
+            except IntegrityError:
+                # 同じセッションが同時に押さえた
+                pass
+        if booked_seats(staff_id, start, capacity) + active_holds(staff_id, start, now).count() > capacity:
+            transaction.set_rollback(True)
+            return False
+    SlotHold.objects.filter(session_key=session_key).exclude(staff_id=staff_id, start=start).delete()
+    return True
+
+
+def is_held_by_other(staff_id, start, session_key, capacity=1):
+    """他のセッションの有効な仮押さえで、残りの席が埋まっているか"""
+    held = active_holds(staff_id, start).exclude(session_key=session_key).count()
+    return held > 0 and booked_seats(staff_id, start, capacity) + held >= capacity
+
+
+def release(staff_id, start, session_key):
+    """自分の仮押さえを解除する"""
+    SlotHold.objects.filter(staff_id=staff_id, start=start, session_key=session_key).delete()
+
+
+def held_slots(staff_id, days, session_key=None):
+    """指定した日のうち、他のセッションが仮押さえしている席の数 {(日付, 時): 席数}"""
+    holds = SlotHold.objects.filter(
+        staff_id=staff_id,
+        start__gte=day_range(days[0])[0],
+        start__lt=day_range(days[-1])[1],
+        expires_at__gt=timezone.now(),
+    )
+    if session_key:
+        holds = holds.exclude(session_key=session_key)
+    return Counter(slot for slot in map(local_slot, holds.values_list('start', flat=True)) if slot is not None)
+
+
+def sweep_expired(batch_size=1000):
+    """期限切れの仮押さえを、batch_size件ずつ削除する。削除した件数を返す"""
+    return SlotHold.objects.filter(expires_at__lte=timezone.now()).delete_in_batches(batch_size)
@@ -0,0 +1,56 @@
+"""予約の二重送信の対策。
+
+予約ページのフォームに埋め込んだキー(またはIdempotency-Keyヘッダ)ごとに、最初の予約の結果を記録しておく。
+同じキーでもう一度送信されたら、予約テーブルには触れずに、記録した結果を返す。
+キーは最初に送信したURL(スタッフと枠)に結び付け、別のURLに同じキーで送信された場合は、結果を返さずに拒否する。
+"""
+import datetime
+import re
+import uuid
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from .models import IdempotencyKey
+
+KEY_PATTERN = re.compile(r'[A-Za-z0-9_-]{8,64}')
+
+
+def new_key():
+    return uuid.uuid4().hex
+
+
+def request_key(request):
+    """リクエストのキー。ヘッダを優先し、なければフォームの値を使う。正しい形式でなければNone"""
+    key = request.META.get('HTTP_IDEMPOTENCY_KEY') or request.POST.get('idempotency_key', '')
+    return key if KEY_PATTERN.fullmatch(key) else None
+
+
+def lookup(key):
+    """期限内のキーの記録を返す。なければNone"""
+    return IdempotencyKey.objects.filter(key=key, expires_at__gt=timezone.now()).first()
+
+
+def claim(key, path):
+    """キーをpathへの送信に使い始める。他のリクエストが先に使っていれば、その記録を(None, 記録)で返す
+
+    記録はこの後の予約と同じトランザクションの中で作り、結果と一緒にコミットする。
+    まだ削除されていない期限切れの記録は、使われていないものとして置き換える。
+    """
+    now = timezone.now()
+    expires_at = now + datetime.timedelta(seconds=settings.BOOKING_IDEMPOTENCY_SECONDS)
+    try:
+        with transaction.atomic():
+            IdempotencyKey.objects.filter(key=key, expires_at__lte=now).delete()
+            return IdempotencyKey.objects.create(key=key, path=path, expires_at=expires_at), None
+    except IntegrityError:
+        return None, lookup(key)
+
+
+def matches(record, path):
+    """記録が、pathへの送信のものか"""
+    return record.path == path
+
+
+def expire(batch_size=1000):
+    """期限切れのキーを、batch_size件ずつ削除する。削除した件数を返す"""
+    return IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).delete_in_batches(batch_size)
@@ -0,0 +1,61 @@
+import datetime
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from booking import factories, holds
+from booking.availability import OPEN_HOURS, week_calendar
+from booking.models import SlotHold
+
+
+class Command(BaseCommand):
+    help = '仮押さえの削除と、仮押さえを考慮したカレンダー作成の速さを計測します。データはすべてロールバックされます'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--holds', type=int, default=100000, help='作成する仮押さえの数(半分は期限切れ)')
+        parser.add_argument('--staff', type=int, default=100, help='仮押さえを分散させるスタッフの数')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=100, help='カレンダー作成を繰り返す回数')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.benchmark(options)
+            transaction.set_rollback(True)
+
+    def benchmark(self, options):
+        store = factories.create_stores(1, prefix='ベンチマーク店舗')[0]
+        staff_ids = [staff.pk for staff in factories.create_staff([store], options['staff'], prefix='benchmark-holds')]
+
+        # 受付時間の枠に、期限切れと有効な仮押さえを交互に作る
+        now = timezone.now()
+        today = timezone.localdate()
+        slots = [
+            timezone.make_aware(datetime.datetime.combine(today + datetime.timedelta(days=day), datetime.time(hour=hour)))
+            for day in range(1, 366) for hour in OPEN_HOURS
+        ]
+        SlotHold.objects.bulk_create([
+            SlotHold(
+                staff_id=staff_ids[i % len(staff_ids)],
+                start=slots[i // len(staff_ids) % len(slots)],
+                session_key=f'benchmark{i}',
+                expires_at=now + datetime.timedelta(minutes=-5 if i % 2 else 5),
+            )
+            for i in range(options['holds'])
+        ], batch_size=500, ignore_conflicts=True)
+        total = SlotHold.objects.filter(staff__store=store).count()
+        self.stdout.write(f'仮押さえ: {total}件, スタッフ: {len(staff_ids)}人')
+
+        days = [today + datetime.timedelta(days=day) for day in range(1, 8)]
+        started = time.perf_counter()
+        for i in range(options['repeat']):
+            staff_id = staff_ids[i % len(staff_ids)]
+            week_calendar(staff_id, days)
+            holds.held_slots(staff_id, days)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'仮押さえを考慮したカレンダー: {elapsed / options["repeat"] * 1000:.3f}ms/回')
+
+        started = time.perf_counter()
+        deleted = holds.sweep_expired(options['batch_size'])
+        elapsed = time.perf_counter() - started
+        rate = deleted / elapsed if elapsed else 0
+        self.stdout.write(f'期限切れの削除: {deleted}件 {elapsed * 1000:.1f}ms ({rate:.0f}件/秒)')
@@ -0,0 +1,19 @@
+import time
+from django.core.management.base import BaseCommand
+from booking.waitlist import dispatch
+
+
+class Command(BaseCommand):
+    help = '枠が空いた空き待ちの人に、まとめてメールで知らせます'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--interval', type=float, default=0, help='指定すると、この秒数ごとに送り続けます')
+
+    def handle(self, *args, **options):
+        while True:
+            sent = dispatch(options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f'{sent}件の空きを知らせました'))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
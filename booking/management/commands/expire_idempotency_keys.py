@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from booking.idempotency import expire
+
+
+class Command(BaseCommand):
+    help = '期限切れの、予約の二重送信対策のキー(IdempotencyKey)を削除します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        deleted = expire(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{deleted}件のキーを削除しました'))
@@ -0,0 +1,22 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from booking.prewarm import prewarm
+
+
+class Command(BaseCommand):
+    help = '全スタッフの、今日から数週間分のカレンダーを前もって作り、共有キャッシュに置いておきます'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--weeks', type=int, default=settings.BOOKING_PREWARM_WEEKS, help='何週間分作るか')
+        parser.add_argument('--processes', type=int, default=None, help='並列に作るプロセス数。省略するとCPUの数')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        results = prewarm(options['weeks'], options['processes'])
+        for store_id, count, seconds in results:
+            self.stdout.write(f'store={store_id} カレンダー{count}件 {seconds:.3f}秒')
+        total = sum(count for _, count, _ in results)
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(results)}店舗、{total}件のカレンダーを{time.monotonic() - started:.3f}秒で作りました'
+        ))
@@ -0,0 +1,33 @@
+import os
+import pstats
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from booking.profiling import profile_files
+
+
+class Command(BaseCommand):
+    help = 'SamplingProfilerMiddlewareの計測結果から、URL名ごとに時間のかかっている関数を表示します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('views', nargs='*', help='表示するURL名(例: booking:calendar)。省略すると全て')
+        parser.add_argument('--limit', type=int, default=20, help='URL名ごとに表示する関数の数')
+        parser.add_argument('--sort', default='cumulative', help='並び順(cumulative, tottime, calls など)')
+
+    def handle(self, *args, **options):
+        root = settings.BOOKING_PROFILE_DIR
+        if not os.path.isdir(root):
+            self.stdout.write('計測結果がありません')
+            return
+
+        names = sorted(os.listdir(root))
+        if options['views']:
+            wanted = {view.replace(':', '.') for view in options['views']}
+            names = [name for name in names if name in wanted]
+        for name in names:
+            directory = os.path.join(root, name)
+            files = profile_files(directory)
+            if not files:
+                continue
+            stats = pstats.Stats(*[os.path.join(directory, file) for file in files], stream=self.stdout)
+            self.stdout.write(self.style.MIGRATE_HEADING(f'{name.replace(".", ":")} ({len(files)}ファイル)'))
+            stats.strip_dirs().sort_stats(options['sort']).print_stats(options['limit'])
@@ -0,0 +1,17 @@
+import datetime
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from booking.events import prune_changes
+
+
+class Command(BaseCommand):
+    help = 'カレンダー配信用の、古い変更履歴(ScheduleChange)を削除します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24, help='これより古い変更履歴を削除します(時間)')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        before = timezone.now() - datetime.timedelta(hours=options['hours'])
+        deleted = prune_changes(before, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{deleted}件の変更履歴を削除しました'))
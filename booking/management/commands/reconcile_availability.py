@@ -0,0 +1,51 @@
+from collections import Counter, defaultdict
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from booking.availability import local_slot
+from booking.models import DailyBookingCount, Schedule
+
+
+class Command(BaseCommand):
+    help = '日ごとの予約枠の集計(DailyBookingCount)が、予約データと一致しているか確認します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='ずれている集計を修正します')
+
+    def handle(self, *args, **options):
+        # 枠ごとに予約を数え、スタッフの定員に達している枠を、埋まっている枠として数える。休暇は席をすべて使う
+        bookings = Counter()
+        capacities = {}
+        schedules = Schedule.objects.values_list('staff_id', 'staff__capacity', 'start', 'name')
+        for staff_id, capacity, start, name in schedules.iterator():
+            slot = local_slot(start)
+            if slot is not None:
+                bookings[(staff_id, *slot)] += capacity if name == Schedule.HOLIDAY_NAME else 1
+                capacities[staff_id] = capacity
+        expected = defaultdict(int)
+        for (staff_id, date, hour), count in bookings.items():
+            if count >= capacities[staff_id]:
+                expected[staff_id, date] += 1
+        actual = {
+            (staff_id, date): count
+            for staff_id, date, count in DailyBookingCount.objects.values_list('staff_id', 'date', 'booked').iterator()
+        }
+
+        mismatches = sorted(key for key in expected.keys() | actual.keys() if expected.get(key, 0) != actual.get(key, 0))
+        for staff_id, date in mismatches:
+            self.stdout.write(
+                f'staff={staff_id} date={date} 集計={actual.get((staff_id, date), 0)} 実際={expected.get((staff_id, date), 0)}'
+            )
+
+        if mismatches and options['fix']:
+            with transaction.atomic():
+                for staff_id, date in mismatches:
+                    count = expected.get((staff_id, date), 0)
+                    if count:
+                        DailyBookingCount.objects.update_or_create(staff_id=staff_id, date=date, defaults={'booked': count})
+                    else:
+                        DailyBookingCount.objects.filter(staff_id=staff_id, date=date).delete()
+            self.stdout.write(self.style.SUCCESS(f'{len(mismatches)}件の集計を修正しました'))
+        elif mismatches:
+            self.stdout.write(self.style.WARNING(f'{len(mismatches)}件の集計がずれています'))
+        else:
+            self.stdout.write(self.style.SUCCESS('集計は一致しています'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from booking.holds import sweep_expired
+
+
+class Command(BaseCommand):
+    help = '期限切れの予約枠の仮押さえ(SlotHold)を削除します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        deleted = sweep_expired(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{deleted}件の仮押さえを削除しました'))
@@ -0,0 +1,268 @@
+"""Prometheusのテキスト形式で出力する、アプリケーションの計測値。
+
+計測値はプロセス内に持ち、値を増やすときは計測値ごとのロックを短時間取るだけにしている。
+BOOKING_METRICS_DIRを指定すると、各プロセスがBOOKING_METRICS_FLUSH_SECONDS秒ごとに
+自分の計測値を <pid>.json として書き出し、/metrics ではそれらを合計して返す。
+指定しなければ、/metrics を処理したプロセスの計測値だけを返す。
+
+ワーカーが入れ替わってもファイルが増え続けないよう、/metrics では、終了したプロセスのファイルを
+dead.json に合計してから削除する(prometheus_clientのmark_process_deadに当たる処理)。
+合計し直している間に読まないよう、ファイルロックを使うので、fcntlがない環境(Windows)では削除しない。
+"""
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# 終了したプロセスの計測値を合計したファイル
+DEAD_SNAPSHOT_NAME = 'dead.json'
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    @staticmethod
+    def merge(total, value):
+        return (total or 0) + value
+
+    def samples(self, key, value):
+        yield self.name, self.labelnames, key, value
+
+
+class Histogram:
+    """バケットごとの件数と、合計・件数を持つ。件数はバケットごとに持ち、出力するときに累積する"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        # 最後の要素は、どのバケットにも入らない(+Inf)件数
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), list(counts)] for key, counts in self._values.items()]
+
+    @staticmethod
+    def merge(total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    def samples(self, key, value):
+        counts, total = value[:-1], value[-1]
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            yield f'{self.name}_bucket', self.labelnames + ('le',), key + (str(bound),), cumulative
+        yield f'{self.name}_sum', self.labelnames, key, total
+        yield f'{self.name}_count', self.labelnames, key, cumulative
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+        self._next_flush = 0
+        self._exit_handler = False
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def snapshot_path(self):
+        return os.path.join(settings.BOOKING_METRICS_DIR, f'{os.getpid()}.json')
+
+    def flush(self):
+        """このプロセスの計測値をファイルに書き出す"""
+        os.makedirs(settings.BOOKING_METRICS_DIR, exist_ok=True)
+        write_json(self.snapshot_path(), self.snapshot())
+        if not self._exit_handler:
+            # 最後の書き出しからプロセスの終了までに増えた分も残す
+            self._exit_handler = True
+            atexit.register(self.flush_at_exit)
+
+    def flush_at_exit(self):
+        if settings.BOOKING_METRICS_DIR:
+            self.flush()
+
+    def maybe_flush(self):
+        """前回の書き出しからBOOKING_METRICS_FLUSH_SECONDS秒たっていれば、書き出す"""
+        if not settings.BOOKING_METRICS_DIR:
+            return
+        now = time.monotonic()
+        if now >= self._next_flush:
+            self._next_flush = now + settings.BOOKING_METRICS_FLUSH_SECONDS
+            self.flush()
+
+    @contextmanager
+    def lock(self, exclusive):
+        """BOOKING_METRICS_DIRのファイルロック。終了したプロセスのファイルを合計し直すときだけ、排他にする"""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(settings.BOOKING_METRICS_DIR, 'metrics.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def read_snapshots(self, names):
+        snapshots = []
+        for name in names:
+            try:
+                with open(os.path.join(settings.BOOKING_METRICS_DIR, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def remove_dead(self):
+        """終了したプロセスのファイルを、dead.jsonに合計してから削除する。削除したファイルの数を返す"""
+        if fcntl is None:
+            return 0
+        dead = [
+            name for name in os.listdir(settings.BOOKING_METRICS_DIR)
+            if name.endswith('.json') and name[:-5].isdigit() and not pid_exists(int(name[:-5]))
+        ]
+        if not dead:
+            return 0
+        with self.lock(exclusive=True):
+            # 他のプロセスが先に合計して削除したファイルは、読めないので数えない
+            snapshots = self.read_snapshots([DEAD_SNAPSHOT_NAME] + dead)
+            merged = self.merge(snapshots)
+            write_json(os.path.join(settings.BOOKING_METRICS_DIR, DEAD_SNAPSHOT_NAME), {
+                name: [[list(key), value] for key, value in values.items()] for name, values in merged.items()
+            })
+            for name in dead:
+                try:
+                    os.remove(os.path.join(settings.BOOKING_METRICS_DIR, name))
+                except FileNotFoundError:
+                    continue
+        return len(dead)
+
+    def collect(self):
+        """全プロセスの計測値を合計した、{名前: {ラベルの値: 値}} を返す"""
+        if settings.BOOKING_METRICS_DIR:
+            self.flush()
+            self.remove_dead()
+            with self.lock(exclusive=False):
+                names = [name for name in os.listdir(settings.BOOKING_METRICS_DIR) if name.endswith('.json')]
+                snapshots = self.read_snapshots(names)
+        else:
+            snapshots = [self.snapshot()]
+        return self.merge(snapshots)
+
+    def merge(self, snapshots):
+        """snapshot()の形の計測値を合計した、{名前: {ラベルの値: 値}} を返す"""
+        merged = {name: {} for name in self.metrics}
+        for snapshot in snapshots:
+            for name, values in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None:
+                    continue
+                for key, value in values:
+                    key = tuple(key)
+                    merged[name][key] = metric.merge(merged[name].get(key), value)
+        return merged
+
+    def render(self):
+        """Prometheusのテキスト形式にする"""
+        lines = []
+        for name, values in self.collect().items():
+            metric = self.metrics[name]
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.type}')
+            for key, value in sorted(values.items()):
+                for sample_name, labelnames, labelvalues, sample in metric.samples(key, value):
+                    lines.append(f'{sample_name}{format_labels(labelnames, labelvalues)} {format_value(sample)}')
+        return '\n'.join(lines) + '\n'
+
+
+def write_json(path, value):
+    """書きかけのファイルを読まれないよう、一時ファイルに書いてから置き換える"""
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(value, f)
+    os.replace(f'{path}.tmp', path)
+
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+registry = Registry()
+
+request_duration = registry.register(Histogram(
+    'booking_request_duration_seconds', 'リクエストの処理時間', ['view'],
+))
+request_sql_duration = registry.register(Histogram(
+    'booking_request_sql_duration_seconds', '1リクエストあたりのSQLの実行時間', ['view'],
+))
+cache_requests = registry.register(Counter(
+    'booking_cache_requests_total', 'キャッシュ(local, shared)の参照回数(hit, miss, トランザクション中で使わなかったbypass)',
+    ['cache', 'result'],
+))
+bookings = registry.register(Counter(
+    'booking_bookings_total', 'お客さんの予約の結果(success, conflict, held, 二重送信のreplayed)', ['result'],
+))
+holidays_added = registry.register(Counter(
+    'booking_holidays_added_total', 'マイページから休暇を追加した回数',
+))
@@ -0,0 +1,70 @@
+import cProfile
+import random
+import time
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from . import metrics
+from .profiling import collector
+
+
+class SamplingProfilerMiddleware:
+    """BOOKING_PROFILE_RATEの割合のリクエストを、cProfileで計測する
+
+    割合が0なら、起動時にミドルウェア自体を外すので、計測しないときの負荷はない。
+    """
+
+    def __init__(self, get_response):
+        if settings.BOOKING_PROFILE_RATE <= 0:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.rate = settings.BOOKING_PROFILE_RATE
+
+    def __call__(self, request):
+        if random.random() >= self.rate:
+            return self.get_response(request)
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # 同じスレッドで、既に他のプロファイラが動いている
+            return self.get_response(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            profile.disable()
+
+        match = request.resolver_match
+        collector.add(match.view_name if match else 'unresolved', profile)
+        return response
+
+
+class MetricsMiddleware:
+    """URL名ごとに、リクエストの処理時間とSQLの実行時間を計測する(metrics.py)"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        sql_duration = 0
+
+        def measure_sql(execute, sql, params, many, context):
+            nonlocal sql_duration
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                sql_duration += time.perf_counter() - start
+
+        start = time.perf_counter()
+        with connection.execute_wrapper(measure_sql):
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        metrics.request_duration.observe(duration, view=view)
+        metrics.request_sql_duration.observe(sql_duration, view=view)
+        metrics.registry.maybe_flush()
+        return response
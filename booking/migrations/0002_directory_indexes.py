@@ -0,0 +1,51 @@
+# Generated by Django 2.2.13 on 2026-10-19 15:02
+
+import sqlite3
+
+from django.db import migrations, models
+
+
+def create_fts_tables(apps, schema_editor):
+    """店名・スタッフ名の全文検索用に、SQLiteのFTS5テーブルを作る。
+
+    trigramトークナイザ(SQLite 3.34以降)がない環境では何もせず、検索はLIKEで行う。
+    """
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite' or sqlite3.sqlite_version_info < (3, 34, 0):
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA compile_options')
+        if 'ENABLE_FTS5' not in {row[0] for row in cursor.fetchall()}:
+            return
+        for table in ('booking_store', 'booking_staff'):
+            cursor.execute(f"CREATE VIRTUAL TABLE {table}_fts USING fts5(name, tokenize='trigram')")
+            cursor.execute(f'INSERT INTO {table}_fts(rowid, name) SELECT id, name FROM {table}')
+
+
+def drop_fts_tables(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for table in ('booking_store', 'booking_staff'):
+            cursor.execute(f'DROP TABLE IF EXISTS {table}_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='store',
+            name='name',
+            field=models.CharField(db_index=True, max_length=255, verbose_name='店名'),
+        ),
+        migrations.AddIndex(
+            model_name='staff',
+            index=models.Index(fields=['store', 'name'], name='staff_store_name_idx'),
+        ),
+        migrations.RunPython(create_fts_tables, drop_fts_tables),
+    ]
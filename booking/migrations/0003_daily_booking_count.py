@@ -0,0 +1,46 @@
+# Generated by Django 2.2.13 on 2026-10-19 15:04
+
+from collections import defaultdict
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+
+def count_existing_schedules(apps, schema_editor):
+    """既存の予約から、日ごとの埋まっている枠数を作る"""
+    Schedule = apps.get_model('booking', 'Schedule')
+    DailyBookingCount = apps.get_model('booking', 'DailyBookingCount')
+    booked = defaultdict(set)
+    for staff_id, start in Schedule.objects.values_list('staff_id', 'start').iterator():
+        local_dt = timezone.localtime(start)
+        if 9 <= local_dt.hour <= 17:
+            booked[staff_id, local_dt.date()].add(local_dt.hour)
+    DailyBookingCount.objects.bulk_create([
+        DailyBookingCount(staff_id=staff_id, date=date, booked=len(hours))
+        for (staff_id, date), hours in booked.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0002_directory_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyBookingCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='日付')),
+                ('booked', models.PositiveSmallIntegerField(default=0, verbose_name='予約済みの枠数')),
+                ('staff', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_counts', to='booking.Staff', verbose_name='スタッフ')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='dailybookingcount',
+            constraint=models.UniqueConstraint(fields=('staff', 'date'), name='unique_daily_booking_count'),
+        ),
+        migrations.RunPython(count_existing_schedules, migrations.RunPython.noop),
+    ]
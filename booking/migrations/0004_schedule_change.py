@@ -0,0 +1,29 @@
+# Generated by Django 2.2.13 on 2026-10-19 15:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0003_daily_booking_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduleChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='日付')),
+                ('hour', models.PositiveSmallIntegerField(verbose_name='時')),
+                ('booked', models.BooleanField(verbose_name='予約あり')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='記録日時')),
+                ('staff', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='booking.Staff', verbose_name='スタッフ')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='schedulechange',
+            index=models.Index(fields=['staff', 'id'], name='schedule_change_staff_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.13 on 2026-10-19 15:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0004_schedule_change'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schedulechange',
+            name='version',
+            field=models.PositiveIntegerField(default=0, verbose_name='カレンダーのバージョン'),
+        ),
+        migrations.AddField(
+            model_name='staff',
+            name='calendar_version',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='カレンダーのバージョン'),
+        ),
+        migrations.AddIndex(
+            model_name='schedulechange',
+            index=models.Index(fields=['staff', 'version'], name='schedule_change_version_idx'),
+        ),
+    ]
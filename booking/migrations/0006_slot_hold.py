@@ -0,0 +1,28 @@
+# Generated by Django 2.2.13 on 2026-10-19 15:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0005_calendar_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlotHold',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField(verbose_name='開始時間')),
+                ('session_key', models.CharField(max_length=40, verbose_name='セッションキー')),
+                ('expires_at', models.DateTimeField(db_index=True, verbose_name='期限')),
+                ('staff', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='booking.Staff', verbose_name='スタッフ')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='slothold',
+            constraint=models.UniqueConstraint(fields=('staff', 'start'), name='unique_slot_hold'),
+        ),
+    ]
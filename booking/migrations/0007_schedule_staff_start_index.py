@@ -0,0 +1,17 @@
+# Generated by Django 2.2.13 on 2026-10-19 15:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0006_slot_hold'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['staff', 'start', 'end'], name='schedule_staff_start_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 2.2.13 on 2026-10-19 15:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0007_schedule_staff_start_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecurringBlock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(default='休み', max_length=255, verbose_name='名前')),
+                ('weekday', models.PositiveSmallIntegerField(blank=True, choices=[(0, '月'), (1, '火'), (2, '水'), (3, '木'), (4, '金'), (5, '土'), (6, '日')], null=True, verbose_name='曜日')),
+                ('start_hour', models.PositiveSmallIntegerField(verbose_name='開始時')),
+                ('end_hour', models.PositiveSmallIntegerField(help_text='この時は含みません', verbose_name='終了時')),
+                ('start_date', models.DateField(blank=True, null=True, verbose_name='適用開始日')),
+                ('end_date', models.DateField(blank=True, null=True, verbose_name='適用終了日')),
+                ('staff', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recurring_blocks', to='booking.Staff', verbose_name='スタッフ')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RecurringBlockException',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='日付')),
+                ('block', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='exceptions', to='booking.RecurringBlock', verbose_name='繰り返しの設定')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='recurringblockexception',
+            constraint=models.UniqueConstraint(fields=('block', 'date'), name='unique_recurring_block_exception'),
+        ),
+    ]
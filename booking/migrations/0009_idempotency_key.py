@@ -0,0 +1,23 @@
+# Generated by Django 2.2.13 on 2026-10-19 15:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0008_recurring_block'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True, verbose_name='キー')),
+                ('outcome', models.CharField(blank=True, choices=[('success', '予約完了'), ('conflict', '入れ違い'), ('held', '手続き中')], max_length=10, verbose_name='結果')),
+                ('location', models.CharField(blank=True, max_length=255, verbose_name='リダイレクト先')),
+                ('expires_at', models.DateTimeField(db_index=True, verbose_name='期限')),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.13 on 2026-10-19 15:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0009_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WaitlistEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField(verbose_name='開始時間')),
+                ('name', models.CharField(max_length=255, verbose_name='お名前')),
+                ('email', models.EmailField(max_length=254, verbose_name='メールアドレス')),
+                ('status', models.CharField(choices=[('waiting', '空き待ち'), ('pending', '通知待ち'), ('notified', '通知済み')], db_index=True, default='waiting', max_length=10, verbose_name='状態')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='登録日時')),
+                ('notified_at', models.DateTimeField(blank=True, null=True, verbose_name='通知日時')),
+                ('staff', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='booking.Staff', verbose_name='スタッフ')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='waitlistentry',
+            index=models.Index(fields=['staff', 'start', 'created_at'], name='waitlist_slot_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='waitlistentry',
+            constraint=models.UniqueConstraint(fields=('staff', 'start', 'email'), name='unique_waitlist_entry'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.13 on 2026-10-19 15:35
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0010_waitlist_entry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='staff',
+            name='capacity',
+            field=models.PositiveSmallIntegerField(default=1, help_text='1つの枠で、同時に受け付ける予約の数', validators=[django.core.validators.MinValueValidator(1)], verbose_name='定員'),
+        ),
+        migrations.CreateModel(
+            name='SlotCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField(verbose_name='開始時間')),
+                ('booked', models.PositiveSmallIntegerField(default=0, verbose_name='予約済みの席数')),
+                ('staff', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='booking.Staff', verbose_name='スタッフ')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='slotcounter',
+            constraint=models.UniqueConstraint(fields=('staff', 'start'), name='unique_slot_counter'),
+        ),
+    ]
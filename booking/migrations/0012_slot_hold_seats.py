@@ -0,0 +1,21 @@
+# Generated by Django 2.2.13 on 2026-10-19 15:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0011_capacity'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='slothold',
+            name='unique_slot_hold',
+        ),
+        migrations.AddConstraint(
+            model_name='slothold',
+            constraint=models.UniqueConstraint(fields=('staff', 'start', 'session_key'), name='unique_slot_hold'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-19 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0012_slot_hold_seats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='idempotencykey',
+            name='path',
+            field=models.CharField(blank=True, max_length=255, verbose_name='送信先のパス'),
+        ),
+    ]
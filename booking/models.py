@@ -1,11 +1,25 @@
 from django.conf import settings
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.core.validators import MinValueValidator
+from django.db import models, transaction
 from django.utils import timezone
 
 
+class BatchDeleteQuerySet(models.QuerySet):
+
+    def delete_in_batches(self, batch_size=1000):
+        """大量の行を、書き込みロックを長く持たないよう、batch_size件ずつ削除する。削除した件数を返す"""
+        deleted = 0
+        while True:
+            pks = list(self.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return deleted
+            deleted += self.model._default_manager.filter(pk__in=pks).delete()[0]
+
+
 class Store(models.Model):
     """店舗"""
-    name = models.CharField('店名', max_length=255)
+    name = models.CharField('店名', max_length=255, db_index=True)
 
     def __str__(self):
         return self.name
@@ -18,24 +32,247 @@ class Staff(models.Model):
         settings.AUTH_USER_MODEL, verbose_name='ログインユーザー', on_delete=models.CASCADE
     )
     store = models.ForeignKey(Store, verbose_name='店舗', on_delete=models.CASCADE)
+    capacity = models.PositiveSmallIntegerField(
+        '定員', default=1, validators=[MinValueValidator(1)], help_text='1つの枠で、同時に受け付ける予約の数',
+    )
+    calendar_version = models.PositiveIntegerField('カレンダーのバージョン', default=0, editable=False)
 
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=['user', 'store'], name='unique_staff'),
         ]
+        indexes = [
+            models.Index(fields=['store', 'name'], name='staff_store_name_idx'),
+        ]
 
     def __str__(self):
         return f'{self.store.name} - {self.name}'
 
+    def save(self, *args, **kwargs):
+        # calendar_versionは予約の変更時にUPDATE文で上げているので、古い値で上書きしないようにする
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'calendar_version'
+            ]
+        super().save(*args, **kwargs)
+
 
 class Schedule(models.Model):
     """予約スケジュール."""
+    # マイページから休暇にしたときの、予約者名。休暇は、スタッフの定員に関わらず枠の席をすべて使う
+    HOLIDAY_NAME = '休暇(システムによる追加)'
+
     start = models.DateTimeField('開始時間')
     end = models.DateTimeField('終了時間')
     name = models.CharField('予約者名', max_length=255)
     staff = models.ForeignKey('Staff', verbose_name='スタッフ', on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [
+            # 予約の重なりのチェック(conflicts.py)や、カレンダーの表示で使う
+            models.Index(fields=['staff', 'start', 'end'], name='schedule_staff_start_idx'),
+        ]
+
     def __str__(self):
         start = timezone.localtime(self.start).strftime('%Y/%m/%d %H:%M:%S')
         end = timezone.localtime(self.end).strftime('%Y/%m/%d %H:%M:%S')
         return f'{self.name} {start} ~ {end} {self.staff}'
+
+    @property
+    def is_holiday(self):
+        return self.name == self.HOLIDAY_NAME
+
+    def save(self, *args, **kwargs):
+        # 予約と、signals.pyで行う集計などの更新を、同じトランザクションで保存する
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+
+
+class SlotCounter(models.Model):
+    """枠(スタッフ, 開始日時)ごとの、予約済みの席の数.
+
+    お客さんの予約では、booked < 定員 の条件付きでこの行を1つ増やしてから予約を保存する(capacity.py)。
+    予約を数えてから保存するのと違い、同時に予約されても定員を超えない。
+    予約が変わると、signals.pyで予約テーブルの数に合わせ直される。行は、その枠に初めて予約するときに作る。
+    """
+    staff = models.ForeignKey('Staff', verbose_name='スタッフ', on_delete=models.CASCADE, related_name='+')
+    start = models.DateTimeField('開始時間')
+    booked = models.PositiveSmallIntegerField('予約済みの席数', default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['staff', 'start'], name='unique_slot_counter'),
+        ]
+
+    def __str__(self):
+        start = timezone.localtime(self.start).strftime('%Y/%m/%d %H:%M:%S')
+        return f'{self.staff_id} {start} {self.booked}'
+
+
+class DailyBookingCount(models.Model):
+    """スタッフごと・日ごとの、予約で埋まっている(満席の)枠の数.
+
+    Scheduleの保存・削除のたびに、変更があった日の分だけ更新される(availability.py)。
+    空き枠の数は、1日の枠数からこの値を引いて求める。予約がない日の行は作らない。
+    """
+    staff = models.ForeignKey(
+        'Staff', verbose_name='スタッフ', on_delete=models.CASCADE, related_name='daily_counts'
+    )
+    date = models.DateField('日付')
+    booked = models.PositiveSmallIntegerField('予約済みの枠数', default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['staff', 'date'], name='unique_daily_booking_count'),
+        ]
+
+    def __str__(self):
+        return f'{self.staff} {self.date} {self.booked}'
+
+
+class ScheduleChange(models.Model):
+    """予約カレンダーの枠の変更履歴(アウトボックス).
+
+    予約の保存・削除と同じトランザクションで記録され、カレンダーを開いているブラウザへ配信される(events.py)。
+    versionは、その変更で上がったStaff.calendar_versionで、差分カレンダーの作成に使う。
+    """
+    # 履歴なので、スタッフが削除されても残しておく(古いものはprune_schedule_changesで削除する)
+    staff = models.ForeignKey(
+        'Staff', verbose_name='スタッフ', on_delete=models.DO_NOTHING, db_constraint=False, related_name='+'
+    )
+    date = models.DateField('日付')
+    hour = models.PositiveSmallIntegerField('時')
+    booked = models.BooleanField('予約あり')
+    version = models.PositiveIntegerField('カレンダーのバージョン', default=0)
+    created_at = models.DateTimeField('記録日時', auto_now_add=True, db_index=True)
+
+    objects = BatchDeleteQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['staff', 'id'], name='schedule_change_staff_idx'),
+            models.Index(fields=['staff', 'version'], name='schedule_change_version_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.staff_id} {self.date} {self.hour}時 {"×" if self.booked else "○"}'
+
+
+class SlotHold(models.Model):
+    """予約ページを開いている間の、予約枠の席の仮押さえ.
+
+    1つのセッションが押さえるのは1つの枠の1席だけで、定員が2以上の枠は、複数のセッションが押さえられる。
+    期限(expires_at)を過ぎたものは無効で、sweep_slot_holdsコマンドでまとめて削除する。
+    """
+    staff = models.ForeignKey('Staff', verbose_name='スタッフ', on_delete=models.CASCADE, related_name='+')
+    start = models.DateTimeField('開始時間')
+    session_key = models.CharField('セッションキー', max_length=40)
+    expires_at = models.DateTimeField('期限', db_index=True)
+
+    objects = BatchDeleteQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['staff', 'start', 'session_key'], name='unique_slot_hold'),
+        ]
+
+    def __str__(self):
+        start = timezone.localtime(self.start).strftime('%Y/%m/%d %H:%M:%S')
+        return f'{self.staff_id} {start}'
+
+
+class RecurringBlock(models.Model):
+    """毎週・毎日の決まった時間に、予約を受け付けない設定(定休日や昼休みなど).
+
+    予約のように1時間ごとの行を作らず、表示や予約の確認のたびに、必要な期間の分だけ展開する(recurrence.py)。
+    曜日を指定しなければ毎日、期間を指定しなければずっと有効。
+    """
+    WEEKDAY_CHOICES = [(0, '月'), (1, '火'), (2, '水'), (3, '木'), (4, '金'), (5, '土'), (6, '日')]
+
+    staff = models.ForeignKey(
+        'Staff', verbose_name='スタッフ', on_delete=models.CASCADE, related_name='recurring_blocks'
+    )
+    name = models.CharField('名前', max_length=255, default='休み')
+    weekday = models.PositiveSmallIntegerField('曜日', choices=WEEKDAY_CHOICES, null=True, blank=True)
+    start_hour = models.PositiveSmallIntegerField('開始時')
+    end_hour = models.PositiveSmallIntegerField('終了時', help_text='この時は含みません')
+    start_date = models.DateField('適用開始日', null=True, blank=True)
+    end_date = models.DateField('適用終了日', null=True, blank=True)
+
+    def clean(self):
+        if self.start_hour is not None and self.end_hour is not None and not self.start_hour < self.end_hour <= 24:
+            raise ValidationError('開始時は終了時より前に、終了時は24以下にしてください。')
+        if self.start_date and self.end_date and self.start_date > self.end_date:
+            raise ValidationError('適用開始日は、適用終了日より前にしてください。')
+
+    def __str__(self):
+        weekday = '毎日' if self.weekday is None else f'毎週{self.get_weekday_display()}曜日'
+        return f'{self.staff_id} {self.name} {weekday} {self.start_hour}時~{self.end_hour}時'
+
+
+class RecurringBlockException(models.Model):
+    """繰り返しの設定を、その日だけ適用しない日"""
+    block = models.ForeignKey(
+        'RecurringBlock', verbose_name='繰り返しの設定', on_delete=models.CASCADE, related_name='exceptions'
+    )
+    date = models.DateField('日付')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['block', 'date'], name='unique_recurring_block_exception'),
+        ]
+
+    def __str__(self):
+        return f'{self.block} {self.date}'
+
+
+class IdempotencyKey(models.Model):
+    """二重送信された予約に、最初の結果をそのまま返すためのキー.
+
+    キーは最初に送信されたURL(path)にだけ使え、期限(expires_at)を過ぎたものは無効。
+    期限切れのものは、expire_idempotency_keysコマンドでまとめて削除する。
+    """
+    OUTCOME_CHOICES = [('success', '予約完了'), ('conflict', '入れ違い'), ('held', '手続き中')]
+
+    key = models.CharField('キー', max_length=64, unique=True)
+    path = models.CharField('送信先のパス', max_length=255, blank=True)
+    outcome = models.CharField('結果', max_length=10, choices=OUTCOME_CHOICES, blank=True)
+    location = models.CharField('リダイレクト先', max_length=255, blank=True)
+    expires_at = models.DateTimeField('期限', db_index=True)
+
+    objects = BatchDeleteQuerySet.as_manager()
+
+    def __str__(self):
+        return f'{self.key} {self.outcome}'
+
+
+class WaitlistEntry(models.Model):
+    """予約で埋まっている枠の、空き待ちの登録.
+
+    枠が空くと、先に登録した人から1人ずつ通知待ち(pending)になり、dispatch_waitlistコマンドがメールで知らせる。
+    """
+    WAITING = 'waiting'
+    PENDING = 'pending'
+    NOTIFIED = 'notified'
+    STATUS_CHOICES = [(WAITING, '空き待ち'), (PENDING, '通知待ち'), (NOTIFIED, '通知済み')]
+
+    staff = models.ForeignKey('Staff', verbose_name='スタッフ', on_delete=models.CASCADE, related_name='+')
+    start = models.DateTimeField('開始時間')
+    name = models.CharField('お名前', max_length=255)
+    email = models.EmailField('メールアドレス')
+    status = models.CharField('状態', max_length=10, choices=STATUS_CHOICES, default=WAITING, db_index=True)
+    created_at = models.DateTimeField('登録日時', auto_now_add=True)
+    notified_at = models.DateTimeField('通知日時', null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['staff', 'start', 'email'], name='unique_waitlist_entry'),
+        ]
+        indexes = [
+            models.Index(fields=['staff', 'start', 'created_at'], name='waitlist_slot_idx'),
+        ]
+
+    def __str__(self):
+        start = timezone.localtime(self.start).strftime('%Y/%m/%d %H:%M:%S')
+        return f'{self.staff_id} {start} {self.name} {self.get_status_display()}'
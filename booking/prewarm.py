@@ -0,0 +1,99 @@
+"""カレンダーの事前作成。
+
+お客さん向けカレンダーの、今日から数週間分の空き状況と表のHTMLを、共有キャッシュに前もって作っておく。
+予約は店舗ごとに1回のクエリでまとめて取得し、店舗ごとにプロセスを分けて並列に作る。
+並列に作るのはforkできる環境だけで、Windowsなどでは、このプロセスだけで作る。
+「-」で表示される日は今日の日付で変わるので、日付が変わった直後に実行するとよい。
+"""
+import datetime
+import multiprocessing
+import threading
+import time
+from django.conf import settings
+from django.db import connections
+from . import availability, coherence, recurrence
+from .models import Schedule, Staff, Store
+
+
+def week_starts(today, weeks):
+    """StaffCalendarの「次週」で表示される、各週の最初の日"""
+    return [today + datetime.timedelta(days=7 * week) for week in range(weeks)]
+
+
+def prewarm_store(store_id, today, weeks):
+    """店舗のスタッフ全員の、weeks週分のカレンダーを共有キャッシュに置く。(店舗のpk, 作った数, 秒数)を返す"""
+    started = time.monotonic()
+    staff_list = list(Staff.objects.select_related('store').filter(store_id=store_id))
+    if not staff_list:
+        return store_id, 0, time.monotonic() - started
+
+    # 世代番号は予約を読む前に取得する。読んだ後に予約が変われば、作ったキャッシュは使われない
+    staff_keys = {staff.pk: coherence.staff_key(staff.pk) for staff in staff_list}
+    generations = coherence.generations.get_many(staff_keys.values())
+
+    first_date = today
+    last_date = today + datetime.timedelta(days=7 * weeks - 1)
+    starts = {staff.pk: [] for staff in staff_list}
+    schedules = Schedule.objects.filter(staff__store_id=store_id)
+    for staff_id, start, name in availability.schedule_starts(schedules, first_date, last_date).values_list(
+        'staff_id', 'start', 'name',
+    ):
+        starts[staff_id].append((start, name))
+    blocks = recurrence.active_blocks_by_staff(list(starts), first_date, last_date)
+
+    values = {}
+    for staff in staff_list:
+        generation = generations[staff_keys[staff.pk]]
+        for first_day in week_starts(today, weeks):
+            days = [first_day + datetime.timedelta(days=day) for day in range(7)]
+            calendar = availability.build_calendar(
+                days, starts[staff.pk], recurrence.expand(blocks.get(staff.pk, []), days), staff.capacity,
+            )
+            values[coherence.shared_key(staff.pk, coherence.week_calendar_name(days), generation)] = calendar
+            values[coherence.shared_key(staff.pk, coherence.calendar_table_name(days, today), generation)] = (
+                coherence.render_calendar_table(staff, days, today, calendar)
+            )
+    coherence.shared_cache().set_many(values)
+    return store_id, len(values) // 2, time.monotonic() - started
+
+
+def _close_connections():
+    # 親プロセスのデータベース接続を、子プロセスで使わない
+    connections.close_all()
+
+
+def pool_context():
+    """並列に作るためのmultiprocessingのコンテキスト。forkできない環境ではNone
+
+    spawnで起動した子プロセスではDjangoの設定が読み込まれていないので、forkだけを使う。
+    """
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    return multiprocessing.get_context('fork')
+
+
+def prewarm(weeks, processes=None, today=None):
+    """全店舗のカレンダーを作る。processesが1か、forkできない環境なら、このプロセスだけで作る"""
+    today = today or datetime.date.today()
+    store_ids = list(Store.objects.values_list('pk', flat=True))
+    context = pool_context()
+    if processes == 1 or len(store_ids) <= 1 or context is None:
+        return [prewarm_store(store_id, today, weeks) for store_id in store_ids]
+
+    _close_connections()
+    with context.Pool(processes, initializer=_close_connections) as pool:
+        return pool.starmap(prewarm_store, [(store_id, today, weeks) for store_id in store_ids])
+
+
+def prewarm_in_background():
+    """BOOKING_PREWARM_ON_STARTUPがTrueなら、起動時にバックグラウンドでカレンダーを作る(wsgi.py)"""
+    if not settings.BOOKING_PREWARM_ON_STARTUP:
+        return
+
+    def run():
+        try:
+            prewarm(settings.BOOKING_PREWARM_WEEKS, processes=1)
+        finally:
+            connections.close_all()
+
+    threading.Thread(target=run, name='booking-prewarm', daemon=True).start()
@@ -0,0 +1,63 @@
+"""本番環境で、一部のリクエストだけをcProfileで計測する仕組み。
+
+計測結果はURL名(booking:calendar など)ごとにプロセス内で集計し、BOOKING_PROFILE_FLUSH_EVERY回ごとに
+BOOKING_PROFILE_DIR/<URL名>/ へpstats形式のファイルとして書き出す。ファイルはURL名ごとに
+BOOKING_PROFILE_KEEP個まで残し、古いものから削除する。集計結果は profile_report コマンドで表示する。
+"""
+import os
+import pstats
+import threading
+import time
+from django.conf import settings
+
+
+def view_directory(view_name):
+    """URL名ごとの保存先。ファイル名に使えない「:」は「.」にする"""
+    return os.path.join(settings.BOOKING_PROFILE_DIR, view_name.replace(':', '.'))
+
+
+class ProfileCollector:
+    """URL名ごとに、計測結果をまとめておく"""
+
+    def __init__(self):
+        self._stats = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, view_name, profile):
+        with self._lock:
+            stats = self._stats.get(view_name)
+            if stats is None:
+                self._stats[view_name] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            self._counts[view_name] = self._counts.get(view_name, 0) + 1
+            if self._counts[view_name] < settings.BOOKING_PROFILE_FLUSH_EVERY:
+                return
+            stats = self._stats.pop(view_name)
+            del self._counts[view_name]
+        self.write(view_name, stats)
+
+    def write(self, view_name, stats):
+        directory = view_directory(view_name)
+        os.makedirs(directory, exist_ok=True)
+        stats.dump_stats(os.path.join(directory, f'{time.time():.6f}-{os.getpid()}.prof'))
+        rotate(directory, settings.BOOKING_PROFILE_KEEP)
+
+
+def rotate(directory, keep):
+    """ディレクトリ内の計測結果を、新しいものからkeep個だけ残す"""
+    for name in profile_files(directory)[:-keep or None]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            # 他のプロセスが先に削除した
+            pass
+
+
+def profile_files(directory):
+    """ディレクトリ内の計測結果のファイル名を、古い順に返す"""
+    return sorted(name for name in os.listdir(directory) if name.endswith('.prof'))
+
+
+collector = ProfileCollector()
@@ -0,0 +1,91 @@
+"""繰り返しの設定(RecurringBlock)の展開。
+
+定休日や昼休みは、1時間ごとの予約の行を作る代わりに、曜日・時間・期間・除外日だけを保存しておき、
+カレンダーの表示や予約の確認のときに、必要な日の分だけ(日付, 時)に展開する。
+展開した枠は、その時間に1時間の予約(休暇)を入れた場合と同じように扱う。
+"""
+import datetime
+from collections import defaultdict
+from django.db.models import Prefetch, Q
+from django.utils import timezone
+from .models import RecurringBlock, RecurringBlockException
+
+
+def active_blocks(staff_id, first_date, last_date):
+    """スタッフの設定のうち、期間内に有効なものを、期間内の除外日と一緒に取得する"""
+    return active_blocks_by_staff([staff_id], first_date, last_date).get(staff_id, [])
+
+
+def active_blocks_by_staff(staff_ids, first_date, last_date):
+    """複数のスタッフについてまとめてactive_blocks()を行い、{スタッフのpk: [設定, ...]} を返す"""
+    exceptions = RecurringBlockException.objects.filter(date__gte=first_date, date__lte=last_date)
+    blocks = (
+        RecurringBlock.objects.filter(staff_id__in=staff_ids)
+        .filter(Q(start_date__isnull=True) | Q(start_date__lte=last_date))
+        .filter(Q(end_date__isnull=True) | Q(end_date__gte=first_date))
+        .prefetch_related(Prefetch('exceptions', queryset=exceptions))
+    )
+    by_staff = defaultdict(list)
+    for block in blocks:
+        by_staff[block.staff_id].append(block)
+    return by_staff
+
+
+def applies(block, date):
+    """設定が、その日に適用されるか"""
+    if block.start_date is not None and date < block.start_date:
+        return False
+    if block.end_date is not None and date > block.end_date:
+        return False
+    if block.weekday is not None and date.weekday() != block.weekday:
+        return False
+    return all(exception.date != date for exception in block.exceptions.all())
+
+
+def expand(blocks, dates):
+    """設定を、指定した日の {(日付, 時): 設定} に展開する"""
+    slots = {}
+    for date in dates:
+        for block in blocks:
+            if applies(block, date):
+                for hour in range(block.start_hour, block.end_hour):
+                    slots.setdefault((date, hour), block)
+    return slots
+
+
+def blocked_slots(staff_id, dates):
+    """スタッフの、指定した日のうち予約を受け付けない {(日付, 時): 設定}"""
+    if not dates:
+        return {}
+    return expand(active_blocks(staff_id, min(dates), max(dates)), dates)
+
+
+def schedule_slots(start, end):
+    """予約と重なる、1時間ごとの枠(日付, 時)のリスト。開始と終了が同じ予約は、開始時の枠と重なる"""
+    start = timezone.localtime(start) if timezone.is_aware(start) else start
+    end = timezone.localtime(end) if timezone.is_aware(end) else end
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    slots = [(hour.date(), hour.hour)]
+    hour += datetime.timedelta(hours=1)
+    while hour < end:
+        slots.append((hour.date(), hour.hour))
+        hour += datetime.timedelta(hours=1)
+    return slots
+
+
+def find_blocked(schedules):
+    """予約のうち、設定で受け付けない時間に重なるものを、(設定, 予約)の組で返す。スタッフごとに1回展開する"""
+    by_staff = defaultdict(list)
+    for schedule in schedules:
+        by_staff[schedule.staff_id].append((schedule, schedule_slots(schedule.start, schedule.end)))
+
+    blocked = []
+    for staff_id, items in by_staff.items():
+        slots = blocked_slots(staff_id, {date for _, covered in items for date, _ in covered})
+        if not slots:
+            continue
+        for schedule, covered in items:
+            block = next((slots[slot] for slot in covered if slot in slots), None)
+            if block is not None:
+                blocked.append((block, schedule))
+    return blocked
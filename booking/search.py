@@ -0,0 +1,77 @@
+"""店舗・スタッフ名の検索。
+
+SQLiteでFTS5(trigram)が使える場合は、マイグレーションで作った booking_store_fts / booking_staff_fts を使う。
+FTSテーブルのrowidは、それぞれStore/Staffのpkと同じ。保存・削除時にsignalsから同期される。
+"""
+from django.db import connection
+from .models import Store, Staff
+
+# trigramトークナイザは3文字未満の検索語にマッチしないので、それより短い場合はLIKEで探す
+MIN_FTS_QUERY_LENGTH = 3
+
+_fts_tables = {}
+
+
+def fts_enabled():
+    """FTSテーブルがあるかどうか。データベースごとに一度だけ調べる"""
+    name = connection.settings_dict['NAME']
+    if name not in _fts_tables:
+        _fts_tables[name] = (
+            connection.vendor == 'sqlite' and 'booking_store_fts' in connection.introspection.table_names()
+        )
+    return _fts_tables[name]
+
+
+def _fts_table(model):
+    return f'{model._meta.db_table}_fts'
+
+
+def index_object(obj):
+    """店舗かスタッフの名前を、FTSテーブルに登録(または更新)する"""
+    if not fts_enabled():
+        return
+    table = _fts_table(type(obj))
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table} WHERE rowid = %s', [obj.pk])
+        cursor.execute(f'INSERT INTO {table}(rowid, name) VALUES (%s, %s)', [obj.pk, obj.name])
+
+
+def index_objects(model, objects):
+    """index_object()を、同じモデルの複数のオブジェクトについてまとめて行う"""
+    if not fts_enabled():
+        return
+    table = _fts_table(model)
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {table} WHERE rowid = %s', [[obj.pk] for obj in objects])
+        cursor.executemany(f'INSERT INTO {table}(rowid, name) VALUES (%s, %s)', [[obj.pk, obj.name] for obj in objects])
+
+
+def unindex_object(obj):
+    """店舗かスタッフを、FTSテーブルから削除する"""
+    if not fts_enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {_fts_table(type(obj))} WHERE rowid = %s', [obj.pk])
+
+
+def _search(model, query):
+    queryset = model.objects.all()
+    if fts_enabled() and len(query) >= MIN_FTS_QUERY_LENGTH:
+        # 検索語全体を1つのフレーズとして扱う。FTSの演算子は使わせない
+        phrase = '"{}"'.format(query.replace('"', '""'))
+        table = _fts_table(model)
+        # pk__in=RawSQL(...)だと「IN ((SELECT ...))」になり、SQLiteでは最初の1件しか一致しないので、extra()で書く
+        return queryset.extra(
+            where=[f'{model._meta.db_table}.id IN (SELECT rowid FROM {table} WHERE {table} MATCH %s)'], params=[phrase],
+        )
+    return queryset.filter(name__icontains=query)
+
+
+def search_stores(query, limit=50):
+    """店名で店舗を探す"""
+    return _search(Store, query).order_by('name', 'pk')[:limit]
+
+
+def search_staff(query, limit=50):
+    """表示名でスタッフを探す"""
+    return _search(Staff, query).select_related('store').order_by('name', 'pk')[:limit]
@@ -0,0 +1,143 @@
+import threading
+from contextlib import contextmanager
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from . import availability, capacity, coherence, events, search, waitlist
+from .models import RecurringBlock, RecurringBlockException, Store, Staff, Schedule
+
+
+def schedules_changed(removed, added):
+    """予約の追加・移動・削除を、集計などに反映する。
+
+    removed/addedは、なくなった予約と増えた予約の(スタッフのpk, 開始日時)のリスト。
+    シグナルが送られないbulk_createやupdateで予約を変更した場合は、これを直接呼ぶ。
+    """
+    removed = list(removed)
+    slots = removed + list(added)
+    booked = availability.booked_hours_for_slots(slots)
+    availability.refresh_daily_counts(booked)
+    capacity.sync_counters(slots)
+    events.record_changes(slots, booked)
+    waitlist.promote(removed, booked)
+    coherence.invalidate({coherence.staff_key(staff_id) for staff_id, _ in slots})
+
+
+_batch = threading.local()
+
+
+@contextmanager
+def batched_changes():
+    """この中で保存・削除した予約の反映を、最後に1回のschedules_changed()にまとめる
+
+    QuerySet.delete()のように1件ずつシグナルが送られる操作でも、集計などへの反映は1回で済む。
+    """
+    if getattr(_batch, 'changes', None) is not None:
+        # 入れ子の場合は、外側でまとめて反映する
+        yield
+        return
+    removed, added = _batch.changes = ([], [])
+    try:
+        yield
+    finally:
+        _batch.changes = None
+    if removed or added:
+        schedules_changed(removed, added)
+
+
+def notify_schedules_changed(removed, added):
+    """シグナルから呼ぶ。batched_changes()の中なら、後でまとめて反映する"""
+    changes = getattr(_batch, 'changes', None)
+    if changes is None:
+        schedules_changed(removed, added)
+    else:
+        changes[0].extend(removed)
+        changes[1].extend(added)
+
+
+@receiver(pre_save, sender=Schedule)
+def remember_schedule_slot(sender, instance, **kwargs):
+    """更新前のスタッフと開始日時を覚えておく"""
+    instance._previous_slot = None
+    if instance.pk is not None:
+        instance._previous_slot = Schedule.objects.filter(pk=instance.pk).values_list('staff_id', 'start').first()
+
+
+@receiver(post_save, sender=Schedule)
+def schedule_saved(sender, instance, **kwargs):
+    previous = getattr(instance, '_previous_slot', None)
+    current = (instance.staff_id, instance.start)
+    if previous != current:
+        notify_schedules_changed([previous] if previous else [], [current])
+
+
+@receiver(post_delete, sender=Schedule)
+def schedule_deleted(sender, instance, **kwargs):
+    notify_schedules_changed([(instance.staff_id, instance.start)], [])
+
+
+@receiver(post_save, sender=Store)
+@receiver(post_save, sender=Staff)
+def index_directory(sender, instance, **kwargs):
+    """店舗・スタッフの保存時に、検索用のインデックスも更新する"""
+    search.index_object(instance)
+
+
+@receiver(post_delete, sender=Store)
+@receiver(post_delete, sender=Staff)
+def unindex_directory(sender, instance, **kwargs):
+    search.unindex_object(instance)
+
+
+@receiver(post_save, sender=Store)
+@receiver(post_delete, sender=Store)
+def store_changed(sender, instance, **kwargs):
+    """店舗が変わったら、その店舗のスタッフのキャッシュも無効にする"""
+    staff_keys = [coherence.staff_key(pk) for pk in Staff.objects.filter(store=instance).values_list('pk', flat=True)]
+    coherence.invalidate([coherence.store_key(instance.pk)] + staff_keys)
+
+
+@receiver(post_save, sender=Staff)
+@receiver(post_delete, sender=Staff)
+def staff_changed(sender, instance, **kwargs):
+    coherence.invalidate([coherence.staff_key(instance.pk)])
+
+
+@receiver(pre_save, sender=Staff)
+def remember_staff_capacity(sender, instance, **kwargs):
+    """更新前の定員を覚えておく"""
+    instance._previous_capacity = None
+    if instance.pk is not None:
+        instance._previous_capacity = Staff.objects.filter(pk=instance.pk).values_list('capacity', flat=True).first()
+
+
+@receiver(post_save, sender=Staff)
+def staff_capacity_changed(sender, instance, created, **kwargs):
+    """定員が変わると、どの枠が埋まっているかも変わるので、日ごとの集計とカレンダーを作り直す"""
+    previous = getattr(instance, '_previous_capacity', None)
+    if not created and previous is not None and previous != instance.capacity:
+        availability.rebuild_daily_counts([instance.pk])
+        whole_calendar_changed(instance.pk)
+
+
+def whole_calendar_changed(staff_id):
+    """繰り返しの設定や定員が変わったら、スタッフのカレンダーを作り直させる
+
+    変わった枠は記録しないので、差分カレンダーはバージョンの抜けを見て、カレンダー全体を送り直す(events.py)。
+    """
+    Staff.objects.filter(pk=staff_id).update(calendar_version=F('calendar_version') + 1)
+    coherence.invalidate([coherence.staff_key(staff_id)])
+
+
+@receiver(post_save, sender=RecurringBlock)
+@receiver(post_delete, sender=RecurringBlock)
+def recurring_block_changed(sender, instance, **kwargs):
+    whole_calendar_changed(instance.staff_id)
+
+
+@receiver(post_save, sender=RecurringBlockException)
+@receiver(post_delete, sender=RecurringBlockException)
+def recurring_block_exception_changed(sender, instance, **kwargs):
+    staff_id = RecurringBlock.objects.filter(pk=instance.block_id).values_list('staff_id', flat=True).first()
+    if staff_id is not None:
+        whole_calendar_changed(staff_id)
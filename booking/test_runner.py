@@ -0,0 +1,120 @@
+"""テスト用のデータベースを、マイグレーション済みのテンプレートからコピーして作るテストランナー。
+
+テストのたびに全マイグレーションを適用する代わりに、一度だけマイグレーションを適用したSQLiteファイルを
+BOOKING_TEST_TEMPLATE_DIRに作っておき、テストの実行ごとに、それをメモリ上のテスト用データベースにコピーする。
+テンプレートのファイル名には、マイグレーションのファイルとDjangoのバージョンから作ったハッシュを含めるので、
+マイグレーションが変われば自動で作り直される。
+
+SQLite以外のデータベースや、複数のデータベースを使う場合、--parallelで実行する場合、
+環境変数BOOKING_TEST_TEMPLATEが0の場合は、Django標準の方法でテスト用のデータベースを作る。
+
+テスト中は、世代番号のファイル(BOOKING_COHERENCE_DB)と共有キャッシュ(BOOKING_CALENDAR_CACHE)を
+一時ディレクトリに置き、開発用のファイルを書き換えない。
+"""
+import copy
+import glob
+import hashlib
+import inspect
+import os
+import sqlite3
+import tempfile
+import django
+from django.conf import settings
+from django.db import connections
+from django.db.migrations.loader import MigrationLoader
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+def migrations_fingerprint():
+    """全アプリのマイグレーションのファイルの中身と、Djangoのバージョンから作ったハッシュ"""
+    digest = hashlib.sha1(django.__version__.encode())
+    loader = MigrationLoader(None, ignore_no_migrations=True)
+    for key, migration in sorted(loader.disk_migrations.items()):
+        digest.update(repr(key).encode())
+        with open(inspect.getfile(type(migration)), 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()[:12]
+
+
+def template_path(fingerprint):
+    return os.path.join(settings.BOOKING_TEST_TEMPLATE_DIR, f'test-template-{fingerprint}.sqlite3')
+
+
+class TemplateDatabaseRunner(DiscoverRunner):
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.temp_settings = override_settings(**self.temp_file_settings(self.temp_dir.name))
+        self.temp_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.temp_settings.disable()
+        self.temp_dir.cleanup()
+        super().teardown_test_environment(**kwargs)
+
+    def temp_file_settings(self, directory):
+        """テスト中に、一時ディレクトリへ置き換える設定"""
+        caches = copy.deepcopy(settings.CACHES)
+        caches[settings.BOOKING_CALENDAR_CACHE]['LOCATION'] = os.path.join(directory, 'calendar')
+        return {'BOOKING_COHERENCE_DB': os.path.join(directory, 'coherence.sqlite3'), 'CACHES': caches}
+
+    def use_template(self):
+        return (
+            os.environ.get('BOOKING_TEST_TEMPLATE', '1') != '0'
+            and self.parallel == 1
+            and not self.keepdb
+            and len(settings.DATABASES) == 1
+            and connections['default'].vendor == 'sqlite'
+        )
+
+    def setup_databases(self, **kwargs):
+        if not self.use_template():
+            return super().setup_databases(**kwargs)
+
+        connection = connections['default']
+        path = template_path(migrations_fingerprint())
+        if not os.path.exists(path):
+            self.build_template(connection, path)
+        old_config = [(connection, connection.settings_dict['NAME'], True)]
+        self.copy_template(connection, path)
+        return old_config
+
+    def build_template(self, connection, path):
+        """マイグレーションを適用したSQLiteファイルを作る。途中で止まっても壊れたテンプレートが残らないよう、最後に置き換える"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        for old in glob.glob(template_path('*')):
+            os.remove(old)
+        building = f'{path}.{os.getpid()}'
+        old_name = connection.settings_dict['NAME']
+        test_settings = connection.settings_dict['TEST']
+        old_test_name = test_settings.get('NAME')
+        test_settings['NAME'] = building
+        try:
+            connection.creation.create_test_db(
+                verbosity=self.verbosity, autoclobber=True, serialize=False, keepdb=False,
+            )
+        finally:
+            connection.close()
+            test_settings['NAME'] = old_test_name
+            connection.settings_dict['NAME'] = old_name
+            settings.DATABASES[connection.alias]['NAME'] = old_name
+        os.replace(building, path)
+
+    def copy_template(self, connection, path):
+        """テンプレートを、メモリ上のテスト用データベースにコピーする"""
+        test_name = connection.creation._get_test_db_name()
+        if self.verbosity >= 1:
+            print(f"Copying test database for alias '{connection.alias}' from {os.path.basename(path)}...")
+        connection.close()
+        settings.DATABASES[connection.alias]['NAME'] = test_name
+        connection.settings_dict['NAME'] = test_name
+        connection.ensure_connection()
+        source = sqlite3.connect(path)
+        try:
+            source.backup(connection.connection)
+        finally:
+            source.close()
+        if connection.settings_dict['TEST'].get('SERIALIZE', True):
+            connection._test_serialized_contents = connection.creation.serialize_db_to_string()
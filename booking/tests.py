@@ -1,14 +1,38 @@
+import copy
 import datetime
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+from collections import defaultdict
+from contextlib import closing
+from io import StringIO
+from unittest import skipUnless
+from django.contrib.auth import get_user_model
+from django.core.exceptions import MiddlewareNotUsed, ValidationError
+from django.core import mail
+from django.core.management import call_command
+from django.http import QueryDict
 from django.shortcuts import resolve_url, get_object_or_404
-from django.test import TestCase
+from django.db import connection
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
 from django.template.exceptions import TemplateDoesNotExist
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
-from .models import Schedule, Staff
+from . import availability, capacity, coherence, conflicts, factories, metrics, recurrence
+from .middleware import SamplingProfilerMiddleware
+from .models import (
+    DailyBookingCount, IdempotencyKey, RecurringBlock, RecurringBlockException, Schedule, ScheduleChange, SlotCounter, SlotHold,
+    Staff, Store, WaitlistEntry,
+)
 
 batu = '×'
 maru = '○'
 line = '-'
 
+User = get_user_model()
+
 
 class StoreListViewTests(TestCase):
     fixtures = ['initial']
@@ -17,6 +41,33 @@ class StoreListViewTests(TestCase):
         """店舗の一覧が表示されるかテスト"""
         response = self.client.get(resolve_url('booking:store_list'))
         self.assertQuerysetEqual(response.context['store_list'],  ['<Store: 店舗A>', '<Store: 店舗B>', '<Store: 店舗C>'])
+        self.assertNotIn('next_query', response.context)
+
+    def test_pagination(self):
+        """店舗が多い場合は、名前順に分割して表示されるかテスト"""
+        Store.objects.bulk_create([Store(name=f'支店{i:03}') for i in range(120)])
+        names = []
+        url = resolve_url('booking:store_list')
+        while True:
+            response = self.client.get(url)
+            names += [store.name for store in response.context['store_list']]
+            if 'next_query' not in response.context:
+                break
+            url = resolve_url('booking:store_list') + '?' + response.context['next_query']
+        self.assertEqual(names, ['店舗A', '店舗B', '店舗C'] + [f'支店{i:03}' for i in range(120)])
+
+    def test_same_name(self):
+        """同じ名前の店舗がページの境目にあっても、漏れなく表示されるかテスト"""
+        Store.objects.bulk_create([Store(name='店舗A') for _ in range(60)])
+        response = self.client.get(resolve_url('booking:store_list'))
+        self.assertEqual(len(response.context['store_list']), 50)
+        response = self.client.get(resolve_url('booking:store_list') + '?' + response.context['next_query'])
+        self.assertEqual(len(response.context['store_list']), 13)
+
+    def test_invalid_cursor(self):
+        """不正なafterパラメータは無視して、最初のページを表示する"""
+        response = self.client.get(resolve_url('booking:store_list') + '?after=invalid')
+        self.assertEqual(len(response.context['store_list']), 3)
 
 
 class StaffListViewTests(TestCase):
@@ -37,6 +88,123 @@ class StaffListViewTests(TestCase):
         response = self.client.get(resolve_url('booking:staff_list', pk=3))
         self.assertQuerysetEqual(response.context['staff_list'],  [])
 
+    def test_sort_free(self):
+        """空き枠が多い順に並べ替えられるかテスト"""
+        staff = get_object_or_404(Staff, pk=3)  # じゃば
+        start = timezone.localtime().replace(hour=10, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
+        Schedule.objects.create(staff=staff, start=start, end=start + datetime.timedelta(hours=1), name='テスト')
+        response = self.client.get(resolve_url('booking:staff_list', pk=1), {'sort': 'free'})
+        self.assertQuerysetEqual(response.context['staff_list'],  ['<Staff: 店舗A - ぱいそん>', '<Staff: 店舗A - じゃば>'])
+        self.assertEqual([staff.free_slots for staff in response.context['staff_list']], [63, 62])
+
+    def test_sort_free_pagination(self):
+        """空き枠順でも、ページをまたいで漏れなく表示されるかテスト"""
+        users = [User.objects.create(username=f'user{i}') for i in range(60)]
+        store = get_object_or_404(Store, pk=3)
+        Staff.objects.bulk_create([Staff(name=f'スタッフ{i:02}', user=user, store=store) for i, user in enumerate(users)])
+        start = timezone.localtime().replace(hour=10, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
+        for staff in Staff.objects.filter(store=store, name__in=['スタッフ10', 'スタッフ55']):
+            Schedule.objects.create(staff=staff, start=start, end=start + datetime.timedelta(hours=1), name='テスト')
+
+        names = []
+        query = {'sort': 'free'}
+        while True:
+            response = self.client.get(resolve_url('booking:staff_list', pk=3), query)
+            names += [staff.name for staff in response.context['staff_list']]
+            if 'next_query' not in response.context:
+                break
+            query = QueryDict(response.context['next_query'])
+        expected = [f'スタッフ{i:02}' for i in range(60) if i not in (10, 55)] + ['スタッフ10', 'スタッフ55']
+        self.assertEqual(names, expected)
+
+    def test_min_free(self):
+        """空き枠の数で絞り込めるかテスト"""
+        staff = get_object_or_404(Staff, pk=3)
+        start = timezone.localtime().replace(hour=10, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
+        Schedule.objects.create(staff=staff, start=start, end=start + datetime.timedelta(hours=1), name='テスト')
+        response = self.client.get(resolve_url('booking:staff_list', pk=1), {'min_free': 63})
+        self.assertQuerysetEqual(response.context['staff_list'],  ['<Staff: 店舗A - ぱいそん>'])
+
+
+class DailyBookingCountTests(TestCase):
+    fixtures = ['initial']
+
+    def setUp(self):
+        self.staff = get_object_or_404(Staff, pk=1)
+        self.start = timezone.localtime().replace(hour=9, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
+
+    def counts(self):
+        return list(DailyBookingCount.objects.values_list('staff_id', 'date', 'booked').order_by('staff_id', 'date'))
+
+    def test_create(self):
+        """予約を追加すると、その日の予約済み枠数が増える。同じ時間の予約や時間外の予約は数えない"""
+        date = self.start.date()
+        Schedule.objects.create(staff=self.staff, start=self.start, end=self.start, name='テスト1')
+        self.assertEqual(self.counts(), [(1, date, 1)])
+        Schedule.objects.create(staff=self.staff, start=self.start, end=self.start, name='テスト2')
+        Schedule.objects.create(staff=self.staff, start=self.start.replace(hour=20), end=self.start, name='テスト3')
+        self.assertEqual(self.counts(), [(1, date, 1)])
+        Schedule.objects.create(staff=self.staff, start=self.start.replace(hour=17), end=self.start, name='テスト4')
+        self.assertEqual(self.counts(), [(1, date, 2)])
+
+    def test_move_and_delete(self):
+        """予約の移動や削除で、元の日と移動先の日の集計が更新される"""
+        schedule = Schedule.objects.create(staff=self.staff, start=self.start, end=self.start, name='テスト')
+        schedule.start = self.start + datetime.timedelta(days=1)
+        schedule.staff_id = 2
+        schedule.save()
+        self.assertEqual(self.counts(), [(2, schedule.start.date(), 1)])
+        schedule.delete()
+        self.assertEqual(self.counts(), [])
+
+    def test_reconcile(self):
+        """集計のずれを、コマンドで確認・修正できる"""
+        Schedule.objects.create(staff=self.staff, start=self.start, end=self.start, name='テスト')
+        out = StringIO()
+        call_command('reconcile_availability', stdout=out)
+        self.assertIn('集計は一致しています', out.getvalue())
+
+        DailyBookingCount.objects.update(booked=5)
+        out = StringIO()
+        call_command('reconcile_availability', stdout=out)
+        self.assertIn('1件の集計がずれています', out.getvalue())
+        call_command('reconcile_availability', '--fix', stdout=StringIO())
+        self.assertEqual(self.counts(), [(1, self.start.date(), 1)])
+
+
+class DirectorySearchViewTests(TestCase):
+    fixtures = ['initial']
+
+    def test_search_store(self):
+        """店名の一部で店舗を探せるかテスト"""
+        Store.objects.create(name='新宿駅前店舗')
+        response = self.client.get(resolve_url('booking:search'), {'q': '駅前店'})
+        self.assertQuerysetEqual(response.context['store_list'], ['<Store: 新宿駅前店舗>'])
+        self.assertQuerysetEqual(response.context['staff_list'], [])
+
+    def test_search_staff(self):
+        """スタッフ名で探せるかテスト。短い検索語でも探せる"""
+        response = self.client.get(resolve_url('booking:search'), {'q': 'じゃ'})
+        self.assertQuerysetEqual(response.context['staff_list'], ['<Staff: 店舗A - じゃば>', '<Staff: 店舗B - じゃんご>'])
+
+    def test_index_updated(self):
+        """名前の変更や削除が、検索結果にも反映されるかテスト"""
+        store = Store.objects.create(name='渋谷駅前店舗')
+        store.name = '池袋駅前店舗'
+        store.save()
+        response = self.client.get(resolve_url('booking:search'), {'q': '渋谷駅前'})
+        self.assertQuerysetEqual(response.context['store_list'], [])
+        response = self.client.get(resolve_url('booking:search'), {'q': '池袋駅前'})
+        self.assertQuerysetEqual(response.context['store_list'], ['<Store: 池袋駅前店舗>'])
+        store.delete()
+        response = self.client.get(resolve_url('booking:search'), {'q': '池袋駅前'})
+        self.assertQuerysetEqual(response.context['store_list'], [])
+
+    def test_no_query(self):
+        """検索語がなければ、何も検索しない"""
+        response = self.client.get(resolve_url('booking:search'))
+        self.assertNotIn('store_list', response.context)
+
 
 class StaffCalendarViewTests(TestCase):
     fixtures = ['initial']
@@ -165,6 +333,456 @@ class StaffCalendarViewTests(TestCase):
         self.assertContains(response, f'{start.year}年{start.month}月{start.day}日 - {end.year}年{end.month}月{end.day}日')
 
 
+@override_settings(BOOKING_EVENTS_POLL_INTERVAL=0, BOOKING_EVENTS_STREAM_SECONDS=60)
+class CalendarEventsViewTests(TestCase):
+    fixtures = ['initial']
+
+    def setUp(self):
+        self.staff = get_object_or_404(Staff, pk=1)
+        self.start = timezone.localtime().replace(hour=9, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
+
+    def changes(self):
+        return list(ScheduleChange.objects.values_list('staff_id', 'date', 'hour', 'booked').order_by('id'))
+
+    def test_record(self):
+        """予約の追加・移動・削除で、変わった枠が記録される"""
+        date = self.start.date()
+        schedule = Schedule.objects.create(staff=self.staff, start=self.start, end=self.start, name='テスト')
+        schedule.name = '名前だけ変更'
+        schedule.save()
+        schedule.start = self.start.replace(hour=10)
+        schedule.save()
+        schedule.delete()
+        self.assertEqual(self.changes(), [(1, date, 9, True), (1, date, 9, False), (1, date, 10, True), (1, date, 10, False)])
+
+    def test_long_poll(self):
+        """ロングポーリングで、指定したidより後の変更を受け取れる"""
+        Schedule.objects.create(staff=self.staff, start=self.start, end=self.start, name='テスト')
+        response = self.client.get(resolve_url('booking:calendar_events', pk=1), {'last_id': 0, 'wait': 0})
+        data = response.json()
+        self.assertEqual(data['changes'], [
+            {'id': data['last_id'], 'staff': 1, 'date': self.start.date().isoformat(), 'hour': 9, 'booked': True, 'remaining': 0},
+        ])
+        response = self.client.get(resolve_url('booking:calendar_events', pk=1), {'last_id': data['last_id'], 'wait': 0})
+        self.assertEqual(response.json()['changes'], [])
+
+    def test_remaining(self):
+        """変更には、定員と繰り返しの設定を反映した、今の残りの席数が含まれる"""
+        Staff.objects.filter(pk=1).update(capacity=2)
+        RecurringBlock.objects.create(staff=self.staff, weekday=self.start.weekday(), start_hour=10, end_hour=11)
+        Schedule.objects.create(staff=self.staff, start=self.start, end=self.start, name='テスト1')
+        Schedule.objects.create(staff=self.staff, start=self.start.replace(hour=10), end=self.start, name='テスト2')
+        response = self.client.get(resolve_url('booking:calendar_events', pk=1), {'last_id': 0, 'wait': 0})
+        changes = response.json()['changes']
+        self.assertEqual([(change['hour'], change['remaining']) for change in changes], [(9, 1), (10, 0)])
+
+    def test_many_subscribers(self):
+        """多数のカレンダーを開いている場合でも、それぞれのスタッフの変更だけが届く"""
+        subscribers = []
+        for i in range(100):
+            staff_pk = 1 if i % 2 else 2
+            response = self.client.get(resolve_url('booking:calendar_events', pk=staff_pk))
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            stream = iter(response.streaming_content)
+            self.assertEqual(next(stream), b'retry: 3000\n\n')
+            subscribers.append((staff_pk, stream))
+
+        schedule = Schedule.objects.create(staff=self.staff, start=self.start, end=self.start, name='テスト')
+        schedule.delete()
+        for staff_pk, stream in subscribers:
+            if staff_pk == 1:
+                first, second = next(stream).decode(), next(stream).decode()
+                self.assertIn('"hour": 9, "booked": true', first)
+                self.assertIn('"hour": 9, "booked": false', second)
+            self.assertEqual(next(stream), b': keepalive\n\n')
+
+    def test_reconnect(self):
+        """再接続時は、Last-Event-IDより後の変更から受け取れる"""
+        Schedule.objects.create(staff=self.staff, start=self.start, end=self.start, name='テスト1')
+        last_id = ScheduleChange.objects.get().pk
+        Schedule.objects.create(staff=self.staff, start=self.start.replace(hour=11), end=self.start, name='テスト2')
+        response = self.client.get(resolve_url('booking:calendar_events', pk=1), HTTP_LAST_EVENT_ID=str(last_id))
+        stream = iter(response.streaming_content)
+        next(stream)
+        self.assertIn('"hour": 11', next(stream).decode())
+
+    def test_prune(self):
+        """古い変更履歴を削除できる"""
+        Schedule.objects.create(staff=self.staff, start=self.start, end=self.start, name='テスト')
+        ScheduleChange.objects.update(created_at=timezone.now() - datetime.timedelta(days=2))
+        call_command('prune_schedule_changes', '--batch-size', '1', stdout=StringIO())
+        self.assertEqual(self.changes(), [])
+
+
+class CalendarDeltaViewTests(TestCase):
+    fixtures = ['initial']
+
+    def setUp(self):
+        self.staff = get_object_or_404(Staff, pk=1)
+        self.start = timezone.localtime().replace(hour=9, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
+
+    def get(self, **params):
+        return self.client.get(resolve_url('booking:calendar_delta', pk=1), params).json()
+
+    def test_full(self):
+        """sinceがなければ、1週間分すべての枠を返す"""
+        Schedule.objects.create(staff=self.staff, start=self.start, end=self.start, name='テスト')
+        data = self.get()
+        self.assertTrue(data['full'])
+        self.assertEqual(data['version'], 1)
+        self.assertEqual(len(data['cells']), 63)
+        self.assertEqual([cell for cell in data['cells'] if cell['booked']], [
+            {'date': self.start.date().isoformat(), 'hour': 9, 'booked': True, 'remaining': 0},
+        ])
+
+    def test_delta(self):
+        """前回のバージョンから変わった枠だけを返す。表示している週の外の変更は含まない"""
+        version = self.get()['version']
+        schedule = Schedule.objects.create(staff=self.staff, start=self.start, end=self.start, name='テスト')
+        Schedule.objects.create(staff=self.staff, start=self.start + datetime.timedelta(days=10), end=self.start, name='来週')
+        schedule.start = self.start.replace(hour=10)
+        schedule.save()
+        data = self.get(since=version)
+        self.assertFalse(data['full'])
+        self.assertEqual(data['version'], version + 3)
+        self.assertEqual(data['cells'], [
+            {'date': self.start.date().isoformat(), 'hour': 9, 'booked': False, 'remaining': 1},
+            {'date': self.start.date().isoformat(), 'hour': 10, 'booked': True, 'remaining': 0},
+        ])
+        self.assertEqual(self.get(since=data['version'])['cells'], [])
+
+    @override_settings(BOOKING_DELTA_MAX_CHANGES=2)
+    def test_too_many_changes(self):
+        """変更が多すぎる場合は、カレンダー全体を返す"""
+        for hour in (9, 10, 11):
+            Schedule.objects.create(staff=self.staff, start=self.start.replace(hour=hour), end=self.start, name='テスト')
+        self.assertFalse(self.get(since=1)['full'])
+        self.assertTrue(self.get(since=0)['full'])
+
+    def test_staff_save(self):
+        """スタッフを保存しても、バージョンは古い値に戻らない"""
+        Schedule.objects.create(staff=self.staff, start=self.start, end=self.start, name='テスト')
+        self.staff.name = '名前を変更'
+        self.staff.save()
+        self.assertEqual(Staff.objects.get(pk=1).calendar_version, 1)
+
+    def test_pruned(self):
+        """古い変更履歴が削除されていれば、カレンダー全体を返す"""
+        Schedule.objects.create(staff=self.staff, start=self.start, end=self.start, name='テスト1')
+        ScheduleChange.objects.all().delete()
+        Schedule.objects.create(staff=self.staff, start=self.start.replace(hour=10), end=self.start, name='テスト2')
+        self.assertTrue(self.get(since=0)['full'])
+        self.assertFalse(self.get(since=1)['full'])
+
+    def test_recurring_block_added(self):
+        """繰り返しの設定で、枠を記録せずにバージョンが上がった後は、予約があってもカレンダー全体を返す"""
+        version = self.get()['version']
+        Schedule.objects.create(staff=self.staff, start=self.start, end=self.start, name='テスト1')
+        RecurringBlock.objects.create(staff=self.staff, weekday=self.start.weekday(), start_hour=12, end_hour=13)
+        Schedule.objects.create(staff=self.staff, start=self.start.replace(hour=10), end=self.start, name='テスト2')
+        data = self.get(since=version)
+        self.assertTrue(data['full'])
+        self.assertEqual(data['version'], version + 3)
+        self.assertIn({'date': self.start.date().isoformat(), 'hour': 12, 'booked': True, 'remaining': 0}, data['cells'])
+        self.assertFalse(self.get(since=version + 2)['full'])
+
+    def test_capacity(self):
+        """定員が2以上なら、差分にもカレンダー全体にも、変更配信と同じ残りの席数を含める"""
+        self.staff.capacity = 3
+        self.staff.save()
+        version = self.get()['version']
+        Schedule.objects.create(staff=self.staff, start=self.start, end=self.start, name='テスト')
+        cell = {'date': self.start.date().isoformat(), 'hour': 9, 'booked': False, 'remaining': 2}
+        self.assertEqual(self.get(since=version)['cells'], [cell])
+        self.assertIn(cell, self.get()['cells'])
+        response = self.client.get(resolve_url('booking:calendar_events', pk=1), {'last_id': 0, 'wait': 0})
+        self.assertEqual(response.json()['changes'][-1]['remaining'], 2)
+
+
+def _bump_generation(path, key, times):
+    """別のワーカープロセスとして、世代番号を上げる"""
+    with override_settings(BOOKING_COHERENCE_DB=path):
+        for _ in range(times):
+            coherence.generations.bump([key])
+
+
+class CoherenceTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'coherence.sqlite3')
+        setting = override_settings(BOOKING_COHERENCE_DB=self.path)
+        setting.enable()
+        self.addCleanup(setting.disable)
+        self.cache = coherence.LocalCache(coherence.generations, maxsize=2)
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        return self.calls
+
+    def test_local_cache(self):
+        """世代番号が変わるまでは、キャッシュした値を返す"""
+        self.assertEqual(self.cache.get_or_set('a', ['staff:1'], self.compute), 1)
+        self.assertEqual(self.cache.get_or_set('a', ['staff:1'], self.compute), 1)
+        coherence.generations.bump(['staff:2'])
+        self.assertEqual(self.cache.get_or_set('a', ['staff:1'], self.compute), 1)
+        coherence.generations.bump(['staff:1'])
+        self.assertEqual(self.cache.get_or_set('a', ['staff:1'], self.compute), 2)
+
+    def test_maxsize(self):
+        """古いものから捨てる"""
+        for key in ('a', 'b', 'c'):
+            self.cache.get_or_set(key, ['staff:1'], self.compute)
+        self.assertEqual(self.cache.get_or_set('c', ['staff:1'], self.compute), 3)
+        self.assertEqual(self.cache.get_or_set('a', ['staff:1'], self.compute), 4)
+
+    def test_multi_process(self):
+        """他のプロセスで世代番号を上げると、このプロセスのキャッシュも作り直される。同時に上げても取りこぼさない"""
+        self.assertEqual(self.cache.get_or_set('a', ['staff:1'], self.compute), 1)
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=_bump_generation, args=(self.path, 'staff:1', 50)) for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+        self.assertEqual(coherence.generations.get_many(['staff:1']), {'staff:1': 200})
+        self.assertEqual(self.cache.get_or_set('a', ['staff:1'], self.compute), 2)
+
+    def test_recreated(self):
+        """世代番号のファイルを作り直すと、世代番号が同じでも共有キャッシュのキーが変わる"""
+        key = coherence.shared_key(1, 'a', 0)
+        self.assertEqual(coherence.shared_key(1, 'a', 0), key)
+        os.remove(self.path)
+        setting = override_settings(BOOKING_COHERENCE_DB=self.path + '.new')
+        setting.enable()
+        self.addCleanup(setting.disable)
+        self.assertNotEqual(coherence.shared_key(1, 'a', 0), key)
+
+
+LOCMEM_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'calendar': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'calendar'},
+}
+
+
+class CalendarCacheTests(TransactionTestCase):
+    fixtures = ['initial']
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        setting = override_settings(BOOKING_COHERENCE_DB=os.path.join(directory.name, 'coherence.sqlite3'), CACHES=LOCMEM_CACHES)
+        setting.enable()
+        self.addCleanup(setting.disable)
+        coherence.local_cache.clear()
+
+    def test_invalidate(self):
+        """カレンダーはキャッシュされるが、予約が入れば作り直される"""
+        url = resolve_url('booking:calendar', pk=1)
+        self.client.get(url)
+        with self.assertNumQueries(2):  # 仮押さえの確認と、変更配信用の最新の変更idの取得だけ
+            response = self.client.get(url)
+        self.assertNotContains(response, batu)
+
+        start = timezone.localtime().replace(hour=9, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
+        Schedule.objects.create(staff_id=1, start=start, end=start, name='テスト')
+        self.assertContains(self.client.get(url), batu)
+
+    def test_store_renamed(self):
+        """店舗名の変更も、キャッシュしたスタッフに反映される"""
+        url = resolve_url('booking:calendar', pk=1)
+        self.assertContains(self.client.get(url), '店舗A店 ぱいそん')
+        store = Store.objects.get(pk=1)
+        store.name = '本店'
+        store.save()
+        self.assertContains(self.client.get(url), '本店店 ぱいそん')
+
+
+class PrewarmTests(TransactionTestCase):
+    fixtures = ['initial']
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        setting = override_settings(BOOKING_COHERENCE_DB=os.path.join(directory.name, 'coherence.sqlite3'), CACHES=LOCMEM_CACHES)
+        setting.enable()
+        self.addCleanup(setting.disable)
+        self.clear()
+
+    def clear(self):
+        coherence.local_cache.clear()
+        coherence.shared_cache().clear()
+
+    def test_prewarm(self):
+        """事前作成したカレンダーは、表示したときに作るものと同じで、予約を読み直さない"""
+        today = datetime.date.today()
+        start = timezone.make_aware(datetime.datetime.combine(today + datetime.timedelta(days=8), datetime.time(10)))
+        Schedule.objects.create(staff_id=1, start=start, end=start + datetime.timedelta(hours=1), name='テスト')
+        RecurringBlock.objects.create(staff_id=1, weekday=today.weekday(), start_hour=12, end_hour=14)
+        urls = [resolve_url('booking:calendar', pk=1)] + [
+            resolve_url('booking:calendar', pk=pk, year=day.year, month=day.month, day=day.day)
+            for pk in (1, 3) for day in (today + datetime.timedelta(days=7), today + datetime.timedelta(days=14))
+        ]
+        expected = [self.client.get(url).content for url in urls]
+        self.clear()
+
+        out = StringIO()
+        call_command('prewarm_calendars', weeks=3, processes=1, stdout=out)
+        self.assertIn('3店舗、9件のカレンダーを', out.getvalue())
+        for url, content in zip(urls, expected):
+            coherence.local_cache.clear()
+            # スタッフ、仮押さえ、変更配信用の最新の変更idの取得だけ
+            with self.assertNumQueries(3):
+                self.assertEqual(self.client.get(url).content, content)
+
+    def test_processes(self):
+        """店舗ごとに子プロセスで作ったカレンダーも、共有キャッシュから使われる"""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        caches = copy.deepcopy(LOCMEM_CACHES)
+        caches['calendar'] = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': directory.name}
+        with self.settings(CACHES=caches):
+            url = resolve_url('booking:calendar', pk=1)
+            expected = self.client.get(url).content
+            self.clear()
+            out = StringIO()
+            call_command('prewarm_calendars', weeks=1, processes=2, stdout=out)
+            self.assertIn('3店舗、3件のカレンダーを', out.getvalue())
+            coherence.local_cache.clear()
+            with self.assertNumQueries(3):
+                self.assertEqual(self.client.get(url).content, expected)
+
+    def test_stale(self):
+        """事前作成した後に予約が入れば、そのカレンダーは使わない"""
+        call_command('prewarm_calendars', weeks=1, processes=1, stdout=StringIO())
+        start = timezone.localtime().replace(hour=9, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
+        Schedule.objects.create(staff_id=1, start=start, end=start, name='テスト')
+        self.assertContains(self.client.get(resolve_url('booking:calendar', pk=1)), batu)
+
+
+class MonthCalendarTests(TestCase):
+    fixtures = ['initial']
+
+    def setUp(self):
+        self.tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+
+    def test_same_as_week_calendar(self):
+        """日ごとの空き枠数は、1週間のカレンダーで予約できる枠の数と同じになる"""
+        rng = random.Random(0)
+        first_date, last_date = availability.month_range(self.tomorrow.year, self.tomorrow.month)
+        schedules = []
+        for _ in range(300):
+            start = timezone.make_aware(datetime.datetime.combine(
+                first_date + datetime.timedelta(days=rng.randrange(31)), datetime.time(rng.randrange(7, 20), rng.choice([0, 30])),
+            ))
+            schedules.append(Schedule(staff_id=rng.choice([1, 3]), start=start, end=start, name='テスト'))
+        Schedule.objects.bulk_create(schedules)
+        RecurringBlock.objects.create(staff_id=3, weekday=2, start_hour=12, end_hour=20)
+
+        with self.assertNumQueries(3):  # 予約の集計と、繰り返しの設定(と除外日)
+            free_slots = availability.free_slots_by_day([1, 3], first_date, last_date)
+        self.assertEqual(list(free_slots), [first_date + datetime.timedelta(days=day) for day in range(last_date.day)])
+        for day, free in free_slots.items():
+            calendars = [availability.week_calendar(staff_id, [day]) for staff_id in (1, 3)]
+            self.assertEqual(free, sum(row[day] for calendar in calendars for row in calendar.values()), day)
+
+    def test_same_as_staff_list(self):
+        """スタッフ一覧の空き枠数は、繰り返しの設定で受け付けない枠も含めて、日ごとの空き枠数の合計と同じになる"""
+        RecurringBlock.objects.create(staff_id=3, weekday=self.tomorrow.weekday(), start_hour=12, end_hour=14)
+        for hour in (9, 12):
+            start = timezone.make_aware(datetime.datetime.combine(self.tomorrow, datetime.time(hour)))
+            Schedule.objects.create(staff_id=3, start=start, end=start, name='テスト')
+        response = self.client.get(resolve_url('booking:staff_list', pk=1))
+        free = {staff.pk: staff.free_slots for staff in response.context['staff_list']}
+        for staff_id in (1, 3):
+            self.assertEqual(free[staff_id], sum(availability.free_slots_by_day([staff_id], *availability.bookable_week()).values()))
+        self.assertEqual(free[3], 60)
+
+    def test_staff(self):
+        """スタッフの月表示では、予約がある日は空き枠が減り、日付をクリックするとその日からの1週間が表示される"""
+        start = timezone.make_aware(datetime.datetime.combine(self.tomorrow, datetime.time(9)))
+        Schedule.objects.create(staff_id=1, start=start, end=start, name='テスト')
+        response = self.client.get(resolve_url('booking:staff_month', pk=1, year=self.tomorrow.year, month=self.tomorrow.month))
+        self.assertContains(response, f'{self.tomorrow.year}年{self.tomorrow.month}月の空き枠数')
+        tomorrow_url = resolve_url('booking:calendar', pk=1, year=self.tomorrow.year, month=self.tomorrow.month, day=self.tomorrow.day)
+        self.assertContains(response, f'<a href="{tomorrow_url}">8枠</a>', html=True)
+
+    def test_store(self):
+        """店舗の月表示では、スタッフ全員の空き枠を合計する"""
+        response = self.client.get(resolve_url('booking:store_month', pk=1, year=self.tomorrow.year, month=self.tomorrow.month))
+        self.assertEqual(response.context['store'].name, '店舗A')
+        free = dict(day for week in response.context['weeks'] for day in week if day[1] is not None)
+        self.assertEqual(free[self.tomorrow], 18)
+        self.assertEqual(self.client.get(resolve_url('booking:store_month', pk=1, year=2020, month=13)).status_code, 404)
+
+
+class FactoryTests(TestCase):
+
+    def test_create(self):
+        """まとめて作ったスタッフや予約も、1件ずつ作った場合と同じように集計・検索できる"""
+        stores = factories.create_stores(2, prefix='テスト店舗')
+        staff_list = factories.create_staff(stores, 3, prefix='テストスタッフ')
+        self.assertEqual([staff.store_id for staff in staff_list], [stores[0].pk] * 3 + [stores[1].pk] * 3)
+        self.assertEqual(len({staff.user_id for staff in staff_list}), 6)
+        self.assertTrue(self.client.login(username=staff_list[0].user.username, password=factories.PASSWORD))
+
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        created = factories.create_schedules(staff_list, tomorrow, 7, fill=0.5)
+        self.assertEqual(Schedule.objects.count(), created)
+        out = StringIO()
+        call_command('reconcile_availability', stdout=out)
+        self.assertIn('集計は一致しています', out.getvalue())
+
+        response = self.client.get(resolve_url('booking:search'), {'q': 'テストスタッフ'})
+        self.assertEqual(len(response.context['staff_list']), 6)
+
+
+@skipUnless(os.environ.get('BOOKING_SCALE_TESTS'), '環境変数BOOKING_SCALE_TESTSを設定したときだけ実行する')
+class ScaleTests(TestCase):
+    """10万件の予約があるときのテスト"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.first_date = datetime.date.today() + datetime.timedelta(days=1)
+        cls.stores = factories.create_stores(10)
+        cls.staff_list = factories.create_staff(cls.stores, 10)
+        cls.schedule_count = factories.create_schedules(cls.staff_list, cls.first_date, 120, fill=0.93)
+
+    def test_counts(self):
+        """日ごとの集計は、予約テーブルを集計した空き枠数と一致する"""
+        self.assertGreaterEqual(self.schedule_count, 100000)
+        last_date = self.first_date + datetime.timedelta(days=119)
+        staff_ids = [staff.pk for staff in self.staff_list]
+        booked = defaultdict(int)
+        for date, count in DailyBookingCount.objects.values_list('date', 'booked'):
+            booked[date] += count
+        free_slots = availability.free_slots_by_day(staff_ids, self.first_date, last_date)
+        self.assertEqual(
+            free_slots, {day: availability.SLOTS_PER_DAY * len(staff_ids) - booked[day] for day in free_slots},
+        )
+
+    def test_staff_list_sort(self):
+        """空き枠順の並べ替えは、予約の数によらず少ないクエリで済む"""
+        store = self.stores[0]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(resolve_url('booking:staff_list', pk=store.pk), {'sort': 'free'})
+        free_slots = [staff.free_slots for staff in response.context['staff_list']]
+        self.assertEqual(free_slots, sorted(free_slots, reverse=True))
+        self.assertLessEqual(len(queries), 5)
+
+    def test_store_month(self):
+        """店舗の月表示も、予約の数によらず少ないクエリで済む"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(resolve_url(
+                'booking:store_month', pk=self.stores[0].pk, year=self.first_date.year, month=self.first_date.month,
+            ))
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(queries), 6)
+
+
 class BookingViewTests(TestCase):
     fixtures = ['initial']
 
@@ -202,6 +820,792 @@ class BookingViewTests(TestCase):
         self.assertEqual(str(messages[0]), 'すみません、入れ違いで予約がありました。別の日時はどうですか。')
 
 
+class SlotHoldTests(TestCase):
+    fixtures = ['initial']
+
+    def setUp(self):
+        self.start = timezone.localtime().replace(hour=9, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
+        self.url = resolve_url(
+            'booking:booking', pk=1, year=self.start.year, month=self.start.month, day=self.start.day, hour=9
+        )
+        self.other = self.client_class()
+
+    def test_hold(self):
+        """予約ページを開くと、他のお客さんのカレンダーでは予約できない枠になる"""
+        self.client.get(self.url)
+        self.assertEqual(SlotHold.objects.count(), 1)
+        self.assertNotContains(self.client.get(resolve_url('booking:calendar', pk=1)), batu)
+        self.assertContains(self.other.get(resolve_url('booking:calendar', pk=1)), batu)
+
+    def test_held_by_other(self):
+        """他のお客さんが仮押さえしている枠は、予約ページを開けず、予約もできない"""
+        self.client.get(self.url)
+        response = self.other.get(self.url, follow=True)
+        self.assertEqual(str(list(response.context['messages'])[0]), 'すみません、他のお客様が予約の手続き中です。別の日時はどうですか。')
+        response = self.other.post(self.url, {'name': 'これは入らない'}, follow=True)
+        self.assertEqual(str(list(response.context['messages'])[0]), 'すみません、他のお客様が予約の手続き中です。別の日時はどうですか。')
+        self.assertFalse(Schedule.objects.exists())
+
+    def test_capacity(self):
+        """定員が2以上の枠は、予約済みの席と仮押さえの合計が定員に達するまで、複数のお客さんが押さえられる"""
+        Staff.objects.filter(pk=1).update(capacity=3)
+        third = self.client_class()
+        self.client.get(self.url)
+        calendar = self.other.get(resolve_url('booking:calendar', pk=1)).context['calendar']
+        self.assertEqual(calendar[9][self.start.date()], 2)
+        self.assertEqual(self.other.get(self.url).status_code, 200)
+        self.assertEqual(SlotHold.objects.count(), 2)
+        self.assertEqual(third.get(resolve_url('booking:calendar', pk=1)).context['calendar'][9][self.start.date()], 1)
+
+        # 予約済みの1席と、2人の仮押さえで満席になる
+        Schedule.objects.create(staff_id=1, start=self.start, end=self.start + datetime.timedelta(hours=1), name='先の予約')
+        response = third.get(self.url, follow=True)
+        self.assertEqual(str(list(response.context['messages'])[0]), 'すみません、他のお客様が予約の手続き中です。別の日時はどうですか。')
+        self.assertEqual(SlotHold.objects.count(), 2)
+
+        self.other.post(self.url, {'name': 'テスト'})
+        self.assertTrue(Schedule.objects.filter(name='テスト').exists())
+
+    def test_booking_releases_hold(self):
+        """予約すると、仮押さえは解除される"""
+        self.client.get(self.url)
+        self.client.post(self.url, {'name': 'テスト'})
+        self.assertTrue(Schedule.objects.filter(name='テスト').exists())
+        self.assertFalse(SlotHold.objects.exists())
+
+    def slot_url(self, start, hour=None):
+        return resolve_url(
+            'booking:booking', pk=1, year=start.year, month=start.month, day=start.day, hour=start.hour if hour is None else hour
+        )
+
+    def test_invalid_slot(self):
+        """営業時間外の時は404。過去や、予約済み、予約を受け付けない時間の枠は、仮押さえしない"""
+        self.assertEqual(self.client.get(self.slot_url(self.start, hour=24)).status_code, 404)
+        self.assertEqual(self.client.get(self.slot_url(self.start, hour=8)).status_code, 404)
+
+        past = self.start - datetime.timedelta(days=2)
+        response = self.client.get(self.slot_url(past), follow=True)
+        self.assertEqual(str(list(response.context['messages'])[0]), 'この枠は、もう予約できません。')
+
+        Schedule.objects.create(staff_id=1, start=self.start, end=self.start + datetime.timedelta(hours=1), name='予約済み')
+        response = self.client.get(self.url, follow=True)
+        self.assertEqual(str(list(response.context['messages'])[0]), 'すみません、この枠は予約できません。別の日時はどうですか。')
+
+        RecurringBlock.objects.create(staff_id=1, weekday=self.start.weekday(), start_hour=12, end_hour=13)
+        response = self.client.get(self.slot_url(self.start, hour=12), follow=True)
+        self.assertEqual(str(list(response.context['messages'])[0]), 'すみません、この枠は予約できません。別の日時はどうですか。')
+        self.assertFalse(SlotHold.objects.exists())
+
+    def test_one_hold_per_session(self):
+        """別の枠を開くと、前に押さえていた枠は解除される"""
+        self.client.get(self.url)
+        self.client.get(self.slot_url(self.start, hour=10))
+        self.assertEqual(list(SlotHold.objects.values_list('start', flat=True)), [self.start + datetime.timedelta(hours=1)])
+
+    def test_expired(self):
+        """期限切れの仮押さえは無視され、他のお客さんが押さえ直せる"""
+        self.client.get(self.url)
+        SlotHold.objects.update(expires_at=timezone.now())
+        self.assertNotContains(self.other.get(resolve_url('booking:calendar', pk=1)), batu)
+        self.assertEqual(self.other.get(self.url).status_code, 200)
+        self.assertEqual(SlotHold.objects.get().session_key, self.other.session.session_key)
+
+    def test_sweep(self):
+        """期限切れの仮押さえだけを、まとめて削除できる"""
+        now = timezone.now()
+        SlotHold.objects.bulk_create([
+            SlotHold(staff_id=1, start=self.start + datetime.timedelta(hours=i), session_key='a', expires_at=now + datetime.timedelta(minutes=-1 if i % 2 else 1))
+            for i in range(10)
+        ])
+        out = StringIO()
+        call_command('sweep_slot_holds', '--batch-size', '2', stdout=out)
+        self.assertIn('5件の仮押さえを削除しました', out.getvalue())
+        self.assertEqual(SlotHold.objects.count(), 5)
+
+    def test_benchmark(self):
+        """ベンチマークのコマンドが動き、データは残らない"""
+        out = StringIO()
+        call_command('benchmark_holds', '--holds', '100', '--staff', '5', '--repeat', '2', stdout=out)
+        self.assertIn('期限切れの削除: 50件', out.getvalue())
+        self.assertFalse(SlotHold.objects.exists())
+
+
+class ScheduleConflictTests(TestCase):
+    fixtures = ['initial']
+
+    def setUp(self):
+        self.base = timezone.localtime().replace(hour=9, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
+
+    def at(self, minutes):
+        return self.base + datetime.timedelta(minutes=minutes)
+
+    def schedule(self, start, end, staff_id=1, **kwargs):
+        return Schedule(staff_id=staff_id, start=self.at(start), end=self.at(end), name='テスト', **kwargs)
+
+    def test_overlapping(self):
+        """時間帯が重なる予約と、開始日時が同じ予約を、1回のクエリで見つける。隣り合う予約は重ならない"""
+        existing = self.schedule(60, 120)
+        existing.save()
+        cases = [
+            ((0, 60), False), ((120, 180), False), ((0, 61), True), ((119, 180), True),
+            ((70, 80), True), ((0, 300), True), ((60, 60), True), ((90, 90), True), ((120, 120), False),
+        ]
+        for (start, end), expected in cases:
+            with self.subTest(start=start, end=end), self.assertNumQueries(1):
+                self.assertEqual(conflicts.overlapping(1, self.at(start), self.at(end)).exists(), expected)
+        self.assertFalse(conflicts.overlapping(2, self.at(70), self.at(80)).exists())
+        self.assertFalse(conflicts.overlapping(1, self.at(70), self.at(80), exclude_pk=existing.pk).exists())
+
+    def test_batch(self):
+        """重なっている予約や、隣り合う予約をたくさん含む場合でも、総当たりと同じ予約を重なりとして見つける"""
+        rng = random.Random(0)
+        existing = []
+        for _ in range(100):
+            start = rng.randrange(0, 24 * 60, 15)
+            existing.append(self.schedule(start, start + rng.choice([0, 15, 30, 60, 90])))
+        Schedule.objects.bulk_create(existing)
+        existing = list(Schedule.objects.all())
+        new = []
+        for _ in range(200):
+            start = rng.randrange(0, 24 * 60, 15)
+            new.append(self.schedule(start, start + rng.choice([0, 15, 30, 60, 90])))
+
+        def overlap(a, b):
+            return conflicts.intervals_overlap(a.start, a.end, b.start, b.end)
+
+        expected = {id(a) for a in new if any(overlap(a, b) for b in existing + new if b is not a)}
+        found = set()
+        for a, b in conflicts.find_batch_conflicts(new):
+            self.assertTrue(overlap(a, b))
+            found.update(id(schedule) for schedule in (a, b) if schedule in new or schedule.pk is None)
+        self.assertEqual(found, expected)
+
+    def test_batch_adjacent(self):
+        """隣り合うだけの予約は、まとめて書き込める"""
+        self.schedule(0, 60).save()
+        new = [self.schedule(start, start + 60) for start in range(60, 600, 60)]
+        with self.assertNumQueries(1):
+            self.assertEqual(conflicts.find_batch_conflicts(new), [])
+        # 30分から90分の予約は、既存の0分からの予約と、新しい60分からの予約の両方と重なる
+        self.assertEqual(len(conflicts.find_batch_conflicts(new + [self.schedule(30, 90)])), 2)
+
+    def test_booking(self):
+        """途中から始まる予約と重なる場合も、予約できない"""
+        self.schedule(30, 90).save()
+        response = self.client.post(
+            resolve_url('booking:booking', pk=1, year=self.base.year, month=self.base.month, day=self.base.day, hour=9),
+            {'name': 'これは入らない'},
+            follow=True
+        )
+        self.assertEqual(str(list(response.context['messages'])[0]), 'すみません、入れ違いで予約がありました。別の日時はどうですか。')
+        self.assertFalse(Schedule.objects.filter(name='これは入らない').exists())
+
+    def test_my_page_schedule(self):
+        """マイページで、他の予約と重なるように変更はできない"""
+        self.client.login(username='tanakataro', password='helloworld123')
+        self.schedule(0, 60).save()
+        schedule = self.schedule(60, 120)
+        schedule.save()
+        response = self.client.post(
+            resolve_url('booking:my_page_schedule', pk=schedule.pk),
+            {'name': '更新', 'start': self.at(30).strftime('%Y-%m-%d %H:%M:%S'), 'end': self.at(90).strftime('%Y-%m-%d %H:%M:%S')},
+        )
+        self.assertContains(response, 'この時間帯には、既に別の予約があります。')
+        self.assertEqual(Schedule.objects.get(pk=schedule.pk).start, self.at(60))
+
+    def test_holiday_add(self):
+        """予約がある時間は、休暇にできない"""
+        self.client.login(username='tanakataro', password='helloworld123')
+        self.schedule(30, 60).save()
+        response = self.client.post(
+            resolve_url('booking:my_page_holiday_add', pk=1, year=self.base.year, month=self.base.month, day=self.base.day, hour=9),
+            follow=True,
+        )
+        self.assertContains(response, 'この時間には、既に予約があります。')
+        self.assertEqual(Schedule.objects.count(), 1)
+
+    def test_holiday_add_blocked(self):
+        """予約を受け付けない時間を休暇にしようとすると、その旨を表示する"""
+        self.client.login(username='tanakataro', password='helloworld123')
+        RecurringBlock.objects.create(staff_id=1, weekday=self.base.weekday(), start_hour=9, end_hour=10)
+        response = self.client.post(
+            resolve_url('booking:my_page_holiday_add', pk=1, year=self.base.year, month=self.base.month, day=self.base.day, hour=9),
+            follow=True,
+        )
+        self.assertContains(response, 'この時間帯は、予約を受け付けていません。')
+        self.assertNotContains(response, 'この時間には、既に予約があります。')
+        self.assertFalse(Schedule.objects.exists())
+
+    def test_admin(self):
+        """管理サイトからも、重なる予約は追加できない"""
+        self.client.login(username='admin', password='admin123')
+        self.schedule(0, 60).save()
+        local = timezone.localtime(self.at(30))
+        response = self.client.post(resolve_url('admin:booking_schedule_add'), {
+            'start_0': local.strftime('%Y-%m-%d'), 'start_1': local.strftime('%H:%M:%S'),
+            'end_0': local.strftime('%Y-%m-%d'), 'end_1': (local + datetime.timedelta(hours=1)).strftime('%H:%M:%S'),
+            'name': '管理サイト', 'staff': 1,
+        })
+        self.assertContains(response, 'この時間帯には、既に別の予約があります。')
+        self.assertEqual(Schedule.objects.count(), 1)
+
+
+class CapacityTests(TestCase):
+    fixtures = ['initial']
+
+    def setUp(self):
+        self.staff = Staff.objects.get(pk=1)
+        self.staff.capacity = 3
+        self.staff.save()
+        self.start = timezone.localtime().replace(hour=10, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
+        self.url = resolve_url(
+            'booking:booking', pk=1, year=self.start.year, month=self.start.month, day=self.start.day, hour=10,
+        )
+
+    def book(self, name):
+        return Schedule.objects.create(staff=self.staff, start=self.start, end=self.start + datetime.timedelta(hours=1), name=name)
+
+    def test_calendar(self):
+        """定員に達するまでは残りの席数を表示し、満席になると予約済みの枠として数える"""
+        self.book('テスト1')
+        self.book('テスト2')
+        calendar = availability.week_calendar(1, [self.start.date()], capacity=3)
+        self.assertEqual(calendar[10][self.start.date()], 1)
+        self.assertEqual(calendar[11][self.start.date()], 3)
+        self.assertContains(self.client.get(resolve_url('booking:calendar', pk=1)), '残り1席')
+        self.assertFalse(DailyBookingCount.objects.exists())
+
+        self.book('テスト3')
+        self.assertEqual(availability.week_calendar(1, [self.start.date()], capacity=3)[10][self.start.date()], 0)
+        self.assertEqual(list(DailyBookingCount.objects.values_list('staff_id', 'booked')), [(1, 1)])
+        self.assertNotContains(self.client.get(resolve_url('booking:calendar', pk=1)), '残り0席')
+
+    def test_booking(self):
+        """定員までは同じ枠に予約でき、その後は満席になる。予約が削除されれば席数も戻る"""
+        for i in range(3):
+            self.client.post(self.url, {'name': f'テスト{i}'})
+        response = self.client.post(self.url, {'name': 'これは入らない'}, follow=True)
+        self.assertEqual(str(list(response.context['messages'])[0]), 'すみません、入れ違いで予約がありました。別の日時はどうですか。')
+        self.assertEqual(Schedule.objects.filter(staff=self.staff, start=self.start).count(), 3)
+        self.assertEqual(SlotCounter.objects.get(staff=self.staff, start=self.start).booked, 3)
+
+        Schedule.objects.filter(name='テスト0').delete()
+        self.assertEqual(SlotCounter.objects.get(staff=self.staff, start=self.start).booked, 2)
+        self.client.post(self.url, {'name': 'テスト3'})
+        self.assertTrue(Schedule.objects.filter(name='テスト3').exists())
+
+    def test_counter_created_from_schedules(self):
+        """カウンターの行がなくても、今ある予約の数から始める"""
+        Schedule.objects.bulk_create([
+            Schedule(staff=self.staff, start=self.start, end=self.start + datetime.timedelta(hours=1), name=f'テスト{i}')
+            for i in range(3)
+        ])
+        self.assertFalse(capacity.reserve(self.staff, self.start))
+        self.assertEqual(SlotCounter.objects.get(staff=self.staff, start=self.start).booked, 3)
+
+    def test_conflicts(self):
+        """開始と終了が同じ予約だけが、定員まで重なれる"""
+        self.book('テスト1')
+        self.book('テスト2')
+        same = Schedule(staff=self.staff, start=self.start, end=self.start + datetime.timedelta(hours=1), name='テスト')
+        self.assertEqual(conflicts.find_conflicts(same), [])
+        shifted = Schedule(staff=self.staff, start=self.start, end=self.start + datetime.timedelta(minutes=30), name='テスト')
+        self.assertEqual(len(conflicts.find_conflicts(shifted)), 2)
+        self.assertEqual(len(conflicts.find_batch_conflicts([same])), 0)
+        self.assertEqual(len(conflicts.find_batch_conflicts([same, copy.copy(same)])), 2)
+
+    def test_capacity_changed(self):
+        """定員を減らすと、日ごとの集計が作り直される"""
+        self.book('テスト1')
+        self.assertFalse(DailyBookingCount.objects.exists())
+        self.staff.capacity = 1
+        self.staff.save()
+        self.assertEqual(list(DailyBookingCount.objects.values_list('staff_id', 'booked')), [(1, 1)])
+        self.assertContains(self.client.get(resolve_url('booking:calendar', pk=1)), batu)
+
+    def test_holiday(self):
+        """休暇は、定員に関わらず枠の席をすべて使う"""
+        self.client.login(username='tanakataro', password='helloworld123')
+        date = self.start.date()
+        self.client.post(resolve_url('booking:my_page_holiday_add', pk=1, year=date.year, month=date.month, day=date.day, hour=9))
+        self.client.post(resolve_url('booking:my_page_day_bulk', pk=1, year=date.year, month=date.month, day=date.day), {'action': 'close'})
+        self.assertEqual(Schedule.objects.filter(name=Schedule.HOLIDAY_NAME).count(), 9)
+
+        for hour in (9, 10):
+            url = resolve_url('booking:booking', pk=1, year=date.year, month=date.month, day=date.day, hour=hour)
+            self.client.post(url, {'name': 'これは入らない'})
+        self.assertFalse(Schedule.objects.filter(name='これは入らない').exists())
+        self.assertEqual(set(availability.week_calendar(1, [date], capacity=3)[hour][date] for hour in availability.OPEN_HOURS), {0})
+        self.assertEqual(list(DailyBookingCount.objects.values_list('date', 'booked')), [(date, 9)])
+        calendar = self.client.get(resolve_url('booking:calendar', pk=1)).context['calendar']
+        self.assertEqual(set(calendar[hour][date] for hour in availability.OPEN_HOURS), {0})
+
+    def test_holiday_conflicts(self):
+        """予約がある枠は、開始と終了が同じでも休暇にできず、休暇の枠には予約できない"""
+        self.book('テスト1')
+        end = self.start + datetime.timedelta(hours=1)
+        holiday = Schedule(staff=self.staff, start=self.start, end=end, name=Schedule.HOLIDAY_NAME)
+        self.assertEqual(len(conflicts.find_conflicts(holiday)), 1)
+        self.assertEqual(len(conflicts.find_batch_conflicts([holiday])), 1)
+        Schedule.objects.all().delete()
+        holiday.save()
+        self.assertEqual(len(conflicts.find_conflicts(Schedule(staff=self.staff, start=self.start, end=end, name='テスト'))), 1)
+
+    def test_admin_holiday(self):
+        """管理サイトからも、予約がある枠には、定員に空きがあっても休暇を追加できない"""
+        self.book('テスト1')
+        self.client.login(username='admin', password='admin123')
+        local = timezone.localtime(self.start)
+        response = self.client.post(resolve_url('admin:booking_schedule_add'), {
+            'start_0': local.strftime('%Y-%m-%d'), 'start_1': local.strftime('%H:%M:%S'),
+            'end_0': local.strftime('%Y-%m-%d'), 'end_1': (local + datetime.timedelta(hours=1)).strftime('%H:%M:%S'),
+            'name': Schedule.HOLIDAY_NAME, 'staff': 1,
+        })
+        self.assertContains(response, 'この時間帯には、既に別の予約があります。')
+        self.assertEqual(Schedule.objects.count(), 1)
+
+    def test_capacity_changed_delta(self):
+        """定員が変わった後は、差分カレンダーもカレンダー全体を返す"""
+        url = resolve_url('booking:calendar_delta', pk=1)
+        version = self.client.get(url).json()['version']
+        self.book('テスト1')
+        self.staff.capacity = 1
+        self.staff.save()
+        self.book('テスト2')
+        data = self.client.get(url, {'since': version}).json()
+        self.assertTrue(data['full'])
+        self.assertIn({'date': self.start.date().isoformat(), 'hour': 10, 'booked': True, 'remaining': 0}, data['cells'])
+
+
+def _book_slot(path, url, name, barrier):
+    """別のワーカープロセスとして、ファイルのデータベースに予約する"""
+    # 親プロセスの接続は使わず、コピーしたデータベースのファイルに接続し直す
+    connection.connection = None
+    connection.settings_dict['NAME'] = path
+    barrier.wait()
+    response = Client().post(url, {'name': name})
+    if response.status_code != 302:
+        raise AssertionError(response.status_code)
+
+
+class CapacityConcurrencyTests(TransactionTestCase):
+    fixtures = ['initial']
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'db.sqlite3')
+        setting = override_settings(BOOKING_COHERENCE_DB=os.path.join(directory.name, 'coherence.sqlite3'), CACHES=LOCMEM_CACHES)
+        setting.enable()
+        self.addCleanup(setting.disable)
+
+    def test_hammer(self):
+        """定員より多いお客さんが同時に同じ枠を予約しても、定員を超えない"""
+        Staff.objects.filter(pk=1).update(capacity=3)
+        start = timezone.localtime().replace(hour=10, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
+        url = resolve_url('booking:booking', pk=1, year=start.year, month=start.month, day=start.day, hour=10)
+        # テスト用のデータベースはメモリ上にあるので、他のプロセスからも使えるようにファイルにコピーする
+        connection.ensure_connection()
+        target = sqlite3.connect(self.path)
+        connection.connection.backup(target)
+        target.close()
+
+        context = multiprocessing.get_context('fork')
+        barrier = context.Barrier(10)
+        processes = [context.Process(target=_book_slot, args=(self.path, url, f'テスト{i}', barrier)) for i in range(10)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+
+        with closing(sqlite3.connect(self.path)) as db:
+            self.assertEqual(db.execute('SELECT COUNT(*) FROM booking_schedule WHERE staff_id = 1').fetchone(), (3,))
+            self.assertEqual(db.execute('SELECT booked FROM booking_slotcounter WHERE staff_id = 1').fetchall(), [(3,)])
+            self.assertEqual(db.execute('SELECT booked FROM booking_dailybookingcount WHERE staff_id = 1').fetchall(), [(1,)])
+
+
+class RecurringBlockTests(TestCase):
+    fixtures = ['initial']
+
+    def setUp(self):
+        self.tomorrow = timezone.localdate() + datetime.timedelta(days=1)
+        self.sunday = self.tomorrow + datetime.timedelta(days=(6 - self.tomorrow.weekday()) % 7)
+        # 日曜日以外の、昼休みの設定がある日
+        self.weekday = self.tomorrow if self.tomorrow != self.sunday else self.tomorrow + datetime.timedelta(days=1)
+
+    def add_blocks(self):
+        # 毎週日曜は休み(除外日あり)、平日の昼休みは2週間後まで
+        sunday = RecurringBlock.objects.create(staff_id=1, name='定休日', weekday=6, start_hour=0, end_hour=24)
+        RecurringBlockException.objects.create(block=sunday, date=self.sunday + datetime.timedelta(days=7))
+        RecurringBlock.objects.create(
+            staff_id=1, name='昼休み', start_hour=12, end_hour=13,
+            start_date=self.tomorrow, end_date=self.tomorrow + datetime.timedelta(days=14),
+        )
+
+    def test_same_as_materialized(self):
+        """繰り返しの設定は、1時間ごとに休暇の予約を入れた場合と同じカレンダーになる"""
+        weeks = [[self.tomorrow + datetime.timedelta(days=7 * week + day) for day in range(7)] for week in range(5)]
+        self.add_blocks()
+        expected = [availability.week_calendar(1, days) for days in weeks]
+        self.assertEqual(RecurringBlock.objects.count(), 2)
+
+        dates = [day for days in weeks for day in days]
+        blocked = recurrence.blocked_slots(1, dates)
+        RecurringBlock.objects.all().delete()
+        Schedule.objects.bulk_create([
+            Schedule(
+                staff_id=1, name='休暇', start=timezone.make_aware(datetime.datetime.combine(date, datetime.time(hour))),
+                end=timezone.make_aware(datetime.datetime.combine(date, datetime.time(hour))) + datetime.timedelta(hours=1),
+            )
+            for date, hour in blocked
+        ])
+        self.assertGreater(Schedule.objects.count(), 100)
+        self.assertEqual([availability.week_calendar(1, days) for days in weeks], expected)
+        self.assertFalse(expected[0][9][self.sunday])
+        self.assertTrue(expected[1][9][self.sunday + datetime.timedelta(days=7)])
+
+    def test_booking(self):
+        """繰り返しの設定で受け付けない時間は、予約できない"""
+        self.add_blocks()
+        date = self.weekday
+        response = self.client.post(
+            resolve_url('booking:booking', pk=1, year=date.year, month=date.month, day=date.day, hour=12),
+            {'name': 'これは入らない'},
+            follow=True,
+        )
+        self.assertEqual(str(list(response.context['messages'])[0]), 'すみません、入れ違いで予約がありました。別の日時はどうですか。')
+        self.assertFalse(Schedule.objects.exists())
+
+        start = timezone.make_aware(datetime.datetime.combine(date, datetime.time(11, 30)))
+        with self.assertRaisesMessage(conflicts.ScheduleConflict, 'この時間帯は、予約を受け付けていません。'):
+            conflicts.save_schedule(Schedule(staff_id=1, start=start, end=start + datetime.timedelta(minutes=30, seconds=1)))
+        conflicts.save_schedule(Schedule(staff_id=1, start=start, end=start + datetime.timedelta(minutes=30)))
+
+    def test_calendar(self):
+        """設定を追加・削除すると、キャッシュしていたカレンダーにもすぐ反映される"""
+        date = self.tomorrow
+        url = resolve_url('booking:calendar', pk=1, year=date.year, month=date.month, day=date.day)
+        self.assertTrue(self.client.get(url).context['calendar'][12][date])
+        block = RecurringBlock.objects.create(staff_id=1, start_hour=12, end_hour=14)
+        calendar = self.client.get(url).context['calendar']
+        self.assertFalse(calendar[12][date])
+        self.assertFalse(calendar[13][date])
+        self.assertTrue(calendar[14][date])
+        RecurringBlockException.objects.create(block=block, date=date)
+        self.assertTrue(self.client.get(url).context['calendar'][12][date])
+
+    def test_delta(self):
+        """設定が変わったら、差分カレンダーはカレンダー全体を送り直す"""
+        url = resolve_url('booking:calendar_delta', pk=1)
+        version = self.client.get(url).json()['version']
+        RecurringBlock.objects.create(staff_id=1, start_hour=12, end_hour=13)
+        data = self.client.get(url, {'since': version}).json()
+        self.assertTrue(data['full'])
+        self.assertEqual(len([cell for cell in data['cells'] if cell['booked']]), 7)
+
+    def test_day_detail(self):
+        """マイページの日ごとの予約一覧では、設定で受け付けない時間は休暇にできない"""
+        self.client.login(username='tanakataro', password='helloworld123')
+        self.add_blocks()
+        date = self.sunday
+        response = self.client.get(resolve_url('booking:my_page_day_detail', pk=1, year=date.year, month=date.month, day=date.day))
+        self.assertContains(response, '定休日(繰り返し)', count=9)
+        self.assertNotContains(response, '<button type="submit">休暇にする</button>')
+
+    def test_invalid_hours(self):
+        """開始時が終了時より後の設定は保存できない"""
+        with self.assertRaises(ValidationError):
+            RecurringBlock(staff_id=1, start_hour=13, end_hour=12).full_clean()
+
+
+class SamplingProfilerTests(TestCase):
+    fixtures = ['initial']
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_disabled(self):
+        """計測する割合が0なら、ミドルウェアを使わない"""
+        with self.settings(BOOKING_PROFILE_RATE=0), self.assertRaises(MiddlewareNotUsed):
+            SamplingProfilerMiddleware(lambda request: None)
+
+    def test_profile(self):
+        """URL名ごとに計測結果をファイルに書き出し、古いファイルは削除する。コマンドで関数の一覧を表示できる"""
+        with self.settings(
+            BOOKING_PROFILE_RATE=1, BOOKING_PROFILE_DIR=self.directory, BOOKING_PROFILE_FLUSH_EVERY=2, BOOKING_PROFILE_KEEP=2,
+        ):
+            for _ in range(7):
+                self.client.get(resolve_url('booking:calendar', pk=1))
+            self.client.get(resolve_url('booking:store_list'))
+            self.assertEqual(sorted(os.listdir(self.directory)), ['booking.calendar'])
+            self.assertEqual(len(os.listdir(os.path.join(self.directory, 'booking.calendar'))), 2)
+
+            out = StringIO()
+            call_command('profile_report', 'booking:calendar', limit=100, stdout=out)
+        self.assertIn('booking:calendar (2ファイル)', out.getvalue())
+        self.assertIn('get_context_data', out.getvalue())
+
+
+class MetricsTests(TestCase):
+    fixtures = ['initial']
+
+    def scrape(self):
+        """/metrics を取得して、{サンプル名とラベル: 値} にする"""
+        response = self.client.get(resolve_url('booking:metrics'))
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        samples = {}
+        for line in response.content.decode().splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_histogram(self):
+        """バケットの件数は累積で出力する"""
+        histogram = metrics.Histogram('test_seconds', 'テスト', ['view'], buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, view='a"b')
+        key, value = histogram.snapshot()[0]
+        self.assertEqual([
+            f'{name}{metrics.format_labels(names, values)} {metrics.format_value(sample)}'
+            for name, names, values, sample in histogram.samples(tuple(key), value)
+        ], [
+            'test_seconds_bucket{view="a\\"b",le="0.1"} 2',
+            'test_seconds_bucket{view="a\\"b",le="1"} 3',
+            'test_seconds_bucket{view="a\\"b",le="+Inf"} 4',
+            'test_seconds_sum{view="a\\"b"} 3.65',
+            'test_seconds_count{view="a\\"b"} 4',
+        ])
+
+    def test_requests(self):
+        """URL名ごとの処理時間とSQLの実行時間、キャッシュと予約の結果を数える"""
+        count = 'booking_request_duration_seconds_count{view="booking:calendar"}'
+        sql_count = 'booking_request_sql_duration_seconds_count{view="booking:calendar"}'
+        success = 'booking_bookings_total{result="success"}'
+        conflict = 'booking_bookings_total{result="conflict"}'
+        # テストはトランザクションの中で動くので、キャッシュは使わずにbypassとして数えられる
+        bypass = 'booking_cache_requests_total{cache="local",result="bypass"}'
+        before = self.scrape()
+
+        self.client.get(resolve_url('booking:calendar', pk=1))
+        self.client.get(resolve_url('booking:calendar', pk=1))
+        start = timezone.localtime() + datetime.timedelta(days=1)
+        url = resolve_url('booking:booking', pk=1, year=start.year, month=start.month, day=start.day, hour=9)
+        self.client.post(url, {'name': 'テスト'})
+        Schedule.objects.filter(name='テスト').update(start=timezone.now())
+        Schedule.objects.create(
+            staff_id=1, name='入れ違い', start=timezone.make_aware(datetime.datetime(start.year, start.month, start.day, 9)),
+            end=timezone.make_aware(datetime.datetime(start.year, start.month, start.day, 10)),
+        )
+        self.client.post(url, {'name': 'テスト'})
+
+        after = self.scrape()
+        self.assertEqual(after[count] - before.get(count, 0), 2)
+        self.assertEqual(after[sql_count] - before.get(sql_count, 0), 2)
+        self.assertGreater(after['booking_request_sql_duration_seconds_sum{view="booking:calendar"}'], 0)
+        self.assertEqual(after[success] - before.get(success, 0), 1)
+        self.assertEqual(after[conflict] - before.get(conflict, 0), 1)
+        self.assertGreaterEqual(after[bypass] - before.get(bypass, 0), 2)
+
+    def test_shared(self):
+        """BOOKING_METRICS_DIRを指定すると、他のプロセスが書き出した計測値も合計する"""
+        with tempfile.TemporaryDirectory() as directory, self.settings(BOOKING_METRICS_DIR=directory):
+            with open(os.path.join(directory, '1.json'), 'w') as f:
+                f.write('{"booking_holidays_added_total": [[[], 1000]]}')
+            before = self.scrape()['booking_holidays_added_total']
+            self.assertGreaterEqual(before, 1000)
+
+            self.client.login(username='tanakataro', password='helloworld123')
+            date = timezone.localdate() + datetime.timedelta(days=1)
+            self.client.post(resolve_url('booking:my_page_holiday_add', pk=1, year=date.year, month=date.month, day=date.day, hour=9))
+            self.assertEqual(self.scrape()['booking_holidays_added_total'], before + 1)
+            self.assertIn(f'{os.getpid()}.json', os.listdir(directory))
+
+    def test_dead_process(self):
+        """終了したプロセスのファイルは、計測値をdead.jsonに合計してから削除する"""
+        process = multiprocessing.get_context('fork').Process(target=os.getpid)
+        process.start()
+        process.join()
+        with tempfile.TemporaryDirectory() as directory, self.settings(BOOKING_METRICS_DIR=directory):
+            before = self.scrape()['booking_holidays_added_total']
+            with open(os.path.join(directory, f'{process.pid}.json'), 'w') as f:
+                f.write('{"booking_holidays_added_total": [[[], 1000]]}')
+            self.assertEqual(self.scrape()['booking_holidays_added_total'], before + 1000)
+            self.assertNotIn(f'{process.pid}.json', os.listdir(directory))
+            self.assertIn(metrics.DEAD_SNAPSHOT_NAME, os.listdir(directory))
+            self.assertEqual(self.scrape()['booking_holidays_added_total'], before + 1000)
+
+
+class IdempotencyTests(TestCase):
+    fixtures = ['initial']
+
+    def setUp(self):
+        self.start = timezone.localtime() + datetime.timedelta(days=1)
+        self.url = resolve_url(
+            'booking:booking', pk=1, year=self.start.year, month=self.start.month, day=self.start.day, hour=9,
+        )
+
+    def test_form(self):
+        """予約ページのフォームには、キーが埋め込まれている"""
+        response = self.client.get(self.url)
+        self.assertRegex(response.content.decode(), r'name="idempotency_key" value="[0-9a-f]{32}"')
+
+    def test_double_submit(self):
+        """同じキーで送信し直しても、予約は1件だけで、2回目は予約テーブルに触れずに同じ結果を返す"""
+        first = self.client.post(self.url, {'name': 'テスト', 'idempotency_key': 'a' * 32})
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.post(self.url, {'name': 'テスト', 'idempotency_key': 'a' * 32})
+        self.assertEqual(second.url, first.url)
+        self.assertFalse([query for query in queries if 'booking_schedule' in query['sql']])
+        self.assertEqual(Schedule.objects.count(), 1)
+        self.assertEqual(IdempotencyKey.objects.get().outcome, 'success')
+
+        self.client.post(self.url, {'name': 'テスト', 'idempotency_key': 'b' * 32})
+        self.assertEqual(Schedule.objects.count(), 1)
+        self.assertEqual(IdempotencyKey.objects.get(key='b' * 32).outcome, 'conflict')
+
+    def test_header(self):
+        """Idempotency-Keyヘッダでもキーを送れる。入れ違いになった結果も、同じメッセージで返す"""
+        Schedule.objects.create(
+            staff_id=1, name='先の予約', start=timezone.make_aware(datetime.datetime(self.start.year, self.start.month, self.start.day, 9)),
+            end=timezone.make_aware(datetime.datetime(self.start.year, self.start.month, self.start.day, 10)),
+        )
+        for _ in range(2):
+            response = self.client.post(self.url, {'name': 'テスト'}, HTTP_IDEMPOTENCY_KEY='c' * 32, follow=True)
+            self.assertEqual(str(list(response.context['messages'])[0]), 'すみません、入れ違いで予約がありました。別の日時はどうですか。')
+        self.assertEqual(IdempotencyKey.objects.count(), 1)
+
+    def test_expired_key(self):
+        """期限切れのキーは、削除される前でも結果を返さず、新しい送信として扱う"""
+        self.client.post(self.url, {'name': 'テスト', 'idempotency_key': 'e' * 32})
+        IdempotencyKey.objects.update(expires_at=timezone.now())
+        Schedule.objects.all().delete()
+        self.client.post(self.url, {'name': 'テスト', 'idempotency_key': 'e' * 32})
+        self.assertEqual(Schedule.objects.count(), 1)
+        self.assertGreater(IdempotencyKey.objects.get().expires_at, timezone.now())
+
+    def test_other_slot(self):
+        """別の枠に同じキーで送信すると、最初の枠の結果は返さずに拒否する"""
+        self.client.post(self.url, {'name': 'テスト', 'idempotency_key': 'f' * 32})
+        other_url = resolve_url(
+            'booking:booking', pk=1, year=self.start.year, month=self.start.month, day=self.start.day, hour=10,
+        )
+        response = self.client.post(other_url, {'name': 'テスト', 'idempotency_key': 'f' * 32})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Schedule.objects.count(), 1)
+
+    def test_invalid(self):
+        """入力エラーの場合はキーを残さず、直して送り直せる"""
+        response = self.client.post(self.url, {'name': '', 'idempotency_key': 'd' * 32})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.client.post(self.url, {'name': 'テスト', 'idempotency_key': 'd' * 32})
+        self.assertEqual(Schedule.objects.count(), 1)
+
+    def test_expire(self):
+        """期限切れのキーをまとめて削除する"""
+        now = timezone.now()
+        IdempotencyKey.objects.bulk_create([
+            IdempotencyKey(key=f'{i:032d}', expires_at=now + datetime.timedelta(hours=-1 if i < 5 else 1)) for i in range(8)
+        ])
+        out = StringIO()
+        call_command('expire_idempotency_keys', batch_size=2, stdout=out)
+        self.assertIn('5件のキーを削除しました', out.getvalue())
+        self.assertEqual(IdempotencyKey.objects.count(), 3)
+
+
+class WaitlistTests(TestCase):
+    fixtures = ['initial']
+
+    def setUp(self):
+        self.date = timezone.localdate() + datetime.timedelta(days=1)
+        self.start = timezone.make_aware(datetime.datetime.combine(self.date, datetime.time(9)))
+        self.schedule = Schedule.objects.create(
+            staff_id=1, start=self.start, end=self.start + datetime.timedelta(hours=1), name='テスト',
+        )
+        self.url = resolve_url('booking:waitlist', pk=1, year=self.date.year, month=self.date.month, day=self.date.day, hour=9)
+
+    def register(self, *names):
+        for name in names:
+            self.client.post(self.url, {'name': name, 'email': f'{name}@example.com'})
+
+    def test_calendar(self):
+        """埋まっている枠から、空き待ちの登録ページへ行ける"""
+        response = self.client.get(resolve_url('booking:calendar', pk=1))
+        self.assertContains(response, f'<a href="{self.url}" title="空き待ちに登録">×</a>', html=True)
+        self.assertContains(self.client.get(self.url), f'{self.date.month}月{self.date.day}日 9時の空き待ちに登録')
+
+    def test_register(self):
+        """空き待ちに登録する。同じメールアドレスでは登録できず、空いている枠は予約ページに案内する"""
+        response = self.client.post(self.url, {'name': 'a', 'email': 'a@example.com'}, follow=True)
+        self.assertContains(response, '空き待ちに登録しました。')
+        response = self.client.post(self.url, {'name': 'a', 'email': 'a@example.com'}, follow=True)
+        self.assertContains(response, 'このメールアドレスは、既に空き待ちに登録されています。')
+        self.assertEqual(WaitlistEntry.objects.count(), 1)
+
+        url = resolve_url('booking:waitlist', pk=1, year=self.date.year, month=self.date.month, day=self.date.day, hour=10)
+        response = self.client.post(url, {'name': 'b', 'email': 'b@example.com'})
+        self.assertRedirects(response, resolve_url(
+            'booking:booking', pk=1, year=self.date.year, month=self.date.month, day=self.date.day, hour=10,
+        ))
+
+    def test_delete(self):
+        """予約が削除されたら、一番先に登録した人だけを通知待ちにし、メールは後でまとめて送る"""
+        self.register('a', 'b', 'c')
+        self.client.login(username='tanakataro', password='helloworld123')
+        self.client.post(resolve_url('booking:my_page_schedule_delete', pk=self.schedule.pk))
+        self.assertEqual(
+            list(WaitlistEntry.objects.order_by('pk').values_list('name', 'status')),
+            [('a', 'pending'), ('b', 'waiting'), ('c', 'waiting')],
+        )
+        self.assertEqual(mail.outbox, [])
+
+        out = StringIO()
+        call_command('dispatch_waitlist', stdout=out)
+        self.assertIn('1件の空きを知らせました', out.getvalue())
+        self.assertEqual(mail.outbox[0].to, ['a@example.com'])
+        self.assertIn('http://127.0.0.1:8000' + resolve_url(
+            'booking:booking', pk=1, year=self.date.year, month=self.date.month, day=self.date.day, hour=9,
+        ), mail.outbox[0].body)
+        self.assertEqual(WaitlistEntry.objects.get(name='a').status, 'notified')
+
+    def test_edit(self):
+        """予約の時間が変更されて空いた場合も、通知待ちにする。他の予約がある間は空いていない"""
+        self.register('a')
+        other = Schedule.objects.create(staff_id=1, start=self.start + datetime.timedelta(minutes=30), end=self.start, name='別')
+        self.schedule.start += datetime.timedelta(hours=2)
+        self.schedule.end += datetime.timedelta(hours=2)
+        self.schedule.save()
+        self.assertEqual(WaitlistEntry.objects.get().status, 'waiting')
+        other.delete()
+        self.assertEqual(WaitlistEntry.objects.get().status, 'pending')
+
+    def test_rebooked(self):
+        """送る前にまた予約が入った場合は、送らずに空き待ちに戻す"""
+        self.register('a', 'b')
+        self.schedule.delete()
+        Schedule.objects.create(staff_id=1, start=self.start, end=self.start, name='先に予約')
+        call_command('dispatch_waitlist', stdout=StringIO())
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(
+            list(WaitlistEntry.objects.order_by('pk').values_list('name', 'status')), [('a', 'waiting'), ('b', 'waiting')],
+        )
+
+    def test_batch(self):
+        """通知待ちの人を、batch_size件ずつまとめて送る"""
+        for hour in range(10, 15):
+            start = self.start.replace(hour=hour)
+            WaitlistEntry.objects.create(staff_id=1, start=start, name='a', email='a@example.com', status='pending')
+        out = StringIO()
+        call_command('dispatch_waitlist', batch_size=2, stdout=out)
+        self.assertIn('5件の空きを知らせました', out.getvalue())
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertFalse(WaitlistEntry.objects.exclude(status='notified').exists())
+
+
 class MyPageViewTests(TestCase):
     fixtures = ['initial']
 
@@ -362,6 +1766,89 @@ class MyPageDayDetailViewTests(TestCase):
         self.assertNotContains(response, 'テスト')
 
 
+class MyPageDayBulkTests(TestCase):
+    fixtures = ['initial']
+
+    def setUp(self):
+        self.client.login(username='tanakataro', password='helloworld123')
+        self.date = timezone.localdate() + datetime.timedelta(days=1)
+        self.url = resolve_url('booking:my_page_day_bulk', pk=1, year=self.date.year, month=self.date.month, day=self.date.day)
+
+    def at(self, hour, minute=0):
+        return timezone.make_aware(datetime.datetime.combine(self.date, datetime.time(hour, minute)))
+
+    def add(self, hour, staff_id=1, minute=0, name='テスト'):
+        return Schedule.objects.create(staff_id=staff_id, start=self.at(hour, minute), end=self.at(hour + 1, minute), name=name)
+
+    def test_clear(self):
+        """その日の予約をすべて削除する。予約の数によらず、同じ数のクエリで済む"""
+        self.add(9)
+        with CaptureQueriesContext(connection) as one:
+            self.client.post(self.url, {'action': 'clear'}, follow=True)
+
+        for hour in availability.OPEN_HOURS:
+            self.add(hour)
+        self.add(9, staff_id=3)
+        next_day = self.add(9)
+        next_day.start += datetime.timedelta(days=1)
+        next_day.end += datetime.timedelta(days=1)
+        next_day.save()
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.post(self.url, {'action': 'clear'}, follow=True)
+        self.assertContains(response, '9件の予約を削除しました。')
+        self.assertEqual(len(many), len(one))
+        self.assertEqual(Schedule.objects.count(), 2)
+        self.assertFalse(DailyBookingCount.objects.filter(staff_id=1, date=self.date).exists())
+        changes = ScheduleChange.objects.filter(staff_id=1, version=Staff.objects.get(pk=1).calendar_version)
+        self.assertEqual(changes.filter(date=self.date, booked=False).count(), 9)
+
+    def test_close(self):
+        """空いている時間を、1回のリクエストですべて休暇にする"""
+        self.add(10, minute=30)
+        RecurringBlock.objects.create(staff_id=1, start_hour=12, end_hour=13)
+        before = metrics.registry.collect()['booking_holidays_added_total'].get((), 0)
+        response = self.client.post(self.url, {'action': 'close'}, follow=True)
+        self.assertContains(response, '6件の休暇を追加しました。')
+        self.assertEqual(metrics.registry.collect()['booking_holidays_added_total'][()], before + 6)
+        holidays = Schedule.objects.filter(name='休暇(システムによる追加)').order_by('start')
+        self.assertEqual([timezone.localtime(holiday.start).hour for holiday in holidays], [9, 13, 14, 15, 16, 17])
+        self.assertEqual(DailyBookingCount.objects.get(staff_id=1, date=self.date).booked, 7)
+        self.assertContains(self.client.post(self.url, {'action': 'close'}, follow=True), '0件の休暇を追加しました。')
+
+    def test_move(self):
+        """休暇以外の予約を、同じ店舗の別のスタッフに移す"""
+        self.client.login(username='admin', password='admin123')
+        for hour in (9, 10):
+            self.add(hour)
+        self.add(11, name='休暇(システムによる追加)')
+        response = self.client.post(self.url, {'action': 'move', 'to_staff': 3}, follow=True)
+        self.assertContains(response, '2件の予約をじゃばさんに移動しました。')
+        self.assertEqual(Schedule.objects.filter(staff_id=3).count(), 2)
+        self.assertEqual(Schedule.objects.filter(staff_id=1).count(), 1)
+        self.assertEqual(DailyBookingCount.objects.get(staff_id=3, date=self.date).booked, 2)
+        self.assertEqual(DailyBookingCount.objects.get(staff_id=1, date=self.date).booked, 1)
+
+    def test_move_conflict(self):
+        """移動先に重なる予約があれば、何も移さない"""
+        self.client.login(username='admin', password='admin123')
+        for hour in (9, 10):
+            self.add(hour)
+        self.add(10, staff_id=3, minute=30)
+        response = self.client.post(self.url, {'action': 'move', 'to_staff': 3}, follow=True)
+        self.assertContains(response, 'じゃばさんに、重なる予約があるため移動できませんでした。')
+        self.assertEqual(Schedule.objects.filter(staff_id=1).count(), 2)
+
+    def test_permission(self):
+        """他のスタッフの日や、他の店舗のスタッフ、自分の担当でないスタッフへの移動は操作できない"""
+        self.add(9)
+        self.client.login(username='yosidaziro', password='helloworld123')
+        self.assertEqual(self.client.post(self.url, {'action': 'clear'}).status_code, 403)
+        self.client.login(username='tanakataro', password='helloworld123')
+        self.assertEqual(self.client.post(self.url, {'action': 'move', 'to_staff': 2}).status_code, 404)
+        self.assertEqual(self.client.post(self.url, {'action': 'move', 'to_staff': 3}).status_code, 403)
+        self.assertEqual(Schedule.objects.filter(staff_id=1).count(), 1)
+
+
 class MyPageScheduleViewTests(TestCase):
     fixtures = ['initial']
 
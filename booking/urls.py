@@ -8,16 +8,27 @@ urlpatterns = [
     path('', views.StoreList.as_view(), name='store_list'),
     path('login/', LoginView.as_view(template_name='admin/login.html'), name='login'),
     path('logout/', LogoutView.as_view(), name='logout'),
+    path('search/', views.DirectorySearch.as_view(), name='search'),
+    path('metrics', views.metrics_view, name='metrics'),
     path('store/<int:pk>/staffs/', views.StaffList.as_view(), name='staff_list'),
+    path('store/<int:pk>/month/', views.StoreMonthCalendar.as_view(), name='store_month'),
+    path('store/<int:pk>/month/<int:year>/<int:month>/', views.StoreMonthCalendar.as_view(), name='store_month'),
     path('staff/<int:pk>/calendar/', views.StaffCalendar.as_view(), name='calendar'),
     path('staff/<int:pk>/calendar/<int:year>/<int:month>/<int:day>/', views.StaffCalendar.as_view(), name='calendar'),
+    path('staff/<int:pk>/month/', views.StaffMonthCalendar.as_view(), name='staff_month'),
+    path('staff/<int:pk>/month/<int:year>/<int:month>/', views.StaffMonthCalendar.as_view(), name='staff_month'),
+    path('staff/<int:pk>/calendar/delta/', views.calendar_delta, name='calendar_delta'),
+    path('staff/<int:pk>/calendar/<int:year>/<int:month>/<int:day>/delta/', views.calendar_delta, name='calendar_delta'),
+    path('staff/<int:pk>/calendar/events/', views.calendar_events, name='calendar_events'),
     path('staff/<int:pk>/booking/<int:year>/<int:month>/<int:day>/<int:hour>/', views.Booking.as_view(), name='booking'),
+    path('staff/<int:pk>/waitlist/<int:year>/<int:month>/<int:day>/<int:hour>/', views.WaitlistRegister.as_view(), name='waitlist'),
 
     path('mypage/', views.MyPage.as_view(), name='my_page'),
     path('mypage/<int:pk>/', views.MyPageWithPk.as_view(), name='my_page_with_pk'),
     path('mypage/<int:pk>/calendar/', views.MyPageCalendar.as_view(), name='my_page_calendar'),
     path('mypage/<int:pk>/calendar/<int:year>/<int:month>/<int:day>/', views.MyPageCalendar.as_view(), name='my_page_calendar'),
     path('mypage/<int:pk>/config/<int:year>/<int:month>/<int:day>/', views.MyPageDayDetail.as_view(), name='my_page_day_detail'),
+    path('mypage/<int:pk>/config/<int:year>/<int:month>/<int:day>/bulk/', views.my_page_day_bulk, name='my_page_day_bulk'),
     path('mypage/schedule/<int:pk>/', views.MyPageSchedule.as_view(), name='my_page_schedule'),
     path('mypage/schedule/<int:pk>/delete/', views.MyPageScheduleDelete.as_view(), name='my_page_schedule_delete'),
     path('mypage/holiday/add/<int:pk>/<int:year>/<int:month>/<int:day>/<int:hour>/', views.my_page_holiday_add, name='my_page_holiday_add'),
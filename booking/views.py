@@ -3,14 +3,18 @@ from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import get_user_model
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
+from django.core import signing
 from django.core.exceptions import PermissionDenied
+from django.db import IntegrityError, transaction
 from django.db.models import Q
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.urls import reverse_lazy
 from django.utils import timezone
 from django.views import generic
 from django.views.decorators.http import require_POST
-from .models import Store, Staff, Schedule
+from . import availability, capacity, coherence, conflicts, day_actions, events, holds, idempotency, metrics, recurrence, search, waitlist
+from .models import Store, Staff, Schedule, WaitlistEntry
 
 User = get_user_model()
 
@@ -38,32 +42,121 @@ class OnlyUserMixin(UserPassesTestMixin):
         return self.kwargs['pk'] == self.request.user.pk or self.request.user.is_superuser
 
 
-class StoreList(generic.ListView):
+def keyset_filter(ordering, values):
+    """並び順ordering(例: ['name', 'pk'])で、valuesの行より後ろにある行を絞り込むQを作る"""
+    condition = Q()
+    for i, field in enumerate(ordering):
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        q = Q(**{f'{field.lstrip("-")}__{lookup}': values[i]})
+        for previous, value in zip(ordering[:i], values):
+            q &= Q(**{previous.lstrip('-'): value})
+        condition |= q
+    return condition
+
+
+class KeysetPaginationMixin:
+    """OFFSETを使わず、前のページの最後の行を起点に次のページを取得するページネーション。
+
+    並び順と同じインデックスがあれば、何ページ目でも同じ速さで表示できる。
+    次ページの起点は、署名付きの文字列としてGETパラメータ「after」で渡す。
+    """
+    keyset_ordering = ('name', 'pk')
+    page_size = 50
+
+    def get_keyset_ordering(self):
+        return self.keyset_ordering
+
+    def get_cursor_values(self, ordering):
+        cursor = self.request.GET.get('after')
+        if not cursor:
+            return None
+        try:
+            values = signing.loads(cursor, salt='booking.keyset')
+        except signing.BadSignature:
+            return None
+        if not isinstance(values, list) or len(values) != len(ordering):
+            return None
+        return values
+
+    def get_context_data(self, **kwargs):
+        ordering = self.get_keyset_ordering()
+        queryset = self.object_list.order_by(*ordering)
+        values = self.get_cursor_values(ordering)
+        if values is not None:
+            queryset = queryset.filter(keyset_filter(ordering, values))
+
+        # 1件多く取得して、次のページがあるかを判定する
+        object_list = list(queryset[:self.page_size + 1])
+        has_next = len(object_list) > self.page_size
+        object_list = object_list[:self.page_size]
+        context = super().get_context_data(object_list=object_list, **kwargs)
+        context[self.get_context_object_name(self.object_list)] = object_list
+        if has_next:
+            last = object_list[-1]
+            query = self.request.GET.copy()
+            query['after'] = signing.dumps(
+                [getattr(last, field.lstrip('-')) for field in ordering], salt='booking.keyset'
+            )
+            context['next_query'] = query.urlencode()
+        return context
+
+
+class StoreList(KeysetPaginationMixin, generic.ListView):
     model = Store
-    ordering = 'name'
 
 
-class StaffList(generic.ListView):
+class StaffList(KeysetPaginationMixin, generic.ListView):
+    """店舗のスタッフ一覧。
+
+    ?sort=free で直近1週間の空き枠が多い順に、?min_free=数値 で空き枠がその数以上のスタッフに絞り込める。
+    """
     model = Staff
-    ordering = 'name'
+
+    def get_keyset_ordering(self):
+        if self.request.GET.get('sort') == 'free':
+            return ('-free_slots', 'name', 'pk')
+        return super().get_keyset_ordering()
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['store'] = self.store
+        context['sort'] = self.request.GET.get('sort', '')
         return context
 
     def get_queryset(self):
         store = self.store = get_object_or_404(Store, pk=self.kwargs['pk'])
         queryset = super().get_queryset().filter(store=store)
+        queryset = availability.with_free_slots(queryset, *availability.bookable_week())
+        min_free = self.request.GET.get('min_free', '')
+        if min_free.isdigit():
+            queryset = queryset.filter(free_slots__gte=int(min_free))
         return queryset
 
 
+class DirectorySearch(generic.TemplateView):
+    """店名・スタッフ名での検索"""
+    template_name = 'booking/search.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        query = self.request.GET.get('q', '').strip()
+        if query:
+            context['store_list'] = search.search_stores(query)
+            context['staff_list'] = search.search_staff(query)
+        context['query'] = query
+        return context
+
+
 class StaffCalendar(generic.TemplateView):
     template_name = 'booking/calendar.html'
+    # 他のお客さんが仮押さえしている席を、残りの席数から引いて表示するか
+    show_holds = True
+    # カレンダーの表のHTMLを、共有キャッシュに置いておくか(仮押さえがない場合だけ)
+    cache_table = True
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        staff = get_object_or_404(Staff, pk=self.kwargs['pk'])
+        staff = coherence.cached_staff(self.kwargs['pk'])
         today = datetime.date.today()
 
         # どの日を基準にカレンダーを表示するかの処理。
@@ -81,23 +174,18 @@ class StaffCalendar(generic.TemplateView):
         start_day = days[0]
         end_day = days[-1]
 
-        # 9時から17時まで1時間刻み、1週間分の、値がTrueなカレンダーを作る
-        calendar = {}
-        for hour in range(9, 18):
-            row = {}
-            for day in days:
-                row[day] = True
-            calendar[hour] = row
-
-        # カレンダー表示する最初と最後の日時の間にある予約を取得する
-        start_time = datetime.datetime.combine(start_day, datetime.time(hour=9, minute=0, second=0))
-        end_time = datetime.datetime.combine(end_day, datetime.time(hour=17, minute=0, second=0))
-        for schedule in Schedule.objects.filter(staff=staff).exclude(Q(start__gt=end_time) | Q(end__lt=start_time)):
-            local_dt = timezone.localtime(schedule.start)
-            booking_date = local_dt.date()
-            booking_hour = local_dt.hour
-            if booking_hour in calendar and booking_date in calendar[booking_hour]:
-                calendar[booking_hour][booking_date] = False
+        # カレンダーを作る前に読んでおけば、作っている間の変更も、変更配信で受け取れる
+        context['last_change_id'] = events.latest_change_id(staff.pk)
+        calendar = coherence.cached_week_calendar(staff.pk, days, staff.capacity)
+        held = holds.held_slots(staff.pk, days, self.request.session.session_key) if self.show_holds else {}
+        if held:
+            # キャッシュしたカレンダーは共有しているので、コピーしてから書き換える
+            calendar = {hour: dict(row) for hour, row in calendar.items()}
+            for (date, hour), seats in held.items():
+                if date in calendar[hour]:
+                    calendar[hour][date] = max(calendar[hour][date] - seats, 0)
+        elif self.cache_table:
+            context['calendar_table'] = coherence.cached_calendar_table(staff, days, today, calendar)
 
         context['staff'] = staff
         context['calendar'] = calendar
@@ -111,33 +199,262 @@ class StaffCalendar(generic.TemplateView):
         return context
 
 
-class Booking(generic.CreateView):
+def month_calendar_context(staff_ids, year=None, month=None):
+    """1か月分の、日ごとの空き枠数のカレンダーのコンテキスト。年月の指定がなければ今月"""
+    today = datetime.date.today()
+    year = year or today.year
+    month = month or today.month
+    if not 1 <= month <= 12:
+        raise Http404
+    first_date, last_date = availability.month_range(year, month)
+    free_slots = availability.free_slots_by_day(staff_ids, first_date, last_date)
+    return {
+        'weeks': [
+            [(day, free_slots.get(day) if day.month == month else None) for day in week]
+            for week in availability.month_weeks(year, month)
+        ],
+        'first_date': first_date,
+        'before': first_date - datetime.timedelta(days=1),
+        'next': last_date + datetime.timedelta(days=1),
+        'today': today,
+        'public_holidays': settings.PUBLIC_HOLIDAYS,
+    }
+
+
+class StaffMonthCalendar(generic.TemplateView):
+    template_name = 'booking/month.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        staff = coherence.cached_staff(self.kwargs['pk'])
+        context.update(month_calendar_context([staff.pk], self.kwargs.get('year'), self.kwargs.get('month')))
+        context['staff'] = staff
+        context['store'] = staff.store
+        return context
+
+
+class StoreMonthCalendar(generic.TemplateView):
+    template_name = 'booking/month.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        store = get_object_or_404(Store, pk=self.kwargs['pk'])
+        staff_ids = Staff.objects.filter(store=store).values_list('pk', flat=True)
+        context.update(month_calendar_context(staff_ids, self.kwargs.get('year'), self.kwargs.get('month')))
+        context['store'] = store
+        return context
+
+
+def calendar_delta(request, pk, year=None, month=None, day=None):
+    """1週間分のカレンダーのうち、?since=バージョン から変わった枠だけをJSONで返す
+
+    sinceがない場合や、差分を作れないほど古い場合は、カレンダー全体を返す(fullがtrue)。
+    端末は、返されたversionを次のsinceに使う。枠には、変更配信と同じく残りの席数(remaining)も含める。
+    """
+    staff = get_object_or_404(Staff, pk=pk)
+    today = datetime.date.today()
+    base_date = datetime.date(year=year, month=month, day=day) if year and month and day else today
+    days = [base_date + datetime.timedelta(days=day) for day in range(7)]
+
+    # 先にバージョンを読んでおけば、この後に予約が入っても、次のリクエストで差分として受け取れる
+    version = staff.calendar_version
+    since = request.GET.get('since', '')
+    changes = events.changes_since(staff.pk, int(since), version, days[0], days[-1]) if since.isdigit() else None
+    full = changes is None
+    remaining = {}
+    if full:
+        calendar = availability.week_calendar(staff.pk, days, staff.capacity)
+        remaining = {(day, hour): seats for hour, row in calendar.items() for day, seats in row.items()}
+    elif changes:
+        # 変更履歴には予約の有無しかないので、変わった日の残りの席数を作り直す。
+        # 定員や休暇、繰り返しの設定で受け付けない枠も、変更配信(events.changes_to_dicts)と同じ値になる
+        calendar = availability.week_calendar(staff.pk, sorted({date for date, _ in changes}), staff.capacity)
+        remaining = {(date, hour): calendar[hour][date] for date, hour in changes}
+
+    return JsonResponse({
+        'version': version,
+        'full': full,
+        'today': today.isoformat(),
+        'cells': [
+            {'date': date.isoformat(), 'hour': hour, 'booked': seats == 0, 'remaining': seats}
+            for (date, hour), seats in sorted(remaining.items())
+        ],
+    })
+
+
+def calendar_events(request, pk):
+    """カレンダーの枠の変更を配信する。
+
+    通常はServer-Sent Eventsで配信し、?wait=秒数 があればロングポーリングとしてJSONを返す。
+    どの変更から送るかは、Last-Event-IDヘッダか ?last_id= で指定する。なければ、これから後の変更だけを送る。
+    """
+    staff = get_object_or_404(Staff, pk=pk)
+    last_id = request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('last_id', '')
+    last_id = int(last_id) if last_id.isdigit() else events.latest_change_id(staff.pk)
+
+    wait = request.GET.get('wait', '')
+    if wait:
+        timeout = min(float(wait) if wait.isdigit() else 0, settings.BOOKING_EVENTS_STREAM_SECONDS)
+        changes = events.wait_for_changes(staff.pk, last_id, timeout)
+        return JsonResponse({
+            'last_id': changes[-1].id if changes else last_id,
+            'changes': events.changes_to_dicts(staff.pk, changes),
+        })
+
+    response = StreamingHttpResponse(events.stream_changes(staff.pk, last_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+class SlotMixin:
+    """URLのスタッフと年月日時で、1時間の枠を指定するビュー"""
+
+    def get_start(self):
+        """枠の開始日時。存在しない日付や、営業時間外の時は404"""
+        if self.kwargs['hour'] not in availability.OPEN_HOURS:
+            raise Http404
+        try:
+            return timezone.make_aware(datetime.datetime(
+                year=self.kwargs['year'], month=self.kwargs['month'], day=self.kwargs['day'], hour=self.kwargs['hour']
+            ))
+        except ValueError:
+            raise Http404
+
+    def redirect_to_calendar(self):
+        return redirect(
+            'booking:calendar', pk=self.kwargs['pk'],
+            year=self.kwargs['year'], month=self.kwargs['month'], day=self.kwargs['day'],
+        )
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['staff'] = coherence.cached_staff(self.kwargs['pk'])
+        return context
+
+
+class Booking(SlotMixin, generic.CreateView):
     model = Schedule
     fields = ('name',)
     template_name = 'booking/booking.html'
+    # 予約の結果ごとの、お客さんへのメッセージ
+    outcome_messages = {
+        'conflict': 'すみません、入れ違いで予約がありました。別の日時はどうですか。',
+        'held': 'すみません、他のお客様が予約の手続き中です。別の日時はどうですか。',
+    }
+    outcome = ''
+
+    def get(self, request, *args, **kwargs):
+        # 名前を入力している間に他のお客さんが予約しないよう、枠を仮押さえしておく
+        staff = coherence.cached_staff(self.kwargs['pk'])
+        start = self.get_start()
+        if start <= timezone.now():
+            messages.error(request, 'この枠は、もう予約できません。')
+            return self.redirect_to_calendar()
+        if not waitlist.is_free(staff.pk, start):
+            messages.error(request, 'すみません、この枠は予約できません。別の日時はどうですか。')
+            return self.redirect_to_calendar()
+        if not request.session.session_key:
+            request.session.create()
+        if not holds.acquire(staff.pk, start, request.session.session_key, staff.capacity):
+            messages.error(request, 'すみません、他のお客様が予約の手続き中です。別の日時はどうですか。')
+            return self.redirect_to_calendar()
+        return super().get(request, *args, **kwargs)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['staff'] = get_object_or_404(Staff, pk=self.kwargs['pk'])
+        context['idempotency_key'] = idempotency.new_key()
         return context
 
+    def post(self, request, *args, **kwargs):
+        key = idempotency.request_key(request)
+        if key is None:
+            return super().post(request, *args, **kwargs)
+
+        # 同じキーで送信済みなら、予約テーブルには触れずに最初の結果を返す
+        record = idempotency.lookup(key)
+        if record is None:
+            with transaction.atomic():
+                record, existing = idempotency.claim(key, request.path)
+                if record is None and existing is not None:
+                    return self.replay(existing)
+                response = super().post(request, *args, **kwargs)
+                if record is not None:
+                    if self.outcome:
+                        record.outcome = self.outcome
+                        record.location = response.url
+                        record.save(update_fields=['outcome', 'location'])
+                    else:
+                        # 入力エラーなら、直して送り直せるようにキーを残さない
+                        record.delete()
+                return response
+        return self.replay(record)
+
+    def replay(self, record):
+        if not idempotency.matches(record, self.request.path):
+            # 別の枠への送信に使われたキーの結果は返さない
+            return HttpResponse('このキーは、別の予約の送信に使われています。', status=409)
+        metrics.bookings.inc(result='replayed')
+        if record.outcome in self.outcome_messages:
+            messages.error(self.request, self.outcome_messages[record.outcome])
+        return redirect(record.location) if record.location else self.redirect_to_calendar()
+
+    def finish(self, outcome):
+        """予約の結果(IdempotencyKey.OUTCOME_CHOICES)を記録して、カレンダーに戻る"""
+        self.outcome = outcome
+        metrics.bookings.inc(result=outcome)
+        if outcome in self.outcome_messages:
+            messages.error(self.request, self.outcome_messages[outcome])
+        return self.redirect_to_calendar()
+
     def form_valid(self, form):
         staff = get_object_or_404(Staff, pk=self.kwargs['pk'])
-        year = self.kwargs.get('year')
-        month = self.kwargs.get('month')
-        day = self.kwargs.get('day')
-        hour = self.kwargs.get('hour')
-        start = datetime.datetime(year=year, month=month, day=day, hour=hour)
-        end = datetime.datetime(year=year, month=month, day=day, hour=hour + 1)
-        if Schedule.objects.filter(staff=staff, start=start).exists():
-            messages.error(self.request, 'すみません、入れ違いで予約がありました。別の日時はどうですか。')
+        start = self.get_start()
+        end = start + datetime.timedelta(hours=1)
+        session_key = self.request.session.session_key
+        if holds.is_held_by_other(staff.pk, start, session_key, staff.capacity):
+            return self.finish('held')
+
+        schedule = form.save(commit=False)
+        schedule.staff = staff
+        schedule.start = start
+        schedule.end = end
+        try:
+            capacity.save_booking(schedule)
+        except conflicts.ScheduleConflict:
+            return self.finish('conflict')
+        if session_key:
+            holds.release(staff.pk, start, session_key)
+        return self.finish('success')
+
+
+class WaitlistRegister(SlotMixin, generic.CreateView):
+    """予約で埋まっている枠の、空き待ちの登録"""
+    model = WaitlistEntry
+    fields = ('name', 'email')
+    template_name = 'booking/waitlist.html'
+
+    def form_valid(self, form):
+        staff = get_object_or_404(Staff, pk=self.kwargs['pk'])
+        start = self.get_start()
+        if start <= timezone.now():
+            messages.error(self.request, 'この枠は、もう予約できません。')
+            return self.redirect_to_calendar()
+        if waitlist.is_free(staff.pk, start):
+            # 空いていれば、そのまま予約してもらう
+            return redirect('booking:booking', **self.kwargs)
+
+        entry = form.save(commit=False)
+        entry.staff = staff
+        entry.start = start
+        try:
+            with transaction.atomic():
+                entry.save()
+        except IntegrityError:
+            messages.error(self.request, 'このメールアドレスは、既に空き待ちに登録されています。')
         else:
-            schedule = form.save(commit=False)
-            schedule.staff = staff
-            schedule.start = start
-            schedule.end = end
-            schedule.save()
-        return redirect('booking:calendar', pk=staff.pk, year=year, month=month, day=day)
+            messages.success(self.request, '空き待ちに登録しました。枠が空いたら、登録順にメールでお知らせします。')
+        return self.redirect_to_calendar()
 
 
 class MyPage(LoginRequiredMixin, generic.TemplateView):
@@ -163,6 +480,8 @@ class MyPageWithPk(OnlyUserMixin, generic.TemplateView):
 
 class MyPageCalendar(OnlyStaffMixin, StaffCalendar):
     template_name = 'booking/my_page_calendar.html'
+    show_holds = False
+    cache_table = False
 
 
 class MyPageDayDetail(OnlyStaffMixin, generic.TemplateView):
@@ -179,8 +498,8 @@ class MyPageDayDetail(OnlyStaffMixin, generic.TemplateView):
 
         # 9時から17時まで1時間刻みのカレンダーを作る
         calendar = {}
-        for hour in range(9, 18):
-            calendar[hour] = []
+        for hour in availability.OPEN_HOURS:
+            calendar[hour] = {'schedules': [], 'block': None}
 
         # カレンダー表示する最初と最後の日時の間にある予約を取得する
         start_time = datetime.datetime.combine(date, datetime.time(hour=9, minute=0, second=0))
@@ -190,10 +509,16 @@ class MyPageDayDetail(OnlyStaffMixin, generic.TemplateView):
             booking_date = local_dt.date()
             booking_hour = local_dt.hour
             if booking_hour in calendar:
-                calendar[booking_hour].append(schedule)
+                calendar[booking_hour]['schedules'].append(schedule)
+
+        # 繰り返しの設定で受け付けない時間
+        for (_, hour), block in recurrence.blocked_slots(staff.pk, [date]).items():
+            if hour in calendar:
+                calendar[hour]['block'] = block
 
         context['calendar'] = calendar
         context['staff'] = staff
+        context['other_staff_list'] = Staff.objects.filter(store=staff.store_id).exclude(pk=staff.pk).order_by('name')
         return context
 
 
@@ -202,6 +527,14 @@ class MyPageSchedule(OnlyScheduleMixin, generic.UpdateView):
     fields = ('start', 'end', 'name')
     success_url = reverse_lazy('booking:my_page')
 
+    def form_valid(self, form):
+        try:
+            self.object = conflicts.save_schedule(form.save(commit=False))
+        except conflicts.ScheduleConflict as e:
+            form.add_error(None, e)
+            return self.form_invalid(form)
+        return redirect(self.get_success_url())
+
 
 class MyPageScheduleDelete(OnlyScheduleMixin, generic.DeleteView):
     model = Schedule
@@ -212,9 +545,48 @@ class MyPageScheduleDelete(OnlyScheduleMixin, generic.DeleteView):
 def my_page_holiday_add(request, pk, year, month, day, hour):
     staff = get_object_or_404(Staff, pk=pk)
     if staff.user == request.user or request.user.is_superuser:
-        start = datetime.datetime(year=year, month=month, day=day, hour=hour)
-        end = datetime.datetime(year=year, month=month, day=day, hour=hour + 1)
-        Schedule.objects.create(staff=staff, start=start, end=end, name='休暇(システムによる追加)')
+        start = timezone.make_aware(datetime.datetime(year=year, month=month, day=day, hour=hour))
+        end = start + datetime.timedelta(hours=1)
+        try:
+            conflicts.save_schedule(Schedule(staff=staff, start=start, end=end, name=day_actions.HOLIDAY_NAME))
+        except conflicts.ScheduleConflict as e:
+            messages.error(request, e.message if e.code == 'blocked' else 'この時間には、既に予約があります。')
+        else:
+            metrics.holidays_added.inc()
         return redirect('booking:my_page_day_detail', pk=pk, year=year, month=month, day=day)
 
     raise PermissionDenied
+
+
+@require_POST
+def my_page_day_bulk(request, pk, year, month, day):
+    """その日の予約を、まとめて削除(clear)・休暇に(close)・別のスタッフへ移動(move)する"""
+    staff = get_object_or_404(Staff, pk=pk)
+    if not (staff.user == request.user or request.user.is_superuser):
+        raise PermissionDenied
+
+    date = datetime.date(year=year, month=month, day=day)
+    action = request.POST.get('action')
+    if action == 'clear':
+        count = day_actions.clear_day(staff.pk, date)
+        messages.success(request, f'{count}件の予約を削除しました。')
+    elif action == 'close':
+        count = day_actions.close_day(staff.pk, date)
+        messages.success(request, f'{count}件の休暇を追加しました。')
+    elif action == 'move':
+        # 移動先は、同じ店舗のスタッフだけ
+        to_staff = get_object_or_404(Staff, pk=request.POST.get('to_staff') or 0, store=staff.store_id)
+        if not (to_staff.user == request.user or request.user.is_superuser):
+            raise PermissionDenied
+        try:
+            count = day_actions.move_day(staff.pk, date, to_staff.pk)
+        except conflicts.ScheduleConflict:
+            messages.error(request, f'{to_staff.name}さんに、重なる予約があるため移動できませんでした。')
+        else:
+            messages.success(request, f'{count}件の予約を{to_staff.name}さんに移動しました。')
+    return redirect('booking:my_page_day_detail', pk=pk, year=year, month=month, day=day)
+
+
+def metrics_view(request):
+    """Prometheusのテキスト形式で、計測値を返す"""
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,90 @@
+"""予約で埋まっている枠の、空き待ち。
+
+予約が削除・変更されて枠が空くと、予約と同じトランザクションで、その枠に一番先に登録した人を
+通知待ちにするだけにしておく(signals.schedules_changed)。メールは、リクエストとは別に動く
+dispatch_waitlistコマンドが、通知待ちの人をまとめて送る。
+"""
+import datetime
+from django.conf import settings
+from django.core.mail import send_mass_mail
+from django.db.models import Q
+from django.urls import reverse
+from django.utils import timezone
+from . import conflicts, recurrence
+from .availability import local_slot
+from .models import Schedule, WaitlistEntry
+
+
+def slot_start(date, hour):
+    return timezone.make_aware(datetime.datetime.combine(date, datetime.time(hour=hour)))
+
+
+def promote(removed, booked):
+    """予約がなくなって空いた枠について、一番先に登録した人を通知待ちにする
+
+    removedはなくなった予約の(スタッフのpk, 開始日時)のリストで、bookedはそれを含む
+    availability.booked_hours_for_slots()の結果。
+    """
+    freed = set()
+    for staff_id, start in removed:
+        slot = local_slot(start)
+        if slot is not None and slot[1] not in booked.get((staff_id, slot[0]), ()):
+            freed.add((staff_id, slot_start(*slot)))
+    if not freed:
+        return
+
+    # 空いた枠の空き待ちを1回のクエリで取得し、枠ごとに一番先に登録した人だけを選ぶ
+    condition = Q()
+    for staff_id, start in freed:
+        condition |= Q(staff_id=staff_id, start=start)
+    first = {}
+    entries = WaitlistEntry.objects.filter(condition, status=WaitlistEntry.WAITING).order_by('created_at', 'pk')
+    for pk, staff_id, start in entries.values_list('pk', 'staff_id', 'start'):
+        first.setdefault((staff_id, start), pk)
+    if first:
+        WaitlistEntry.objects.filter(pk__in=first.values()).update(status=WaitlistEntry.PENDING)
+
+
+def is_free(staff_id, start):
+    """枠が、今も予約できるか"""
+    schedule = Schedule(staff_id=staff_id, start=start, end=start + datetime.timedelta(hours=1))
+    return not conflicts.find_conflicts(schedule, limit=1) and not recurrence.find_blocked([schedule])
+
+
+def notification(entry):
+    local_start = timezone.localtime(entry.start)
+    url = settings.BOOKING_SITE_URL + reverse('booking:booking', kwargs={
+        'pk': entry.staff_id, 'year': local_start.year, 'month': local_start.month, 'day': local_start.day,
+        'hour': local_start.hour,
+    })
+    subject = '【予約サイト】空き待ちの枠が空きました'
+    body = (
+        f'{entry.name}様\n\n'
+        f'{entry.staff.store.name}店 {entry.staff.name}の、{local_start:%Y年%m月%d日 %H時}の枠が空きました。\n'
+        f'ご予約は、こちらからどうぞ(先着順です)。\n{url}\n'
+    )
+    return subject, body, settings.DEFAULT_FROM_EMAIL, [entry.email]
+
+
+def dispatch(batch_size=100):
+    """通知待ちの人に、batch_size件ずつまとめてメールを送る。送った件数を返す
+
+    送る前に枠がまた埋まっていれば、送らずに空き待ちへ戻す(登録順はそのまま)。
+    """
+    sent = 0
+    while True:
+        entries = list(
+            WaitlistEntry.objects.filter(status=WaitlistEntry.PENDING).select_related('staff__store').order_by('pk')[:batch_size]
+        )
+        if not entries:
+            return sent
+
+        free = [entry for entry in entries if is_free(entry.staff_id, entry.start)]
+        free_pks = {entry.pk for entry in free}
+        taken = [entry.pk for entry in entries if entry.pk not in free_pks]
+        send_mass_mail([notification(entry) for entry in free], fail_silently=False)
+        WaitlistEntry.objects.filter(pk__in=free_pks).update(
+            status=WaitlistEntry.NOTIFIED, notified_at=timezone.now(),
+        )
+        WaitlistEntry.objects.filter(pk__in=taken).update(status=WaitlistEntry.WAITING)
+        sent += len(free)
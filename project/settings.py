@@ -41,6 +41,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # ミドルウェアも含めて計測するため、最初に置く
+    'booking.middleware.SamplingProfilerMiddleware',
+    'booking.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -82,6 +85,10 @@ DATABASES = {
 }
 
 
+# テスト用のデータベースを、マイグレーション済みのテンプレートからコピーして作る(booking/test_runner.py)
+TEST_RUNNER = 'booking.test_runner.TemplateDatabaseRunner'
+BOOKING_TEST_TEMPLATE_DIR = os.path.join(BASE_DIR, 'cache', 'test')
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -165,3 +172,53 @@ PUBLIC_HOLIDAYS = [
 LOGIN_URL = 'booking:login'
 LOGIN_REDIRECT_URL = 'booking:store_list'
 LOGOUT_REDIRECT_URL = 'booking:store_list'
+
+# カレンダーの変更配信(Server-Sent Events)で、変更を確認する間隔と、1回の接続を続ける秒数
+BOOKING_EVENTS_POLL_INTERVAL = 1
+BOOKING_EVENTS_STREAM_SECONDS = 30
+
+# 差分カレンダーで返す変更の上限。これより多く変わっていれば、カレンダー全体を返す
+BOOKING_DELTA_MAX_CHANGES = 500
+
+# プロセス内キャッシュの世代番号を、全ワーカーで共有するためのSQLiteファイル
+BOOKING_COHERENCE_DB = os.path.join(BASE_DIR, 'coherence.sqlite3')
+
+# 予約ページを開いたときに、予約枠を仮押さえしておく秒数
+BOOKING_HOLD_SECONDS = 300
+
+# cProfileで計測するリクエストの割合(0から1)。0なら計測しない
+BOOKING_PROFILE_RATE = float(os.environ.get('BOOKING_PROFILE_RATE', 0))
+# 計測結果を保存するディレクトリと、何回分をまとめて1ファイルにするか、URL名ごとに残すファイルの数
+BOOKING_PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
+BOOKING_PROFILE_FLUSH_EVERY = 20
+BOOKING_PROFILE_KEEP = 10
+
+# /metrics で、全ワーカーの計測値を合計するためのディレクトリ。Noneなら、リクエストを処理したプロセスの計測値だけを返す
+BOOKING_METRICS_DIR = None
+BOOKING_METRICS_FLUSH_SECONDS = 5
+
+# 全ワーカーで共有するキャッシュ。カレンダーの事前作成(prewarm_calendars)でも使う
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'calendar': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'calendar'),
+        'TIMEOUT': 60 * 60 * 24 * 2,
+    },
+}
+BOOKING_CALENDAR_CACHE = 'calendar'
+
+# 事前作成する週の数と、Webサーバーの起動時にも事前作成するか
+BOOKING_PREWARM_WEEKS = 4
+BOOKING_PREWARM_ON_STARTUP = False
+
+# 予約の二重送信対策のキーを、最初の結果と一緒に残しておく秒数
+BOOKING_IDEMPOTENCY_SECONDS = 60 * 60 * 24
+
+# 空き待ちの通知メール。本番ではSMTPなどに変更する
+EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+DEFAULT_FROM_EMAIL = 'noreply@example.com'
+# メールに書く、予約ページのURLの先頭
+BOOKING_SITE_URL = 'http://127.0.0.1:8000'